@@ -18,6 +18,13 @@ from .models import CLAUDE, MODELS
 from .exceptions import *
 from .streamwrappers import *
 from .utils import _get_api_key
+from .tools import Tool, ToolPool, get_tool_instance, LIFECYCLE_CALL
+from .streamutils import _get_coalescer
+from .logwriter import LogWriter, _shared_writer
+from .logstore import LogStore, FileLogStore, SQLiteLogStore
+from .attachments import BLOB_SOURCE_TYPE, Attachment, BlobStore, b64encode, encoded_attachments, blob_sources, blob_digests, rehydrate_messages
+from . import fileuploads
+from .snapshot import dump_snapshot, load_snapshot
 
 from pathlib import Path
 import os
@@ -25,6 +32,8 @@ import json
 import datetime
 import time
 import types
+import inspect
+import functools
 from types import SimpleNamespace
 from collections import defaultdict
 
@@ -66,13 +75,29 @@ class Bot(object):
     """
     __slots__ = ['fields', 'sysprompt_path', 'sysprompt_text', 'client', 'model', 
             'temperature', 'max_tokens', 'oneshot', 'welcome_message', 'soft_start', 
-            'tools', 'bot_name']
+            'tools', 'bot_name', 'stream_retain_events', 'stream_resume_attempts', 'stream_readahead',
+            'upload_files', 'image_pipeline']
     """soft_start will inject the welcome_message into the conversation context as though 
             the agent had said it, making it think that the conversation has already
             begun. Beware of causing confusion by soft-starting with something the model 
             wouldn't say.
         oneshot is for bots that don't need to maintain conversation context to do their job.
-            Is NOT compatible with tool use!"""
+            Is NOT compatible with tool use!
+        stream_retain_events is how many raw events a stream wrapper keeps in its .events list:
+            None (the default) keeps them all, an int N keeps only the most recent N.
+        stream_resume_attempts is how many times a streamed response will be resumed if the
+            connection drops partway through (default 0, ie. never). The request is re-issued
+            with the text received so far as a prefill, and the continuation carries on in the
+            same text_stream. Responses that have started a tool call can't be resumed.
+        stream_readahead (sync streaming only) - if set to N > 0, a background thread reads up
+            to N events ahead of the consumer, so that the connection keeps being read while the
+            consumer is busy with a chunk. Default 0, ie. off.
+        upload_files - if True, files attached with with_files are uploaded through the Files API
+            (once each; see robo.fileuploads) and referred to by file_id, rather than being sent
+            as base64 in every request. Default False.
+        image_pipeline - an ImagePipeline (see robo.images) that attached JPEG, PNG and WEBP
+            images are put through before they're sent, to shrink them to the size the model
+            actually uses and strip their metadata. Default None, ie. images are sent as they are."""
     
     @staticmethod
     def _make_sysprompt_segment(text, set_cache_checkpoint=False):
@@ -141,26 +166,99 @@ class Bot(object):
         """
         return {}
     
+    @staticmethod
+    def _make_tool_dispatch_entry(name, toolclass=None, attrname=None, function=None):
+        if toolclass is not None:
+            target = getattr(toolclass, 'target', None)
+            if target is None or type(target) is types.MemberDescriptorType:
+                target = 'model'
+            return SimpleNamespace(
+                name = name,
+                toolclass = toolclass,
+                attrname = None,
+                target = target,
+                lifecycle = toolclass.get_lifecycle(),
+                native_async = toolclass.call_async is not Tool.call_async,
+                validator = toolclass.get_input_validator(),
+            )
+        return SimpleNamespace(
+            name = name,
+            toolclass = None,
+            attrname = attrname,
+            target = None,
+            lifecycle = None,
+            native_async = inspect.iscoroutinefunction(function),
+            validator = None,
+        )
+    
+    @classmethod
+    def _make_attribute_dispatch_entry(klass, name, attrname, tool):
+        """Dispatch entry for a tool that is an attribute of the Bot: a Tool class, or a function
+        (anything else callable) to be called with the input; None if it's neither"""
+        if isinstance(tool, type) and issubclass(tool, Tool):
+            return klass._make_tool_dispatch_entry(name, toolclass=tool)
+        if callable(tool):
+            return klass._make_tool_dispatch_entry(name, attrname=attrname, function=tool)
+        return None
+    
+    @classmethod
+    def _get_tool_dispatch_table(klass) -> dict:
+        """Map API tool names to dispatch entries. Built once per Bot class and then reused, so
+        that dispatching a tool call is a single dict lookup. Tool classes are indexed by the name
+        in their call schema (which may differ from the class name), function-style tools by the
+        name following their tools_ prefix."""
+        if (table := klass.__dict__.get('_tool_dispatch_table')) is not None:
+            return table
+        table = {}
+        for attrname in dir(klass):
+            if attrname.startswith('tools_') and (entry := klass._make_attribute_dispatch_entry(
+                        attrname[len('tools_'):], attrname, getattr(klass, attrname))) is not None:
+                table[entry.name] = entry
+        if (tools := getattr(klass, 'tools', None)) and type(tools) is not types.MemberDescriptorType:
+            for toolclass in tools:
+                name = toolclass.get_call_schema()['name']
+                table[name] = klass._make_tool_dispatch_entry(name, toolclass=toolclass)
+        klass._tool_dispatch_table = table
+        return table
+    
+    def _get_tool_dispatch_entry(self, name):
+        table = self._get_tool_dispatch_table()
+        try:
+            return table[name]
+        except KeyError:
+            pass
+        ## Not indexed - could be a Tool class or method that is an attribute of the Bot (or of this
+        ## instance) but isn't registered via tools or named with the tools_ prefix. Look it up the
+        ## old way; only tools that the class has are kept in its table.
+        for candidate in [f'tools_{name}', name]:
+            if (tool := getattr(self, candidate, None)) is None:
+                continue
+            if (entry := self._make_attribute_dispatch_entry(name, candidate, tool)) is None:
+                continue
+            if hasattr(type(self), candidate):
+                table[name] = entry
+            return entry
+        raise Exception(f'Tool function not found: tools_{name}')
+    
     def _configure_tool_call(self, tooluseblock):
         if type(tooluseblock) is dict:
             tooluseblock = SimpleNamespace(**tooluseblock)
-        for toolfnname_candidate in [f'tools_{tooluseblock.name}', tooluseblock.name]:
-            tool = getattr(self, toolfnname_candidate, None)
-            if tool:
-                break
-        if tool is None:
-            raise Exception(f'Tool function not found: tools_{tooluseblock.name}')
-        
-        if type(tool) is type:
-            target = getattr(tool, 'target', None)
-            if target is None or type(target) is types.MemberDescriptorType:
-                target = 'model'
-        else:
-            target = None
-        
-        return (tooluseblock, tool, target)
+        return (tooluseblock, self._get_tool_dispatch_entry(tooluseblock.name))
     
-    def handle_tool_call(self, tooluseblock:dict | SimpleNamespace, toolcontext:dict={}) -> dict:
+    @staticmethod
+    def _check_tool_input(tooluseblock, entry):
+        """Validate the input for a tool call before it runs. Returns None if the input is fine, 
+        otherwise an error response to be sent back to the model in place of the tool's output."""
+        if entry.validator is None or not (problems := entry.validator(tooluseblock.input)):
+            return None
+        return {
+            'target': 'model',
+            'message': f"Invalid input for tool {entry.name}: " + '; '.join(problems),
+            'is_error': True,
+        }
+    
+    def handle_tool_call(self, tooluseblock:dict | SimpleNamespace, toolcontext:dict={}, toolpool:ToolPool=None, 
+                toolinstance:Tool=None) -> dict:
         """Execute a tool call based on the provided tool use block. Checks the Bot for a tool function
         or registered callable class to handle the block.
         
@@ -170,8 +268,16 @@ class Bot(object):
                 "message": <message for the client or the model, flexible format>
             }
         
+        For Tool classes, the input is validated against the tool's call schema first; if it's 
+        invalid the tool isn't run, and an error response (with "is_error": True) targeting the 
+        model is returned instead.
+        
         Args:
             tooluseblock: Tool use block containing name and input parameters
+            toolcontext: Passed to the Tool's __init__ when an instance is created
+            toolpool: Where to find/keep instances of Tools with a 'conversation' lifecycle
+            toolinstance: An already-created instance of the Tool to use (eg. one that has been 
+                receiving the input as it streamed in)
             
         Returns:
             The result of the tool execution
@@ -179,18 +285,34 @@ class Bot(object):
         Raises:
             Exception: If the requested tool function is not found
         """
-        tooluseblock, tool, target = self._configure_tool_call(tooluseblock)
-        if target is None:
-            return tool(**tooluseblock.input)
-        else:
-            return {'target': target, 'message': tool(**toolcontext).call_sync(**tooluseblock.input)}
-    
-    async def ahandle_tool_call(self, tooluseblock:dict | SimpleNamespace, toolcontext:dict={}) -> dict:
-        tooluseblock, tool, target = self._configure_tool_call(tooluseblock)
-        if target is None:
-            return tool(**tooluseblock.input)
-        else:
-            return {'target': target, 'message': await tool(**toolcontext).call_async(**tooluseblock.input)}
+        tooluseblock, entry = self._configure_tool_call(tooluseblock)
+        if entry.toolclass is None:
+            return getattr(self, entry.attrname)(**tooluseblock.input)
+        try:
+            if (error_response := self._check_tool_input(tooluseblock, entry)) is not None:
+                return error_response
+            instance, toolinstance = toolinstance or get_tool_instance(entry.toolclass, toolcontext, toolpool), None
+            return {'target': entry.target, 'message': instance.call_sync(**tooluseblock.input)}
+        finally:
+            if toolinstance is not None and entry.lifecycle == LIFECYCLE_CALL:
+                ## Created for streaming_input, but the call was never made
+                toolinstance.teardown()
+    
+    async def ahandle_tool_call(self, tooluseblock:dict | SimpleNamespace, toolcontext:dict={}, toolpool:ToolPool=None, 
+                toolinstance:Tool=None) -> dict:
+        tooluseblock, entry = self._configure_tool_call(tooluseblock)
+        if entry.toolclass is None:
+            result = getattr(self, entry.attrname)(**tooluseblock.input)
+            return (await result) if entry.native_async else result
+        try:
+            if (error_response := self._check_tool_input(tooluseblock, entry)) is not None:
+                return error_response
+            instance, toolinstance = toolinstance or get_tool_instance(entry.toolclass, toolcontext, toolpool), None
+            return {'target': entry.target, 'message': await instance.call_async(**tooluseblock.input)}
+        finally:
+            if toolinstance is not None and entry.lifecycle == LIFECYCLE_CALL:
+                ## Created for streaming_input, but the call was never made
+                await toolinstance.ateardown()
     
     @property
     def sysprompt_clean(self) -> str | dict:
@@ -250,7 +372,9 @@ class Bot(object):
     def __init__(self, client=None, async_mode=False):
         for f, v in [('model', CLAUDE.SONNET.LATEST), ('temperature', 1), ('fields', []),
                     ('max_tokens', 8192), ('oneshot', False), ('welcome_message', None),
-                    ('soft_start', False)]:
+                    ('soft_start', False), ('stream_retain_events', None),
+                    ('stream_resume_attempts', 0), ('stream_readahead', 0), ('upload_files', False),
+                    ('image_pipeline', None)]:
             if not hasattr(self, f):
                 setattr(self, f, v)
         if not client:
@@ -306,7 +430,10 @@ class Conversation(object):
     __slots__ = ['messages', 'bot', 'sysprompt', 'argv', 'max_tokens', 'message_objects', 
                 'is_streaming', 'started', 'is_async', 'oneshot',
                 'soft_started', 'tool_use_blocks', 'tool_context'] + \
-                ['_callbacks_registered', '_message_cache_checkpoints']
+                ['_callbacks_registered', '_message_cache_checkpoints', '_tool_pool', '_streaming_tool_instances',
+                 '_attachments', '_blobs', 'image_pipeline']
+    _SNAPSHOT_FIELDS = ['messages', 'sysprompt', 'argv', 'max_tokens', 'oneshot', 'message_objects', 'started',
+                'soft_started', 'tool_use_blocks', '_message_cache_checkpoints', '_attachments']
     def __init__(self, bot:BotType, argv:list|dict=None, stream:bool=False, async_mode:bool=False, soft_start:bool=None, tool_context=None):
         self.is_async = async_mode
         if type(bot) is type:
@@ -321,6 +448,11 @@ class Conversation(object):
         self._callbacks_registered = defaultdict(list)
         self._message_cache_checkpoints = []
         self.tool_use_blocks = SimpleNamespace(pending=[], resolved=[])
+        self._tool_pool = ToolPool()
+        self._streaming_tool_instances = {}
+        self._attachments = {} ## Attachments referred to by messages, by digest
+        self._blobs = None ## Where attachments that aren't in _attachments can be found, if anywhere
+        self.image_pipeline = self.bot.image_pipeline
         if (soft_start or (self.bot.soft_start and not soft_start is False)) and self.bot.welcome_message:
             self.messages.append(self._make_text_message('assistant', self.bot.welcome_message))
             self.message_objects.append(None)
@@ -379,14 +511,30 @@ class Conversation(object):
         }
     
     @staticmethod
-    def _make_message_file_segment(filespec):
+    def _make_message_file_segment(filespec, attachments=None, image_pipeline=None):
         """filespec is (mimetype, filething, blocktype)
-        filething can be a filepath or a file-like object.
+        filething can be a filepath, bytes (or another bytes-like object, which isn't copied) or a
+        file-like object.
+        If attachments (a dict) is given, the segment refers to the file by digest and the
+        Attachment goes in attachments, to be encoded when a request is sent; otherwise the file
+        is base64-encoded into the segment. Images are put through image_pipeline, if given.
         """
         """blocktype (per Claude API) is one of image, document, container_upload"""
-        import base64
         mimetype, filething, blocktype = filespec
-        if type(filething) is bytes:
+        if image_pipeline is not None and blocktype == 'image':
+            filething, mimetype = image_pipeline.process_file(filething, mimetype)
+        if attachments is not None:
+            attachment = Attachment(filething)
+            attachments.setdefault(attachment.digest, attachment)
+            return {
+                'type': blocktype,
+                'source': {
+                    'type': BLOB_SOURCE_TYPE,
+                    'media_type': mimetype,
+                    'digest': attachment.digest,
+                }
+            }
+        if isinstance(filething, (bytes, bytearray, memoryview)):
             filedat = filething
         elif hasattr(filething, 'read') and callable(filething.read):
             filedat = filething.read()
@@ -399,7 +547,7 @@ class Conversation(object):
             'source': {
                 'type': 'base64',
                 'media_type': mimetype,
-                'data': base64.b64encode(filedat).decode('utf-8')
+                'data': b64encode(filedat)
             }
         }
     
@@ -465,10 +613,59 @@ class Conversation(object):
             )
         )
     
+    def _begin_tool_request(self, toolblock):
+        """Called when the model starts streaming a tool call. Tools that want their input as it 
+        streams in (see Tool.streaming_input) are instantiated here."""
+        try:
+            entry = self.bot._get_tool_dispatch_entry(toolblock.name)
+        except Exception:
+            return ## Let the failure surface when the call is handled
+        if entry.toolclass is not None and getattr(entry.toolclass, 'streaming_input', False) is True:
+            self._streaming_tool_instances[toolblock.id] = get_tool_instance(entry.toolclass, 
+                    self.tool_context, self._tool_pool)
+    
+    def _drop_streaming_tools(self):
+        """Forget instances created by _begin_tool_request whose calls were never handled (because
+        the stream failed or was abandoned), returning the 'call' lifecycle ones for teardown. Pooled
+        instances stay in their pools."""
+        instances, self._streaming_tool_instances = self._streaming_tool_instances, {}
+        return [instance for instance in instances.values() if type(instance).get_lifecycle() == LIFECYCLE_CALL]
+    
+    def _end_streaming_tools(self):
+        for instance in self._drop_streaming_tools():
+            instance.teardown()
+    
+    async def _aend_streaming_tools(self):
+        for instance in self._drop_streaming_tools():
+            await instance.ateardown()
+    
+    def _stream_tool_input(self, toolblock, partial_json, snapshot):
+        if (instance := self._streaming_tool_instances.get(toolblock.id)) is not None:
+            instance.input_delta(partial_json, snapshot)
+        def tool_input_delta_callback_wrapper(callback_function):
+            callback_function(self, (toolblock, partial_json, snapshot))
+        self._execute_callbacks('tool_input_delta', tool_input_delta_callback_wrapper)
+    
+    async def _astream_tool_input(self, toolblock, partial_json, snapshot):
+        if (instance := self._streaming_tool_instances.get(toolblock.id)) is not None:
+            await instance.ainput_delta(partial_json, snapshot)
+        async def tool_input_delta_callback_wrapper(callback_function):
+            await callback_function(self, (toolblock, partial_json, snapshot))
+        await self._aexecute_callbacks('tool_input_delta', tool_input_delta_callback_wrapper)
+    
+    def _truncate_messages(self, length):
+        """Remove messages from the end of the conversation, leaving the first `length`"""
+        del self.messages[length:]
+        self._message_cache_checkpoints[:] = [cp for cp in self._message_cache_checkpoints if cp < length]
+    
+    def _pending_tool_names(self):
+        return [tub.name for tub in self.tool_use_blocks.pending if tub.status == 'PENDING']
+    
     def _handle_pending_tool_requests(self):
         for tub in self.tool_use_blocks.pending:
             if tub.status == 'PENDING':
-                tub.response = self.bot.handle_tool_call(tub.request, toolcontext=self.tool_context)
+                tub.response = self.bot.handle_tool_call(tub.request, toolcontext=self.tool_context, 
+                        toolpool=self._tool_pool, toolinstance=self._streaming_tool_instances.pop(tub.id, None))
                 def tool_executed_callback_wrapper(callback_function):
                     callback_function(self, (tub.request, tub.response))
                 self._execute_callbacks('tool_executed', tool_executed_callback_wrapper)
@@ -480,7 +677,8 @@ class Conversation(object):
     async def _ahandle_pending_tool_requests(self):
         for tub in self.tool_use_blocks.pending:
             if tub.status == 'PENDING':
-                tub.response = await self.bot.ahandle_tool_call(tub.request, toolcontext=self.tool_context)
+                tub.response = await self.bot.ahandle_tool_call(tub.request, toolcontext=self.tool_context, 
+                        toolpool=self._tool_pool, toolinstance=self._streaming_tool_instances.pop(tub.id, None))
                 async def tool_executed_callback_wrapper(callback_function):
                     await callback_function(self, (tub.request, tub.response))
                 await self._aexecute_callbacks('tool_executed', tool_executed_callback_wrapper)
@@ -514,6 +712,7 @@ class Conversation(object):
                     'type': 'tool_result',
                     'tool_use_id': tub.id,
                     'content': str(tub.response['message']),
+                    **({'is_error': True} if tub.response.get('is_error') else {})
                 })
                 tub.status = 'RESOLVED' if mark_resolved else tub.status
         if mark_resolved:
@@ -533,29 +732,88 @@ class Conversation(object):
         return lastmsg['role'] == 'assistant' and \
             all([block['type'] == 'text' for block in lastmsg['content']])
     
-    def _get_conversation_context(self):
-        """Oneshot is for bots that don't need conversational context"""
+    def _get_conversation_context(self, resolve=None):
+        """Oneshot is for bots that don't need conversational context. resolve turns attachment
+        references into sources (by default, _resolve_attachment)"""
         checkpoints = self._message_cache_checkpoints
         if self.oneshot:
-            return [self.messages[-1]]
+            mymessages = [self.messages[-1]]
         elif len(checkpoints) > 0:
             from copy import deepcopy
             mymessages = deepcopy(self.messages)
             for idx in checkpoints:
                 mymessages[idx]['content'][-1]['cache_control'] = {'type': 'ephemeral'}
-            return mymessages
+        else:
+            mymessages = self.messages
         
-        return self.messages
+        return rehydrate_messages(mymessages, resolve or self._resolve_attachment)
+    
+    def _load_attachment(self, digest):
+        ## Attachments in a restored (or revived) conversation's messages are only in the blob store
+        if digest in self._attachments or self._blobs is None:
+            return self._attachments[digest].read()
+        return self._blobs.get(digest)
+    
+    def _attachment_filename(self, digest):
+        if (attachment := self._attachments.get(digest)) is not None and isinstance(attachment.source, Path):
+            return attachment.source.name
+    
+    def _encode_attachment(self, digest):
+        if (attachment := self._attachments.get(digest)) is not None:
+            return attachment.encode()
+        return b64encode(self._load_attachment(digest))
+    
+    def _attachment_data(self, digest):
+        """The base64 for an attachment, from the cache shared by all conversations if possible"""
+        return encoded_attachments.get(digest, functools.partial(self._encode_attachment, digest))
+    
+    def _resolve_attachment(self, source):
+        """The source to send for an attachment: a file_id if the bot uploads files (an async
+        conversation's uploads are done beforehand, by _aload_attachments()), otherwise base64"""
+        digest = source['digest']
+        if self.bot.upload_files:
+            if not self.is_async:
+                file_id = fileuploads.uploaded_files.upload(self.bot.client, digest, source['media_type'],
+                            functools.partial(self._load_attachment, digest), self._attachment_filename(digest))
+            else:
+                file_id = fileuploads.uploaded_files.lookup(self.bot.client, digest)
+            if file_id is not None:
+                return {'type': 'file', 'file_id': file_id}
+        return {'type': 'base64', 'media_type': source['media_type'], 'data': self._attachment_data(digest)}
+    
+    async def _aload_attachments(self):
+        """Upload or encode any attachments that need it, so that the event loop doesn't wait on
+        reading, encoding or uploading them when the request is put together"""
+        sources = {source['digest']: source for source in blob_sources(self.messages)}
+        if self.bot.upload_files:
+            for digest, source in sources.items():
+                await fileuploads.uploaded_files.aupload(self.bot.client, digest, source['media_type'],
+                            functools.partial(self._load_attachment, digest), self._attachment_filename(digest))
+        elif (missing := [digest for digest in sources if digest not in encoded_attachments]):
+            await asyncio.to_thread(lambda: [self._attachment_data(digest) for digest in missing])
+    
+    def _process_images(self, with_files):
+        """Put the images among with_files through the image pipeline, ahead of compiling the
+        message (which puts them through again, but the pipeline's cache makes that cheap)"""
+        processed = []
+        for fspec in with_files:
+            if type(fspec) is not tuple:
+                fspec = self._infer_filespec_from_filename(fspec)
+            mimetype, filething, blocktype = fspec
+            if blocktype == 'image':
+                filething, mimetype = self.image_pipeline.process_file(filething, mimetype)
+            processed.append((mimetype, filething, blocktype))
+        return processed
     
     @classmethod
-    def _compile_user_message(klass, message, with_files=[]):
+    def _compile_user_message(klass, message, with_files=[], attachments=None, image_pipeline=None):
         if with_files:
             message_blocks = []
             for fspec in with_files:
                 if type(fspec) is not tuple:
                     fspec = klass._infer_filespec_from_filename(fspec)
                 message_blocks.append(
-                    klass._make_message_file_segment(fspec)
+                    klass._make_message_file_segment(fspec, attachments, image_pipeline)
                 )
             if message: ## Allow for messages consisting only of files
                 message_blocks.append(klass._make_message_text_segment(message))
@@ -589,6 +847,9 @@ class Conversation(object):
     
     def register_callback(self, callback_name:str, callback_fn:Callable[[ConversationType, tuple], None]) -> None:
         self._callbacks_registered[callback_name].append(callback_fn)
+    
+    def unregister_callback(self, callback_name:str, callback_fn:Callable[[ConversationType, tuple], None]) -> None:
+        self._callbacks_registered[callback_name].remove(callback_fn)
         
     def _lookup_callbacks(self, callback_name):
         return self._callbacks_registered[callback_name]
@@ -601,17 +862,125 @@ class Conversation(object):
         await asyncio.gather(*[callback_wrapper(callback_coro) for callback_coro in self._lookup_callbacks(callback_name)])
     
     def count_tokens(self, message:str, with_files:list=[]):
-        compiled_messages = self._get_conversation_context() + [
-            self._compile_user_message(message, with_files=with_files)
-        ]
+        """Count the input tokens that sending message (with with_files) would use. This changes
+        nothing: the files aren't added to the conversation, and attachments are counted as inline
+        base64 rather than being uploaded, even if the bot uploads files."""
+        attachments = dict(self._attachments) ## with_files are added to a copy
+        
+        def resolve(source):
+            digest = source['digest']
+            if digest in self._attachments or digest not in attachments:
+                data = self._attachment_data(digest)
+            else:
+                data = attachments[digest].encode()
+            return {'type': 'base64', 'media_type': source['media_type'], 'data': data}
+        
+        compiled_messages = self._get_conversation_context(resolve) + rehydrate_messages([
+            self._compile_user_message(message, with_files=with_files, attachments=attachments,
+                    image_pipeline=self.image_pipeline)
+        ], resolve)
         config = self._configure_for_message()
         
         return self.bot.client.messages.count_tokens(
             model = config['model'],
             system = config['system'],
-            messages = compiled_messages
+            messages = compiled_messages,
+            **({'extra_headers': config['extra_headers']} if 'extra_headers' in config else {})
         )
     
+    @staticmethod
+    def _dump_message_object(message_object):
+        if message_object is None:
+            return None
+        if isinstance(message_object, CannedResponse):
+            return {'type': 'canned', 'text': message_object.text, 'include_in_context': message_object.include_in_context}
+        return message_object.model_dump(mode='json')
+    
+    @staticmethod
+    def _load_message_object(data):
+        if data is None:
+            return None
+        if data['type'] == 'canned':
+            return CannedResponse(data['text'], data['include_in_context'])
+        return anthropic.types.Message.model_validate(data)
+    
+    @staticmethod
+    def _dump_tool_use_block(tub):
+        request = tub.request.model_dump(mode='json') if hasattr(tub.request, 'model_dump') else vars(tub.request)
+        ## Tools can return anything, so keep only what _compile_tool_responses() sends to the API
+        response = None if tub.response is None else {'target': tub.response.get('target'),
+                    'message': str(tub.response['message']), 'is_error': bool(tub.response.get('is_error'))}
+        return vars(tub) | {'request': request, 'response': response}
+    
+    @staticmethod
+    def _load_tool_use_block(data):
+        return SimpleNamespace(**(data | {'request': SimpleNamespace(**data['request'])}))
+    
+    def _snapshot_state(self, blobs):
+        if self._attachments:
+            if blobs is None:
+                raise ValueError("A blob store is needed to snapshot a conversation with attachments")
+            for digest, attachment in self._attachments.items():
+                if digest not in blobs:
+                    blobs.put(attachment.read())
+        return {field: getattr(self, field) for field in self._SNAPSHOT_FIELDS} | {
+            'message_objects': [self._dump_message_object(obj) for obj in self.message_objects],
+            'tool_use_blocks': {status: [self._dump_tool_use_block(tub) for tub in getattr(self.tool_use_blocks, status)]
+                        for status in ('pending', 'resolved')},
+            '_attachments': list(self._attachments),
+            'is_async': self.is_async,
+            'is_streaming': self.is_streaming,
+        }
+    
+    def snapshot(self, blobs:BlobStore|None=None) -> bytes:
+        """Serialise the conversation's state (but not its bot, client, tool context or callbacks)
+        so that restore() can carry it on, in this process or another. Take snapshots between
+        turns, not while a response is streaming.
+        
+        Attachments are referred to by digest rather than included; their contents are put in
+        blobs (a BlobStore that the restoring process can get at too), which is required if the
+        conversation has any."""
+        return dump_snapshot(self._snapshot_state(self._blobs if blobs is None else blobs))
+    
+    async def asnapshot(self, blobs:BlobStore|None=None) -> bytes:
+        """Async version of snapshot()"""
+        return self.snapshot(blobs)
+    
+    @classmethod
+    def restore(klass, bot:BotType, snapshot:bytes, blobs:BlobStore|None=None, **kwargs) -> Self:
+        """Recreate a conversation from the output of snapshot().
+        
+        Args:
+            bot: The bot instance or class to use for the conversation
+            snapshot (bytes): What snapshot() returned
+            blobs (BlobStore): Where the conversation's attachments were put by snapshot()
+            **kwargs: Additional arguments to be passed to the constructor; async_mode and
+                stream default to those of the conversation the snapshot was taken from
+        
+        Returns: the restored conversation
+        
+        Raises:
+            SnapshotFormatException: if snapshot isn't something this version of RoboOp can read
+            ValueError: if attachments the snapshot refers to aren't in blobs
+        """
+        state = load_snapshot(snapshot)
+        kwargs = {'async_mode': state.pop('is_async'), 'stream': state.pop('is_streaming')} | kwargs
+        conversation = klass(bot, **kwargs)
+        if blobs is not None:
+            conversation._blobs = blobs
+        conversation._restore_state(state)
+        return conversation
+    
+    def _restore_state(self, state):
+        for field in self._SNAPSHOT_FIELDS:
+            setattr(self, field, state[field])
+        self.message_objects = [self._load_message_object(data) for data in state['message_objects']]
+        self.tool_use_blocks = SimpleNamespace(**{status: [self._load_tool_use_block(data) for data in tubs]
+                    for status, tubs in state['tool_use_blocks'].items()})
+        self._attachments = {}
+        if (missing := [digest for digest in state['_attachments'] if self._blobs is None or digest not in self._blobs]):
+            raise ValueError(f"Attachments missing from the blob store: {', '.join(missing)}")
+    
     def prestart(self, argv:list=[]) -> Self:
         """Initialize the conversation with template arguments.
         
@@ -701,7 +1070,8 @@ class Conversation(object):
             max_tokens=self.max_tokens,
             temperature=self.bot.temperature, 
             system=self.sysprompt,
-            tools=self.bot.get_tools_schema()
+            tools=self.bot.get_tools_schema(),
+            **({'extra_headers': {'anthropic-beta': fileuploads.FILES_API_BETA}} if self.bot.upload_files else {})
         )
     
     def _resume_stream(self, message, is_tool_message=False, set_cache_checkpoint=False, with_files=[]):
@@ -710,7 +1080,8 @@ class Conversation(object):
         if is_tool_message:
             self.messages.append(message)
         else:
-            self.messages.append(self._compile_user_message(message, with_files=with_files))
+            self.messages.append(self._compile_user_message(message, with_files=with_files, attachments=self._attachments,
+                    image_pipeline=self.image_pipeline))
         
         stream = self.bot.client.messages.stream(
             **(self._configure_for_message() | {'messages': self._get_conversation_context()})
@@ -723,7 +1094,8 @@ class Conversation(object):
         if is_tool_message:
             self.messages.append(message)
         else:
-            self.messages.append(self._compile_user_message(message, with_files=with_files))
+            self.messages.append(self._compile_user_message(message, with_files=with_files, attachments=self._attachments,
+                    image_pipeline=self.image_pipeline))
     
         message_out = self.bot.client.messages.create(
             **(self._configure_for_message() | {'messages': self._get_conversation_context()})
@@ -833,6 +1205,8 @@ class Conversation(object):
             is_tool_message = True
         elif canned_response is not None:
             return self._handle_canned_response(message, canned_response)
+        if self.image_pipeline is not None and with_files:
+            with_files = await asyncio.to_thread(self._process_images, with_files)
         
         try:
             if self.is_streaming:
@@ -851,7 +1225,9 @@ class Conversation(object):
         if is_tool_message:
             self.messages.append(message)
         else:
-            self.messages.append(self._compile_user_message(message, with_files=with_files))
+            self.messages.append(self._compile_user_message(message, with_files=with_files, attachments=self._attachments,
+                    image_pipeline=self.image_pipeline))
+        await self._aload_attachments()
         stream = self.bot.client.messages.stream(
             **(self._configure_for_message() | {'messages': self._get_conversation_context()})
         )
@@ -863,7 +1239,9 @@ class Conversation(object):
         if is_tool_message:
             self.messages.append(message)
         else:
-            self.messages.append(self._compile_user_message(message, with_files=with_files))
+            self.messages.append(self._compile_user_message(message, with_files=with_files, attachments=self._attachments,
+                    image_pipeline=self.image_pipeline))
+        await self._aload_attachments()
     
         message_out = await self.bot.client.messages.create(
             **(self._configure_for_message() | {'messages': self._get_conversation_context()})
@@ -926,6 +1304,15 @@ class Conversation(object):
     
     async def _post_stream_hook_async(self):
         pass
+    
+    def close(self) -> None:
+        """Tear down any Tool instances with a 'conversation' lifecycle that were created
+        during this conversation. The conversation may continue to be used afterwards, in
+        which case fresh instances will be created as needed."""
+        self._tool_pool.teardown()
+    
+    async def aclose(self) -> None:
+        await self._tool_pool.ateardown()
 
 
 class LoggedConversation(Conversation):
@@ -933,8 +1320,28 @@ class LoggedConversation(Conversation):
     
     Extends Conversation to provide persistent storage of conversation history
     in JSON format, enabling conversation resumption and analysis.
+    
+    Where the conversation is stored is up to its log_store (see robo.logstore). Passing logs_dir
+    uses a FileLogStore, which gives each conversation a journal in a folder of its own under
+    logs_dir; pass log_store=SQLiteLogStore(path) instead to keep any number of conversations in
+    a single database. Either way, only the messages added (or removed) since the last turn are
+    written, so logging a turn costs the same however long the conversation gets (if a write
+    fails, its messages are sent again, along with everything since, by the next one). Attachments are
+    stored once each, and a revived conversation's messages refer to them by hash; they're only
+    loaded from the log store when a request is sent.
+    
+    Logs are written by a LogWriter (log_writer; by default, one shared by all conversations)
+    on a background thread, which commits writes from many conversations together, so an async
+    conversation's event loop never waits on the disk. log_durability decides how long resume()
+    or aresume() waits: 'turn' (the default) waits until the turn has been written, while
+    'batched' just queues the write; use flush_log() or aflush_log() to wait for queued writes
+    (and find out if any failed).
     """
-    __slots__ = ['conversation_id', 'logs_dir', 'first_saved_at']
+    __slots__ = ['conversation_id', 'logs_dir', 'log_store', 'log_writer', 'first_saved_at', 'log_durability', '_log_state',
+                 'history_offset', '_logged_length', '_log_low_water', '_log_pending', '_log_failures']
+    _SNAPSHOT_FIELDS = Conversation._SNAPSHOT_FIELDS + ['conversation_id', 'first_saved_at', 'history_offset',
+                '_logged_length', '_log_low_water']
+    
     def __init__(self, bot, **kwargs):
         if 'conversation_id' in kwargs:
             self.conversation_id = kwargs.pop('conversation_id')
@@ -942,59 +1349,162 @@ class LoggedConversation(Conversation):
             import uuid
             self.conversation_id = str(uuid.uuid4())
         
-        if 'logs_dir' in kwargs:
-            self.logs_dir = kwargs.pop('logs_dir')
-        else:
-            raise Exception(f"logs_dir required to create a viable LoggedConversation")
+        self.logs_dir = kwargs.pop('logs_dir', None)
+        self.log_store = kwargs.pop('log_store', None)
+        if self.log_store is None:
+            if self.logs_dir is None:
+                raise Exception(f"logs_dir required to create a viable LoggedConversation")
+            self.log_store = FileLogStore(self.logs_dir)
+        self.log_writer = kwargs.pop('log_writer', None) or _shared_writer
+        self.log_durability = kwargs.pop('log_durability', 'turn')
+        if self.log_durability not in ('turn', 'batched'):
+            raise ValueError(f"Unknown log_durability: {self.log_durability}")
         self.first_saved_at = None
+        self._log_state = self.log_store.new_state(self.conversation_id)
+        self._log_pending = []
+        self._log_failures = [] ## Log indexes of the first messages of writes that failed
+        self.history_offset = 0 ## Number of earlier messages in the log that haven't been loaded
+        self._logged_length = 0 ## Number of messages (in self.messages) the log store has
+        self._log_low_water = None
         
         super().__init__(bot, **kwargs)
+        self._blobs = self.log_store.blobs
     
     def __repr__(self):
         return f'<{type(self).__name__} with ID {self.conversation_id}>'
     
-    def _logfolder_path(self):
+    def _truncate_messages(self, length):
+        super()._truncate_messages(length)
+        if self._log_low_water is None or length < self._log_low_water:
+            self._log_low_water = length
+    
+    def _log_header(self):
+        return {
+            'when': str(datetime.datetime.now()),
+            'with': type(self.bot).__name__,
+            'argv': self.argv,
+        }
+    
+    def _take_log_failures(self):
+        """The log index from which messages need writing again because a write failed, or None"""
+        failed_from = None
+        while self._log_failures:
+            index = self._log_failures.pop()
+            failed_from = index if failed_from is None else min(failed_from, index)
+        return failed_from
+    
+    def _prepare_log_write(self):
+        """Work out which messages need to be written and hand them to the log store. Returns a
+        function that does the writing (and touches nothing on self, so it can be run on another
+        thread) and the log index of the first message it writes, or None if there's nothing to
+        write. The messages are counted as logged straight away, so that writes can be queued
+        one after another; if a write fails, _log_failures gets its first index (see
+        _submit_log_write), and the next write sends everything from there on again."""
+        start = self._logged_length
+        truncated = self._log_low_water is not None or len(self.messages) < start
+        if truncated:
+            start = min(start, len(self.messages), start if self._log_low_water is None else self._log_low_water)
+        if (failed_from := self._take_log_failures()) is not None:
+            start, truncated = max(0, min(start, len(self.messages), failed_from - self.history_offset)), True
+            self.log_store.write_failed(self._log_state)
+        elif not truncated and start == len(self.messages):
+            return None
         if self.first_saved_at is None:
-            self.first_saved_at = int(time.time()/10)
-        dirname = f"{self.first_saved_at:x}__{self.conversation_id}"
-        return Path(self.logs_dir) / dirname
+            self.first_saved_at = int(time.time())
+        write = self.log_store.prepare_write(self, start, truncated)
+        write.attachments = [self._attachments[digest] for digest in dict.fromkeys(blob_digests(self.messages[start:]))
+                    if digest in self._attachments]
+        self._logged_length = len(self.messages)
+        self._log_low_water = None
+        return write, self.history_offset + start
+    
+    def _submit_log_write(self):
+        """Queue any changes to be written; returns a future for the write if log_durability
+        says to wait for it, otherwise None"""
+        if (prepared := self._prepare_log_write()) is None:
+            return None
+        write, first_index = prepared
+        future = self.log_writer.submit(write)
+        def note_failure(future):
+            ## Runs on the writer thread; list.append is atomic
+            if future.exception() is not None:
+                self._log_failures.append(first_index)
+        future.add_done_callback(note_failure)
+        if self.log_durability == 'turn':
+            return future
+        self._log_pending = [f for f in self._log_pending if not f.done() or f.exception()]
+        self._log_pending.append(future)
+        return None
     
     def _write_log(self):
-        if self.logs_dir:
-            logdir = self._logfolder_path()
-            logdir.mkdir(parents=True, exist_ok=True)
-            with open(logdir / 'conversation.json', 'w') as logfile:
-                json.dump({
-                    'when': str(datetime.datetime.now()),
-                    'with': type(self.bot).__name__,
-                    'argv': self.argv,
-                    'messages': self.messages
-                }, logfile, indent=4)
-    
-    def resume(self, message:str) -> AnthropicMessageType|CannedResponseType|StreamWrapperType:
-        resp = super().resume(message)
+        if (future := self._submit_log_write()) is not None:
+            future.result()
+    
+    async def _awrite_log(self):
+        if (future := self._submit_log_write()) is not None:
+            await asyncio.wrap_future(future)
+    
+    def flush_log(self):
+        """Wait for any queued log writes to finish, raising the first error if any of them failed"""
+        pending, self._log_pending = self._log_pending, []
+        for future in pending:
+            future.result()
+    
+    async def aflush_log(self):
+        """Wait for any queued log writes to finish, raising the first error if any of them failed"""
+        pending, self._log_pending = self._log_pending, []
+        for future in pending:
+            await asyncio.wrap_future(future)
+    
+    def _snapshot_state(self, blobs):
+        return super()._snapshot_state(blobs) | {'_log_state': self.log_store.dump_state(self._log_state)}
+    
+    def _restore_state(self, state):
+        super()._restore_state(state)
+        self._log_state = self.log_store.load_state(state['_log_state'])
+    
+    def snapshot(self, blobs:BlobStore|None=None) -> bytes:
+        """As Conversation.snapshot(), having first made sure that the log is up to date. The
+        snapshot includes where the log store is up to, so restore() (which, like revive(), needs
+        logs_dir or log_store) carries on logging where this left off; keep using the snapshot
+        rather than this conversation from then on. Attachments are already in the log store's
+        blob store, so blobs isn't needed."""
         self._write_log()
-        return resp
+        self.flush_log()
+        return super().snapshot(blobs)
+    
+    async def asnapshot(self, blobs:BlobStore|None=None) -> bytes:
+        await self._awrite_log()
+        await self.aflush_log()
+        return super().snapshot(blobs)
     
-    async def aresume(self, message:str) -> AnthropicMessageType|CannedResponseType|StreamWrapperAsyncType:
-        resp = await super().aresume(message)
+    def resume(self, message:str, set_cache_checkpoint:bool=False, with_files:list=[]) -> AnthropicMessageType|CannedResponseType|StreamWrapperType:
+        resp = super().resume(message, set_cache_checkpoint=set_cache_checkpoint, with_files=with_files)
         self._write_log()
         return resp
     
+    async def aresume(self, message:str, set_cache_checkpoint=False, with_files:list=[]) -> AnthropicMessageType|CannedResponseType|StreamWrapperAsyncType:
+        resp = await super().aresume(message, set_cache_checkpoint=set_cache_checkpoint, with_files=with_files)
+        await self._awrite_log()
+        return resp
+    
     def _post_stream_hook(self):
         self._write_log()
     
     async def _post_stream_hook_async(self):
-        self._write_log()
+        await self._awrite_log()
     
     @classmethod
-    def revive(klass, bot:BotType, conversation_id:str, logs_dir:str|Path, **kwargs) -> Self:
-        """Restore a previously logged conversation from disk.
+    def revive(klass, bot:BotType, conversation_id:str, logs_dir:str|Path|None=None, tail:int|None=None,
+                **kwargs) -> Self:
+        """Restore a previously logged conversation.
         
         Args:
             bot: The bot instance or class to use for the conversation
             conversation_id (str): The unique identifier of the conversation to restore
-            logs_dir (str): Directory containing the conversation logs
+            logs_dir (str): Directory containing the conversation logs (or pass log_store)
+            tail (int): Only load the last this many turns (a turn being a user message and
+                everything after it up to the next); see load_earlier_history()
             argv (list): Template arguments for system prompt
             **kwargs: Additional arguments to be passed to the superclass constructor
             
@@ -1005,21 +1515,73 @@ class LoggedConversation(Conversation):
             UnknownConversationException: If the conversation ID is not found
         """
         revenant = klass(bot, conversation_id=conversation_id, logs_dir=logs_dir, **kwargs)
-        ## Find the chatlog to continue the conversation
-        try:
-            logdir_candidate = list(filter(lambda f: f.endswith(conversation_id), os.listdir(logs_dir)))[0]
-        except IndexError as exc:
-            excmsg = f"Conversation with ID {conversation_id} could not be found"
-            raise UnknownConversationException(excmsg) from exc
-        revenant.first_saved_at = int(logdir_candidate.split('__')[0], 16)
-        with (Path(logs_dir) / logdir_candidate / 'conversation.json').open('r') as reader:
-            logdata = json.load(reader)
-        revenant.messages = logdata['messages']
-        revenant.prestart(logdata['argv'])
-        return revenant
+        return revenant._load_log(revenant.log_store.load(conversation_id, tail=tail))
+    
+    @classmethod
+    async def arevive(klass, bot:BotType, conversation_id:str, logs_dir:str|Path|None=None, tail:int|None=None,
+                **kwargs) -> Self:
+        """Async version of revive(); the log is read on a worker thread."""
+        revenant = klass(bot, conversation_id=conversation_id, logs_dir=logs_dir, **kwargs)
+        return revenant._load_log(await asyncio.to_thread(revenant.log_store.load, conversation_id, tail))
+    
+    def load_earlier_history(self, turns:int=1) -> int:
+        """For a conversation revived with tail, load up to turns more of the turns before those
+        already loaded, adding them to the start of messages (so they're sent to the model from
+        then on). Returns the number of messages loaded; 0 once the whole history is loaded.
+        Don't call this while a response is streaming."""
+        if self.history_offset == 0:
+            return 0
+        self.flush_log()
+        return self._prepend_history(*self.log_store.load_history(self.conversation_id, self.history_offset, turns))
+    
+    async def aload_earlier_history(self, turns:int=1) -> int:
+        """Async version of load_earlier_history(); the log is read on a worker thread."""
+        if self.history_offset == 0:
+            return 0
+        await self.aflush_log()
+        return self._prepend_history(*await asyncio.to_thread(self.log_store.load_history, self.conversation_id,
+                    self.history_offset, turns))
+    
+    def _prepend_history(self, offset, messages):
+        count = len(messages)
+        self.messages[:0] = messages
+        self._message_cache_checkpoints[:] = [cp + count for cp in self._message_cache_checkpoints]
+        self._logged_length += count
+        if self._log_low_water is not None:
+            self._log_low_water += count
+        self.history_offset = offset
+        return count
+    
+    @staticmethod
+    def list_conversations(logs_dir:str|Path|None=None, bot:BotType|str|None=None, since:float|None=None,
+                until:float|None=None, log_store:LogStore|None=None) -> list[SimpleNamespace]:
+        """List the logged conversations, most recently updated first, from the log store's index
+        (without reading any of the logs). Each is a SimpleNamespace with conversation_id,
+        created, updated, bot and message_count (plus path, for logs_dir); created and updated
+        are Unix timestamps.
+        
+        Args:
+            logs_dir (str): Directory containing the conversation logs (or pass log_store)
+            bot: Only list conversations with this bot (a Bot class or instance, or a class name)
+            since (float): Only list conversations updated at or after this time
+            until (float): Only list conversations updated before this time
+        """
+        if bot is not None and not isinstance(bot, str):
+            bot = (bot if isinstance(bot, type) else type(bot)).__name__
+        log_store = log_store or FileLogStore(logs_dir)
+        return log_store.list_conversations(bot=bot, since=since, until=until)
+    
+    def _load_log(self, logdata):
+        self.first_saved_at = logdata.created
+        self.messages = logdata.messages
+        self.history_offset = logdata.offset
+        self._log_state = logdata.state
+        self._logged_length = len(logdata.messages)
+        self.prestart(logdata.argv)
+        return self
 
 
-def streamer(bot_or_conversation, args=[], cc=None):
+def streamer(bot_or_conversation, args=[], cc=None, coalesce=False):
     """Create a streaming conversation function for real-time output.
     
     Args:
@@ -1027,6 +1589,10 @@ def streamer(bot_or_conversation, args=[], cc=None):
         args (list): Template arguments for system prompt
         cc (file-like object): If provided, write the response text to the object (using obj.write())
             as well as printing it.
+        coalesce (bool or ChunkCoalescer): Write the response in phrases rather than token by token
+            (see robo.streamutils.ChunkCoalescer). Pass True for the default settings or a
+            ChunkCoalescer to configure them. Buffered text is written out before any tools are
+            run and at the end of each response.
         
     Returns:
         function: A function that takes a message and streams the response to stdout
@@ -1036,23 +1602,40 @@ def streamer(bot_or_conversation, args=[], cc=None):
         convo = bot_or_conversation
     else: ## in which case it should be either a bot instance or Bot class
         convo = Conversation(bot_or_conversation, stream=True)
+    coalescer = _get_coalescer(coalesce)
+    def write(chunk):
+        print(chunk, end="", flush=True)
+        if cc:
+            cc.write(chunk)
+    def flush_coalescer(conv, data):
+        ## Tools run once a turn is complete, so don't hold text back while they do
+        if (text := coalescer.flush()):
+            write(text)
     def streamit(message, with_files=[]):
         if not convo.started:
             convo.prestart(args)
-        with convo.resume(message, with_files=with_files) as stream:
-            for chunk in stream.text_stream:
-                print(chunk, end="", flush=True)
-                if cc:
-                    cc.write(chunk)
+        if coalescer:
+            convo.register_callback('turn_complete', flush_coalescer)
+        try:
+            with convo.resume(message, with_files=with_files) as stream:
+                chunks = coalescer.coalesce(stream.text_stream) if coalescer else stream.text_stream
+                for chunk in chunks:
+                    write(chunk)
+        finally:
+            if coalescer:
+                convo.unregister_callback('turn_complete', flush_coalescer)
+                flush_coalescer(convo, None)
         print()
     return streamit
 
-def streamer_async(bot_or_conversation, args=[], cc=None):
+def streamer_async(bot_or_conversation, args=[], cc=None, coalesce=False):
     """Create an async streaming conversation function for real-time output.
     
     Args:
         bot_or_conversation: Either a Bot instance/class or a Conversation with stream=True
         args (list): Template arguments for system prompt
+        cc (file-like object): As for streamer()
+        coalesce (bool or ChunkCoalescer): As for streamer()
         
     Returns:
         coroutine function: An async function that takes a message and streams the response to stdout
@@ -1061,14 +1644,28 @@ def streamer_async(bot_or_conversation, args=[], cc=None):
         convo = bot_or_conversation
     else:
         convo = Conversation(bot_or_conversation, stream=True, async_mode=True)
+    coalescer = _get_coalescer(coalesce)
+    def write(chunk):
+        print(chunk, end="", flush=True)
+        if cc:
+            cc.write(chunk)
+    async def flush_coalescer(conv, data):
+        if (text := coalescer.flush()):
+            write(text)
     async def streamit(message, with_files=[]):
         if not convo.started:
             convo.prestart(args)
-        async with await convo.aresume(message, with_files=with_files) as stream:
-            async for chunk in stream.text_stream:
-                print(chunk, end="", flush=True)
-                if cc:
-                    cc.write(chunk)
+        if coalescer:
+            convo.register_callback('turn_complete', flush_coalescer)
+        try:
+            async with await convo.aresume(message, with_files=with_files) as stream:
+                chunks = coalescer.acoalesce(stream.text_stream) if coalescer else stream.text_stream
+                async for chunk in chunks:
+                    write(chunk)
+        finally:
+            if coalescer:
+                convo.unregister_callback('turn_complete', flush_coalescer)
+                await flush_coalescer(convo, None)
     return streamit
 
 def gettext(message):
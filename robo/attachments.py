@@ -0,0 +1,294 @@
+"""Content-addressed storage for file attachments.
+
+Files sent with with_files go into the message history as references - file blocks whose source
+gives the SHA-256 hash of the file rather than its contents - with the conversation holding on
+to an Attachment that says where the contents can be found (a path, or the bytes themselves).
+When a conversation is logged, each file is stored once - compressed, and keyed by its hash - in
+the log store's blob store, so that a file attached to many turns (or many conversations) is only
+stored once. References are turned into base64 file blocks only when a request is sent to the
+API; the base64 is kept in a bounded cache shared by every conversation in the process, so a file
+that many conversations attach is only encoded once.
+"""
+
+import binascii
+import contextlib
+import hashlib
+import mmap
+import os
+import threading
+import zlib
+from collections import OrderedDict
+from pathlib import Path
+
+BLOB_SOURCE_TYPE = 'robo_blob'
+ENCODE_CHUNK_SIZE = 3 * 256 * 1024 ## A multiple of 3, so that chunks encode without padding
+
+
+def b64encode(data, hasher=None) -> str:
+    """Base64-encode a bytes-like object (bytes, bytearray, memoryview, mmap...) a chunk at a time
+    into a buffer allocated up front, without copying the input, so that the memory needed is
+    about twice the size of the output (the buffer, and the string made from it) rather than
+    several times the size of the input. If hasher is given, it's updated with the data too."""
+    with memoryview(data) as raw, raw.cast('B') as view:
+        out = bytearray(4 * ((view.nbytes + 2) // 3))
+        position = 0
+        for start in range(0, view.nbytes, ENCODE_CHUNK_SIZE):
+            with view[start:start + ENCODE_CHUNK_SIZE] as chunk:
+                if hasher is not None:
+                    hasher.update(chunk)
+                encoded = binascii.b2a_base64(chunk, newline=False)
+            out[position:position + len(encoded)] = encoded
+            position += len(encoded)
+    return out.decode('ascii')
+
+
+@contextlib.contextmanager
+def _mapped(path):
+    """The contents of the file at path, memory-mapped (so it's paged in as it's read)"""
+    with open(path, 'rb') as reader:
+        if os.fstat(reader.fileno()).st_size == 0:
+            yield b'' ## Empty files can't be mapped
+            return
+        with mmap.mmap(reader.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            yield mapped
+
+
+class BlobStore(object):
+    """Base class for blob stores: put() stores some bytes and returns their digest, get() returns
+    the bytes for a digest (or raises KeyError)"""
+    __slots__ = []
+    
+    @staticmethod
+    def digest(data:bytes) -> str:
+        return 'sha256:' + hashlib.sha256(data).hexdigest()
+    
+    def put(self, data:bytes, sync:bool=False) -> str:
+        """If sync is True, the blob must be on disk (not just handed to the OS) before returning"""
+        raise NotImplementedError
+    
+    def get(self, digest:str) -> bytes:
+        raise NotImplementedError
+    
+    def __contains__(self, digest:str) -> bool:
+        raise NotImplementedError
+
+
+class FileBlobStore(BlobStore):
+    """Stores each blob as a zlib-compressed file under directory, sharded by its digest"""
+    __slots__ = ['directory', 'level']
+    
+    def __init__(self, directory:str|Path, level:int=6):
+        self.directory = Path(directory)
+        self.level = level
+    
+    def _path(self, digest):
+        hexdigest = digest.split(':', 1)[1]
+        return self.directory / hexdigest[:2] / hexdigest
+    
+    def put(self, data, sync=False):
+        digest = self.digest(data)
+        if not (path := self._path(digest)).exists():
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+            with open(tmp, 'wb') as blobfile:
+                blobfile.write(zlib.compress(data, self.level))
+                if sync:
+                    blobfile.flush()
+                    os.fsync(blobfile.fileno())
+            os.replace(tmp, path)
+        return digest
+    
+    def get(self, digest):
+        try:
+            return zlib.decompress(self._path(digest).read_bytes())
+        except FileNotFoundError as exc:
+            raise KeyError(digest) from exc
+    
+    def __contains__(self, digest):
+        return self._path(digest).exists()
+
+
+class SQLiteBlobStore(BlobStore):
+    """Stores zlib-compressed blobs in a table of an SQLite database, sharing a connection (and
+    the lock guarding it, which must be reentrant) with whatever else uses the database"""
+    __slots__ = ['connection', 'lock', 'level']
+    
+    def __init__(self, connection, lock, level:int=6):
+        self.connection = connection
+        self.lock = lock
+        self.level = level
+        with self.lock:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS blobs (digest TEXT PRIMARY KEY, data BLOB NOT NULL)')
+    
+    def put(self, data, sync=False):
+        ## Durability is down to the database's own synchronous setting
+        digest = self.digest(data)
+        with self.lock:
+            if self.connection.execute('SELECT 1 FROM blobs WHERE digest = ?', (digest,)).fetchone() is None:
+                self.connection.execute('INSERT INTO blobs (digest, data) VALUES (?, ?)',
+                            (digest, zlib.compress(data, self.level)))
+        return digest
+    
+    def get(self, digest):
+        with self.lock:
+            row = self.connection.execute('SELECT data FROM blobs WHERE digest = ?', (digest,)).fetchone()
+        if row is None:
+            raise KeyError(digest)
+        return zlib.decompress(row[0])
+    
+    def __contains__(self, digest):
+        with self.lock:
+            return self.connection.execute('SELECT 1 FROM blobs WHERE digest = ?', (digest,)).fetchone() is not None
+
+
+class Attachment(object):
+    """Where to find the contents of an attached file: source is a path, or a bytes-like object
+    (bytes, bytearray, memoryview...) which is used as it is rather than copied, so mustn't be
+    changed afterwards. A file-like object is read straight away. Files are hashed when attached,
+    and read again whenever they need encoding; a file that has changed in the meantime raises
+    ValueError rather than sending different contents under the same hash."""
+    __slots__ = ['source', 'digest', 'size']
+    
+    def __init__(self, source):
+        if hasattr(source, 'read') and callable(source.read):
+            source = source.read()
+        if isinstance(source, (str, Path)):
+            self.source = Path(source)
+            hasher, self.size = hashlib.sha256(), 0
+            with open(self.source, 'rb') as reader:
+                while (chunk := reader.read(1 << 20)):
+                    hasher.update(chunk)
+                    self.size += len(chunk)
+            self.digest = 'sha256:' + hasher.hexdigest()
+        else:
+            self.source = source
+            self.size = memoryview(source).nbytes
+            self.digest = BlobStore.digest(source)
+    
+    def _check(self, digest):
+        if digest != self.digest:
+            raise ValueError(f"Attached file has changed since it was attached: {self.source}")
+    
+    def read(self):
+        """The file's contents (as bytes, or the bytes-like object it was attached as)"""
+        if not isinstance(self.source, Path):
+            return self.source
+        with open(self.source, 'rb') as reader:
+            data = reader.read()
+        self._check(BlobStore.digest(data))
+        return data
+    
+    def encode(self) -> str:
+        """The file's contents, base64-encoded (see b64encode); files are memory-mapped rather
+        than read in, and checked against the digest as they're encoded"""
+        if not isinstance(self.source, Path):
+            return b64encode(self.source)
+        hasher = hashlib.sha256()
+        with _mapped(self.source) as data:
+            encoded = b64encode(data, hasher)
+        self._check('sha256:' + hasher.hexdigest())
+        return encoded
+
+
+class EncodedAttachmentCache(object):
+    """Least-recently-used cache of base64-encoded attachments, by digest, holding at most
+    max_bytes of encoded data. Thread-safe; get() encodes whatever isn't cached."""
+    __slots__ = ['max_bytes', 'hits', 'misses', '_entries', '_size', '_lock']
+    
+    def __init__(self, max_bytes:int=128 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+    
+    def get(self, digest:str, encode) -> str:
+        """The base64 for digest, calling encode() for it if it isn't cached"""
+        with self._lock:
+            if (encoded := self._entries.get(digest)) is not None:
+                self._entries.move_to_end(digest)
+                self.hits += 1
+                return encoded
+            self.misses += 1
+        encoded = encode()
+        self.put(digest, encoded)
+        return encoded
+    
+    def put(self, digest:str, encoded:str):
+        if len(encoded) > self.max_bytes:
+            return
+        with self._lock:
+            if digest not in self._entries:
+                self._entries[digest] = encoded
+                self._size += len(encoded)
+            while self._size > self.max_bytes:
+                self._size -= len(self._entries.popitem(last=False)[1])
+    
+    def __contains__(self, digest):
+        return digest in self._entries
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+
+encoded_attachments = EncodedAttachmentCache()
+
+
+def _has_source(block, source_type):
+    return isinstance(block, dict) and isinstance(source := block.get('source'), dict) and source.get('type') == source_type
+
+
+def dehydrate_message(message:dict, blobs:BlobStore, sync:bool=False) -> dict:
+    """Return message with the contents of any base64 file blocks put in blobs and replaced by
+    references. message itself is left as it is."""
+    content = message.get('content')
+    if not isinstance(content, list) or not any(_has_source(block, 'base64') for block in content):
+        return message
+    blocks = []
+    for block in content:
+        if _has_source(block, 'base64'):
+            source = block['source']
+            digest = blobs.put(binascii.a2b_base64(source['data']), sync=sync)
+            block = block | {'source': {'type': BLOB_SOURCE_TYPE, 'media_type': source['media_type'], 'digest': digest}}
+        blocks.append(block)
+    return message | {'content': blocks}
+
+
+def blob_sources(messages:list):
+    """Yield the sources (with digest and media_type) of the blob references in messages"""
+    for message in messages:
+        if isinstance(content := message.get('content'), list):
+            for block in content:
+                if _has_source(block, BLOB_SOURCE_TYPE):
+                    yield block['source']
+
+
+def blob_digests(messages:list):
+    """Yield the digests of the blobs referred to by messages"""
+    for source in blob_sources(messages):
+        yield source['digest']
+
+
+def rehydrate_messages(messages:list, resolve) -> list:
+    """Return messages with the sources of blob references replaced by resolve(source), which
+    returns a source the API understands (base64 or file). Messages without references are
+    passed through as they are."""
+    rehydrated = []
+    for message in messages:
+        content = message.get('content')
+        if isinstance(content, list) and any(_has_source(block, BLOB_SOURCE_TYPE) for block in content):
+            blocks = []
+            for block in content:
+                if _has_source(block, BLOB_SOURCE_TYPE):
+                    block = block | {'source': resolve(block['source'])}
+                blocks.append(block)
+            message = message | {'content': blocks}
+        rehydrated.append(message)
+    return rehydrated
+
+
+__all__ = ['b64encode', 'BlobStore', 'FileBlobStore', 'SQLiteBlobStore', 'Attachment', 'EncodedAttachmentCache',
+           'encoded_attachments', 'dehydrate_message', 'rehydrate_messages', 'blob_sources', 'blob_digests']
@@ -8,4 +8,18 @@ class FieldValuesMissingException(BaseException):
 class SyncAsyncMismatchError(BaseException):
     """Raised when async operations are attempted in a sync-mode context, and vice versa"""
 
-__all__ = ['UnknownConversationException', 'FieldValuesMissingException', 'SyncAsyncMismatchError']
\ No newline at end of file
+class SubscriberDroppedException(BaseException):
+    """Raised to a StreamBroadcaster subscriber that fell too far behind and was dropped"""
+
+class StreamCancelledException(BaseException):
+    """Raised to a StreamBroadcaster subscriber when the stream it was following was cancelled"""
+
+class CorruptLogException(BaseException):
+    """Raised when a conversation log can't be read because messages are missing from it"""
+
+class SnapshotFormatException(BaseException):
+    """Raised when restoring from data that isn't a conversation snapshot this version can read"""
+
+__all__ = ['UnknownConversationException', 'FieldValuesMissingException', 'SyncAsyncMismatchError',
+           'SubscriberDroppedException', 'StreamCancelledException', 'SnapshotFormatException',
+           'CorruptLogException']
\ No newline at end of file
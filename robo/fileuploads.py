@@ -0,0 +1,153 @@
+"""Sending attachments through the Files API, so that each file is uploaded once and requests
+refer to it by ID rather than carrying it as base64 every turn.
+
+Bots with upload_files set upload attachments the first time a request that includes them is
+sent. A FileUploadCache remembers which file_id each attachment (by digest) was uploaded as, for
+each API key, until the upload expires; by default that's uploaded_files, shared by every
+conversation in the process, but it can be given a path to keep the mapping in a JSON file so
+that it survives restarts and can be shared between processes on the same machine.
+"""
+
+import asyncio
+import contextlib
+import hashlib
+import json
+import os
+import threading
+import time
+from pathlib import Path
+try:
+    import fcntl
+except ImportError: # pragma: no cover
+    fcntl = None
+
+FILES_API_BETA = 'files-api-2025-04-14'
+
+
+class FileUploadCache(object):
+    """Maps (API key, attachment digest) to the file_id the attachment was uploaded as, and when
+    that upload expires (if it does). Uploads due to expire within expiry_margin seconds are
+    treated as already expired, so that a file can't expire between being looked up and the
+    request that uses it arriving. Thread-safe.
+    
+    With a path, the mapping is kept in a JSON file that several processes can share: it's read
+    again whenever another process has changed it, and each change is made to the latest version
+    of the file while holding a lock on it (an flock on path + '.lock', where the platform has
+    fcntl), so that processes don't overwrite each other's entries."""
+    __slots__ = ['path', 'expiry_margin', 'uploads', '_entries', '_loaded', '_lock']
+    
+    def __init__(self, path:str|Path|None=None, expiry_margin:float=300.0):
+        self.path = None if path is None else Path(path)
+        self.expiry_margin = expiry_margin
+        self.uploads = 0
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._loaded = None ## Identifies the version of the file _entries was read from
+        if self.path is not None:
+            self._load()
+    
+    @staticmethod
+    def _key(client, digest):
+        ## File IDs belong to the workspace of the API key that uploaded them
+        api_key = getattr(client, 'api_key', None) or ''
+        return hashlib.sha256(api_key.encode('utf-8')).hexdigest()[:16] + ':' + digest
+    
+    @staticmethod
+    def _version(stat):
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+    
+    def _load(self):
+        """Read the file again if it has changed since it was last read"""
+        try:
+            if self._version(self.path.stat()) == self._loaded:
+                return
+            with open(self.path) as cachefile:
+                version, entries = self._version(os.fstat(cachefile.fileno())), json.load(cachefile)
+        except FileNotFoundError:
+            version, entries = None, {}
+        self._entries, self._loaded = entries, version
+    
+    @contextlib.contextmanager
+    def _file_lock(self):
+        with open(self.path.with_name(self.path.name + '.lock'), 'a') as lockfile:
+            if fcntl is not None:
+                fcntl.flock(lockfile.fileno(), fcntl.LOCK_EX)
+            yield ## The lock is released when the file is closed
+    
+    def _update(self, change):
+        """Call change(entries) to modify the entries; with a path, it's applied to the latest
+        version of the file, which is then saved, all under the file lock"""
+        if self.path is None:
+            change(self._entries)
+            return
+        with self._file_lock():
+            self._load()
+            change(self._entries)
+            tmp = self.path.with_name(f"{self.path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+            tmp.write_text(json.dumps(self._entries))
+            os.replace(tmp, self.path)
+            self._loaded = self._version(self.path.stat())
+    
+    def lookup(self, client, digest:str) -> str|None:
+        """The file_id that digest was uploaded as with client's API key, or None if it hasn't
+        been (or the upload has expired)"""
+        key = self._key(client, digest)
+        with self._lock:
+            if self.path is not None:
+                self._load()
+            if (entry := self._entries.get(key)) is None:
+                return None
+            if entry['expires_at'] is not None and entry['expires_at'] - self.expiry_margin <= time.time():
+                def forget(entries):
+                    ## Unless another process has uploaded it again in the meantime
+                    if entries.get(key) == entry:
+                        del entries[key]
+                self._update(forget)
+                return None
+            return entry['file_id']
+    
+    def store(self, client, digest:str, metadata):
+        """Record an upload; metadata is what the Files API returned"""
+        expires_at = getattr(metadata, 'expires_at', None)
+        if expires_at is not None and not isinstance(expires_at, (int, float)):
+            expires_at = expires_at.timestamp()
+        key = self._key(client, digest)
+        with self._lock:
+            self.uploads += 1
+            self._update(lambda entries: entries.update({key: {'file_id': metadata.id, 'expires_at': expires_at}}))
+    
+    def invalidate(self, file_id:str|None=None):
+        """Forget the upload with file_id (for instance after deleting it), or every upload"""
+        def forget(entries):
+            for key in [key for key, entry in entries.items() if file_id is None or entry['file_id'] == file_id]:
+                del entries[key]
+        with self._lock:
+            self._update(forget)
+    
+    @staticmethod
+    def _upload_args(digest, media_type, data, filename):
+        return {'file': (filename or 'attachment-' + digest.split(':', 1)[1][:16], data, media_type),
+                'betas': [FILES_API_BETA]}
+    
+    def upload(self, client, digest:str, media_type:str, load, filename:str|None=None) -> str:
+        """The file_id for digest, uploading load() with client if it hasn't been uploaded yet"""
+        if (file_id := self.lookup(client, digest)) is None:
+            metadata = client.beta.files.upload(**self._upload_args(digest, media_type, bytes(load()), filename))
+            self.store(client, digest, metadata)
+            file_id = metadata.id
+        return file_id
+    
+    async def aupload(self, client, digest:str, media_type:str, load, filename:str|None=None) -> str:
+        """upload() for async clients; load is called on a worker thread"""
+        if (file_id := self.lookup(client, digest)) is None:
+            data = await asyncio.to_thread(lambda: bytes(load()))
+            metadata = await client.beta.files.upload(**self._upload_args(digest, media_type, data, filename))
+            self.store(client, digest, metadata)
+            file_id = metadata.id
+        return file_id
+
+
+uploaded_files = FileUploadCache()
+
+
+__all__ = ['FileUploadCache', 'uploaded_files', 'FILES_API_BETA']
@@ -0,0 +1,145 @@
+"""Shrinking images before they're attached, so that requests (and uploads) aren't inflated by
+photos at resolutions the model never sees.
+
+The API scales down images that are more than 1568 pixels on their long edge, or more than about
+1.15 megapixels, before the model looks at them, so sending anything bigger only costs bytes and
+time. An ImagePipeline (set as image_pipeline on a Bot, or on a Conversation) scales images down
+to those limits, re-encodes them at a given quality, and drops their metadata (EXIF, including
+location, and so on) along the way. Images that are already small enough, in the right format
+and without metadata are only replaced if re-encoding makes them smaller. Results are cached by a
+hash of the original image.
+
+Needs Pillow (pip install RoboOp[images], or pip install Pillow).
+"""
+
+import hashlib
+import io
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+try:
+    from PIL import Image, ImageOps
+except ImportError: # pragma: no cover
+    Image = ImageOps = None
+
+FORMATS = {'image/jpeg': 'JPEG', 'image/png': 'PNG', 'image/webp': 'WEBP'}
+MEDIA_TYPES = {fmt: media_type for media_type, fmt in FORMATS.items()}
+METADATA_KEYS = ('exif', 'icc_profile', 'xmp', 'XML:com.adobe.xmp', 'comment', 'photoshop')
+
+
+class ImagePipeline(object):
+    """Scales images down so that they're no more than max_dimension pixels on their long edge
+    and max_pixels in all, and re-encodes them - as format ('JPEG', 'PNG' or 'WEBP'; by default
+    whatever they already were) at quality (for JPEG and WEBP) - without their metadata. Animated
+    images are left as they are, as are images that don't need scaling down or converting and
+    have no metadata, unless re-encoding them saves bytes. Results for up to max_cache_bytes of
+    processed images are kept, by a hash of the original."""
+    __slots__ = ['max_dimension', 'max_pixels', 'quality', 'format', 'max_cache_bytes', '_cache', '_cache_size',
+                 '_lock']
+    
+    def __init__(self, max_dimension:int=1568, max_pixels:int=1_150_000, quality:int=85, format:str|None=None,
+                max_cache_bytes:int=64 * 1024 * 1024):
+        if Image is None:
+            raise ImportError("ImagePipeline needs Pillow: pip install Pillow")
+        if format is not None and format not in MEDIA_TYPES:
+            raise ValueError(f"Unsupported image format: {format}")
+        self.max_dimension = max_dimension
+        self.max_pixels = max_pixels
+        self.quality = quality
+        self.format = format
+        self.max_cache_bytes = max_cache_bytes
+        self._cache = OrderedDict()
+        self._cache_size = 0
+        self._lock = threading.Lock()
+    
+    def _target_size(self, width, height):
+        scale = min(1.0, self.max_dimension / max(width, height), (self.max_pixels / (width * height)) ** 0.5)
+        return max(1, int(width * scale)), max(1, int(height * scale))
+    
+    def _convert(self, source, media_type, nbytes):
+        """source is the image's path or bytes, nbytes its length. Returns (data, media_type)
+        for the processed image, or (None, media_type) if the original is to be sent as it is."""
+        with Image.open(source if isinstance(source, Path) else io.BytesIO(source)) as original:
+            if getattr(original, 'is_animated', False):
+                return None, media_type ## Leave animations alone
+            keepable = original.format == FORMATS[media_type] and not original.getexif() and \
+                        not any(key in original.info for key in METADATA_KEYS) and not getattr(original, 'text', None)
+            image = ImageOps.exif_transpose(original) ## Keep photos the right way up without their EXIF
+            image.load()
+        if (size := self._target_size(*image.size)) != image.size:
+            image = image.resize(size, Image.LANCZOS)
+            keepable = False
+        fmt = self.format or FORMATS[media_type]
+        keepable = keepable and fmt == FORMATS[media_type]
+        if fmt == 'JPEG' and image.mode not in ('RGB', 'L'):
+            if image.mode in ('RGBA', 'LA', 'P'):
+                ## JPEG has no transparency, so put transparent images on white
+                image = image.convert('RGBA')
+                background = Image.new('RGB', image.size, (255, 255, 255))
+                background.paste(image, mask=image.getchannel('A'))
+                image = background
+            else:
+                image = image.convert('RGB')
+        ## Pillow only writes EXIF if asked to, but PNGs pick up other metadata (ICC profiles, text
+        ## chunks...) from info
+        image.info = {key: value for key, value in image.info.items() if key == 'transparency'}
+        out = io.BytesIO()
+        options = {'optimize': True} if fmt == 'PNG' else {'quality': self.quality}
+        image.save(out, format=fmt, **options)
+        if keepable and out.tell() >= nbytes:
+            ## Re-encoding an image that's already been optimised would only lose quality
+            return None, media_type
+        return out.getvalue(), MEDIA_TYPES[fmt]
+    
+    def _process(self, key, source, media_type, nbytes):
+        """Cached _convert(); key is a hash of the image"""
+        with self._lock:
+            if (cached := self._cache.get(key)) is not None:
+                self._cache.move_to_end(key)
+                return cached
+        result = self._convert(source, media_type, nbytes)
+        self._remember(key, result)
+        if result[0] is not None:
+            ## Processed images are left as they are, so that processing one again changes nothing
+            self._remember(hashlib.sha256(result[0]).hexdigest(), (None, result[1]))
+        return result
+    
+    def process(self, data, media_type:str) -> tuple:
+        """Returns (data, media_type) for the processed image. Anything that isn't a JPEG, PNG or
+        WEBP image is returned as it is."""
+        if media_type not in FORMATS:
+            return data, media_type
+        result = self._process(hashlib.sha256(data).hexdigest(), data, media_type, memoryview(data).nbytes)
+        return (data, media_type) if result[0] is None else result
+    
+    def _remember(self, key, result):
+        size = 0 if result[0] is None else len(result[0])
+        with self._lock:
+            if key not in self._cache and size <= self.max_cache_bytes:
+                self._cache[key] = result
+                self._cache_size += size
+                while self._cache_size > self.max_cache_bytes:
+                    evicted = self._cache.popitem(last=False)[1][0]
+                    self._cache_size -= 0 if evicted is None else len(evicted)
+    
+    def process_file(self, filething, media_type:str) -> tuple:
+        """process() for anything that can be attached: a path, bytes-like object or file-like
+        object. Returns (filething, media_type), with filething as it was if there's nothing to do.
+        A path is hashed a chunk at a time and decoded from the file, so it's only read into memory
+        if the image has to be re-encoded."""
+        if media_type not in FORMATS:
+            return filething, media_type
+        if hasattr(filething, 'read') and callable(filething.read):
+            return self.process(filething.read(), media_type)
+        if not isinstance(filething, (str, Path)):
+            return self.process(filething, media_type)
+        path = Path(filething)
+        with open(path, 'rb') as imagefile:
+            key = hashlib.file_digest(imagefile, 'sha256').hexdigest()
+            size = imagefile.tell()
+        result = self._process(key, path, media_type, size)
+        return (filething, media_type) if result[0] is None else result
+
+
+__all__ = ['ImagePipeline']
@@ -0,0 +1,92 @@
+"""An on-disk index of the conversations in a LoggedConversation logs_dir, so that they can be
+found and listed without scanning the directory or reading the logs themselves."""
+
+import contextlib
+import hashlib
+import sqlite3
+from pathlib import Path
+from types import SimpleNamespace
+
+
+class LogIndex(object):
+    """Index of the conversations logged in logs_dir, kept in an SQLite database (index.sqlite)
+    alongside the logs. Each conversation_id maps to the folder its log is in (relative to
+    logs_dir), when it was created and last updated, the name of the bot class it's with, and how
+    many messages it has."""
+    __slots__ = ['logs_dir', 'path', '_schema_created']
+    
+    FILENAME = 'index.sqlite'
+    FIELDS = ['conversation_id', 'path', 'created', 'updated', 'bot', 'message_count']
+    _SCHEMA = """
+        CREATE TABLE IF NOT EXISTS conversations (
+            conversation_id TEXT PRIMARY KEY,
+            path TEXT NOT NULL,
+            created REAL,
+            updated REAL,
+            bot TEXT,
+            message_count INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS conversations_by_updated ON conversations (updated);
+        CREATE INDEX IF NOT EXISTS conversations_by_bot ON conversations (bot, updated);
+    """
+    
+    def __init__(self, logs_dir):
+        self.logs_dir = Path(logs_dir)
+        self.path = self.logs_dir / self.FILENAME
+        self._schema_created = False
+    
+    @staticmethod
+    def shard_path(conversation_id:str) -> Path:
+        """Where a conversation's log folder goes, relative to logs_dir: two levels of 256 shards
+        chosen by a hash of the ID, so that no directory ends up with more than a few entries."""
+        digest = hashlib.sha1(conversation_id.encode('utf-8')).hexdigest()
+        return Path(digest[:2]) / digest[2:4] / conversation_id
+    
+    @contextlib.contextmanager
+    def _connect(self):
+        with contextlib.closing(sqlite3.connect(self.path, timeout=30)) as connection:
+            if not self._schema_created:
+                connection.executescript(self._SCHEMA)
+                self._schema_created = True
+            with connection:
+                yield connection
+    
+    def record(self, conversation_id:str, path:str, created:float|None, updated:float, bot:str, message_count:int):
+        """Add or update a conversation's entry. created is only set when the entry is added."""
+        self.record_many([{'conversation_id': conversation_id, 'path': path, 'created': created,
+                    'updated': updated, 'bot': bot, 'message_count': message_count}])
+    
+    def record_many(self, entries:list):
+        """Add or update several entries (dicts with the same fields as record() takes) at once"""
+        with self._connect() as connection:
+            connection.executemany("""
+                INSERT INTO conversations (conversation_id, path, created, updated, bot, message_count)
+                VALUES (:conversation_id, :path, coalesce(:created, :updated), :updated, :bot, :message_count)
+                ON CONFLICT (conversation_id) DO UPDATE SET
+                    path = excluded.path, updated = excluded.updated, message_count = excluded.message_count
+            """, entries)
+    
+    def _select(self, where='', params=()):
+        if not self.path.exists():
+            return []
+        with self._connect() as connection:
+            rows = connection.execute(f"SELECT {', '.join(self.FIELDS)} FROM conversations {where}", params)
+            return [SimpleNamespace(**dict(zip(self.FIELDS, row))) for row in rows]
+    
+    def lookup(self, conversation_id:str) -> SimpleNamespace|None:
+        entries = self._select('WHERE conversation_id = ?', (conversation_id,))
+        return entries[0] if entries else None
+    
+    def conversations(self, bot:str|None=None, since:float|None=None, until:float|None=None) -> list:
+        """Entries for the conversations (optionally only those with the named bot class, and/or
+        last updated within a range of timestamps), most recently updated first"""
+        clauses, params = [], []
+        for clause, value in [('bot = ?', bot), ('updated >= ?', since), ('updated < ?', until)]:
+            if value is not None:
+                clauses.append(clause)
+                params.append(value)
+        where = f"WHERE {' AND '.join(clauses)} " if clauses else ''
+        return self._select(where + 'ORDER BY updated DESC', params)
+
+
+__all__ = ['LogIndex']
@@ -0,0 +1,505 @@
+"""Storage backends for LoggedConversation.
+
+A LogStore persists conversations' messages (and the argv they were started with) and can load
+them back. LoggedConversation keeps track of which messages have changed since they were last
+saved and hands them to the store's prepare_write(), which returns a LogWrite holding everything
+that needs writing. The (blocking) writing is done by the store's commit(), which may be handed
+several writes, from any number of conversations, to commit as a group; it may be run on
+another thread, so nothing it does may touch the conversations. Any bookkeeping the store needs
+for each conversation lives in the object returned by new_state(), which the conversation holds
+on to.
+
+A conversation revived with only its last few turns loaded has history_offset earlier messages
+that aren't in its messages list, so message i of the list is message history_offset + i of
+the log.
+
+Stores that have a blob store (see robo.attachments) save the contents of file attachments there,
+once per distinct file, with the logged messages referring to them by hash.
+"""
+
+import functools
+import json
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+from .exceptions import UnknownConversationException, CorruptLogException
+from .logindex import LogIndex
+from .attachments import FileBlobStore, SQLiteBlobStore, dehydrate_message
+
+
+class LogWrite(object):
+    """A write prepared by a LogStore. Calling it commits it on its own; LogWriter commits several
+    at once. attachments are the Attachments that the messages being written refer to."""
+    __slots__ = ['store', 'payload', 'attachments']
+    
+    def __init__(self, store, payload, attachments=()):
+        self.store = store
+        self.payload = payload
+        self.attachments = attachments
+    
+    def __call__(self):
+        self.store.commit([self])
+
+
+class LogStore(object):
+    """Base class for LoggedConversation storage backends"""
+    __slots__ = ['blobs']
+    
+    def __init__(self, blobs=None):
+        self.blobs = blobs
+    
+    def _dehydrate(self, message, sync=False):
+        return message if self.blobs is None else dehydrate_message(message, self.blobs, sync=sync)
+    
+    def _store_attachments(self, writes, sync=False):
+        """Put the files that writes' messages refer to in the blob store, if they aren't there
+        already; done before the messages themselves are written"""
+        for write in writes:
+            for attachment in write.attachments:
+                if self.blobs is None:
+                    raise ValueError(f"{type(self).__name__} has no blob store to keep attachments in")
+                if attachment.digest not in self.blobs:
+                    self.blobs.put(attachment.read(), sync=sync)
+    
+    def new_state(self, conversation_id:str):
+        """Per-conversation bookkeeping for a conversation that hasn't been saved yet"""
+        return SimpleNamespace()
+    
+    def dump_state(self, state) -> dict:
+        """state (from new_state()) as plain data, for a conversation snapshot"""
+        return dict(vars(state))
+    
+    def load_state(self, data:dict):
+        """The reverse of dump_state()"""
+        return SimpleNamespace(**data)
+    
+    def prepare_write(self, conversation, start:int, truncated:bool) -> LogWrite:
+        """Return a LogWrite that saves conversation.messages[start:], replacing any saved messages
+        from start onwards if truncated is True. Called from the thread that owns conversation."""
+        raise NotImplementedError
+    
+    def commit(self, writes:list, sync:bool=False):
+        """Carry out writes (made by prepare_write, in the order they were made). If sync is True,
+        they must be on disk - not just handed to the operating system - before this returns."""
+        raise NotImplementedError
+    
+    def write_failed(self, state):
+        """Called (from the thread that owns the conversation) before the conversation with this
+        state sends the messages from a write that failed again, as a truncated write. Stores
+        whose state tracks what has been written should reset it here."""
+        pass
+    
+    def load(self, conversation_id:str, tail:int|None=None) -> SimpleNamespace:
+        """Load a conversation; returns a SimpleNamespace with argv, messages, offset, created and
+        state. If tail is given, only the messages making up the last tail turns are loaded, and
+        offset is the number of messages before them. Raises UnknownConversationException if
+        there's no such conversation."""
+        raise NotImplementedError
+    
+    def load_history(self, conversation_id:str, before:int, turns:int) -> tuple[int, list]:
+        """Load the messages making up the turns turns before message number before; returns the
+        number of the first message loaded, and the messages"""
+        raise NotImplementedError
+    
+    def list_conversations(self, bot:str|None=None, since:float|None=None, until:float|None=None) -> list:
+        """Conversations (optionally only those with the named bot class, and/or last updated
+        within a range of timestamps), most recently updated first. Each is a SimpleNamespace with
+        at least conversation_id, created, updated, bot and message_count."""
+        raise NotImplementedError
+    
+    @staticmethod
+    def _entry(conversation):
+        return {
+            'conversation_id': conversation.conversation_id,
+            'created': conversation.first_saved_at,
+            'updated': time.time(),
+            'bot': type(conversation.bot).__name__,
+            'message_count': conversation.history_offset + len(conversation.messages),
+        }
+
+
+def _is_turn_start(message):
+    """A user message that isn't just tool results, ie. a point a conversation can be picked up from"""
+    content = message['content']
+    return message['role'] == 'user' and (isinstance(content, str) or
+                any(not isinstance(block, dict) or block.get('type') != 'tool_result' for block in content))
+
+
+def _last_turns(indexed_messages, turns, end):
+    """Take (index, message) pairs, last first, until turns turns have been seen; returns the index
+    of the first message taken (end if none were), and the messages in order"""
+    offset, messages, seen = end, [], 0
+    for index, message in indexed_messages:
+        offset = index
+        messages.append(message)
+        if _is_turn_start(message) and (seen := seen + 1) == turns:
+            break
+    messages.reverse()
+    return offset, messages
+
+
+class FileLogStore(LogStore):
+    """Stores each conversation in a folder of its own under logs_dir (sharded by a hash of its
+    ID; see LogIndex), recorded in an index alongside the logs so that conversations can be found
+    and listed without scanning the directory.
+    
+    The folder holds an append-only journal (journal.jsonl) of JSON records - a header, then one
+    record per message added (or a truncate record if messages were removed) - so that logging a
+    turn costs the same however long the conversation gets. Once the journal grows longer than
+    both compact_threshold records and the previous snapshot, the whole conversation is written
+    out to snapshot.jsonl (a header line, then a line per message) and the journal starts afresh.
+    Because the snapshot has a line per message, the last few turns of a conversation can be read
+    from the end of it without reading the rest. Folders written by older versions (named
+    <hextime>__<id> and holding only a conversation.json, or with a snapshot.json) can still be
+    loaded.
+    
+    Attachments are kept in logs_dir/blobs, shared by all of the conversations."""
+    __slots__ = ['logs_dir', 'compact_threshold', 'index']
+    
+    def __init__(self, logs_dir:str|Path, compact_threshold:int=64):
+        self.logs_dir = Path(logs_dir)
+        self.compact_threshold = compact_threshold
+        self.index = LogIndex(logs_dir)
+        super().__init__(FileBlobStore(self.logs_dir / 'blobs'))
+    
+    def new_state(self, conversation_id):
+        return SimpleNamespace(
+            logdir=self.logs_dir / LogIndex.shard_path(conversation_id),
+            journal_records=0, ## Number of records in the current journal file
+            snapshot_length=0,
+        )
+    
+    def dump_state(self, state):
+        return super().dump_state(state) | {'logdir': str(state.logdir)}
+    
+    def load_state(self, data):
+        return super().load_state(data | {'logdir': Path(data['logdir'])})
+    
+    @staticmethod
+    def _write_file(path, mode, text, sync):
+        with open(path, mode) as logfile:
+            logfile.write(text)
+            if sync:
+                logfile.flush()
+                os.fsync(logfile.fileno())
+    
+    def _write_snapshot(self, logdir, header, messages, offset, sync=False):
+        """Compact the log: write the whole conversation to snapshot.jsonl and start a new journal.
+        Both files are replaced atomically, and the journal's records carry absolute message
+        indexes, so a crash between the two replacements loses nothing. If the conversation was
+        only partly loaded, the first offset messages are read back from the log."""
+        if offset:
+            messages = self._read_log(logdir, before=offset).messages + messages
+        snapshot_tmp, journal_tmp = logdir / 'snapshot.jsonl.tmp', logdir / 'journal.jsonl.tmp'
+        lines = [json.dumps({'type': 'header'} | header | {'length': len(messages)})]
+        lines.extend(json.dumps(self._dehydrate(message, sync)) for message in messages)
+        self._write_file(snapshot_tmp, 'w', '\n'.join(lines) + '\n', sync)
+        os.replace(snapshot_tmp, logdir / 'snapshot.jsonl')
+        self._write_file(journal_tmp, 'w', json.dumps({'type': 'header'} | header) + '\n', sync)
+        os.replace(journal_tmp, logdir / 'journal.jsonl')
+    
+    def _append_journal(self, logdir, records, sync=False):
+        for record in records:
+            if record['type'] == 'message':
+                record['message'] = self._dehydrate(record['message'], sync)
+        self._write_file(logdir / 'journal.jsonl', 'a', ''.join(json.dumps(record) + '\n' for record in records), sync)
+    
+    def commit(self, writes, sync=False):
+        """Writes for the same conversation are combined: journal records are appended with a
+        single write, and a snapshot makes any journal records before it redundant. The index
+        is updated for all of the conversations in one transaction."""
+        self._store_attachments(writes, sync)
+        by_logdir = {}
+        for write in writes:
+            by_logdir.setdefault(write.payload.logdir, []).append(write.payload)
+        for logdir, payloads in by_logdir.items():
+            logdir.mkdir(parents=True, exist_ok=True)
+            records = []
+            for payload in payloads:
+                if payload.snapshot is not None:
+                    records = []
+                    self._write_snapshot(logdir, *payload.snapshot, sync)
+                else:
+                    records.extend(payload.records)
+            if records:
+                self._append_journal(logdir, records, sync)
+        self.index.record_many([write.payload.entry for write in writes])
+    
+    def prepare_write(self, conversation, start, truncated):
+        state, messages, offset = conversation._log_state, conversation.messages, conversation.history_offset
+        records = [{'type': 'truncate', 'length': offset + start}] if truncated else []
+        for index in range(start, len(messages)):
+            records.append({'type': 'message', 'index': offset + index, 'message': messages[index]})
+        entry = self._entry(conversation) | {'path': str(state.logdir.relative_to(self.logs_dir))}
+        payload = SimpleNamespace(logdir=state.logdir, entry=entry, records=records, snapshot=None)
+        if state.journal_records + len(records) > max(self.compact_threshold, state.snapshot_length):
+            state.snapshot_length = offset + len(messages)
+            state.journal_records = 1
+            payload.snapshot = (conversation._log_header(), list(messages), offset)
+        else:
+            if state.journal_records == 0:
+                records.insert(0, {'type': 'header'} | conversation._log_header())
+            state.journal_records += len(records)
+        return LogWrite(self, payload)
+    
+    def write_failed(self, state):
+        ## The failed write may have been the one that started the journal, so start it again
+        state.journal_records = 0
+    
+    @staticmethod
+    def _snapshot_lines(path, length):
+        """Yield (index, message) for the messages in a snapshot.jsonl, last first, reading the
+        file backwards a block at a time"""
+        index = length
+        with open(path, 'rb') as reader:
+            position = reader.seek(0, os.SEEK_END)
+            remainder = b''
+            while position > 0 and index > 0:
+                size = min(65536, position)
+                position -= size
+                reader.seek(position)
+                lines = (reader.read(size) + remainder).split(b'\n')
+                remainder = lines.pop(0)
+                for line in reversed(lines):
+                    if line.strip() and index > 0:
+                        index -= 1
+                        yield index, json.loads(line)
+    
+    @classmethod
+    def _read_log(klass, logdir, turns=None, before=None):
+        """Rebuild a conversation from its snapshot (or legacy snapshot.json or conversation.json)
+        and journal. If turns is given, only the messages making up the last that many turns
+        (before message number before, if given) are loaded, and offset is set to the number of
+        the first of them."""
+        logdata = SimpleNamespace(argv=None, messages=[], offset=0, created=None,
+                    state=SimpleNamespace(logdir=logdir, journal_records=0, snapshot_length=0))
+        snapshot = None ## The snapshot's messages, if they've been loaded
+        if (logdir / 'snapshot.jsonl').exists():
+            with (logdir / 'snapshot.jsonl').open('r') as reader:
+                header = json.loads(reader.readline())
+                if turns is None:
+                    snapshot = [json.loads(line) for line in reader if line.strip()]
+            logdata.argv, length = header['argv'], header['length']
+        else:
+            for basename in ['snapshot.json', 'conversation.json']:
+                if (logdir / basename).exists():
+                    with (logdir / basename).open('r') as reader:
+                        legacy = json.load(reader)
+                    logdata.argv, snapshot = legacy['argv'], legacy['messages']
+                    break
+            length = len(snapshot or [])
+        logdata.state.snapshot_length = snapshot_length = length
+        ## Replay the journal without needing the snapshot's messages: anything it sets takes
+        ## precedence over the snapshot, up to the final length. Snapshot messages from the lowest
+        ## truncation onwards are only valid if the journal has written them again.
+        written, snapshot_valid = {}, length
+        if (logdir / 'journal.jsonl').exists():
+            with (logdir / 'journal.jsonl').open('r') as reader:
+                for line in reader:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        break ## A write that was cut short
+                    logdata.state.journal_records += 1
+                    if record['type'] == 'header':
+                        logdata.argv = record['argv']
+                    elif record['type'] == 'message':
+                        written[record['index']] = record['message']
+                        length = record['index'] + 1
+                    elif record['type'] == 'truncate':
+                        length = min(length, record['length'])
+                        snapshot_valid = min(snapshot_valid, length)
+                        written = {index: message for index, message in written.items() if index < length}
+        end = length if before is None else min(before, length)
+        if (missing := [i for i in range(snapshot_valid, end) if i not in written]):
+            raise CorruptLogException(f"The log in {logdir} is missing messages {missing[0]} to {missing[-1]}")
+        if turns is None:
+            logdata.messages = [written[i] if i in written else snapshot[i] for i in range(end)]
+            return logdata
+        from_snapshot = iter(klass._snapshot_lines(logdir / 'snapshot.jsonl', snapshot_length) if snapshot is None
+                    else reversed(list(enumerate(snapshot[:snapshot_length]))))
+        def message_at(index):
+            if index in written:
+                return written[index]
+            for snapshot_index, message in from_snapshot:
+                if snapshot_index == index:
+                    return message
+        logdata.offset, logdata.messages = _last_turns(((i, message_at(i)) for i in range(end - 1, -1, -1)), turns, end)
+        return logdata
+    
+    def _find_logdir(self, conversation_id):
+        entry = self.index.lookup(conversation_id)
+        created = None if entry is None else entry.created
+        if (logdir := self.logs_dir / LogIndex.shard_path(conversation_id)).is_dir():
+            pass
+        elif entry is not None:
+            logdir = self.logs_dir / entry.path
+        else:
+            ## Older logs sit directly in logs_dir, in folders named <hextime>__<id>
+            try:
+                logdir_candidate = list(filter(lambda f: f.endswith(f"__{conversation_id}"), os.listdir(self.logs_dir)))[0]
+            except IndexError as exc:
+                excmsg = f"Conversation with ID {conversation_id} could not be found"
+                raise UnknownConversationException(excmsg) from exc
+            logdir, created = self.logs_dir / logdir_candidate, int(logdir_candidate.split('__')[0], 16) * 10
+        return logdir, created
+    
+    def load(self, conversation_id, tail=None):
+        logdir, created = self._find_logdir(conversation_id)
+        logdata = self._read_log(logdir, turns=tail)
+        logdata.created = created
+        return logdata
+    
+    def load_history(self, conversation_id, before, turns):
+        logdir, created = self._find_logdir(conversation_id)
+        logdata = self._read_log(logdir, turns=turns, before=before)
+        return logdata.offset, logdata.messages
+    
+    def list_conversations(self, bot=None, since=None, until=None):
+        return self.index.conversations(bot=bot, since=since, until=until)
+
+
+class SQLiteLogStore(LogStore):
+    """Stores any number of conversations in a single SQLite database, one row per message, in
+    WAL mode so that reading doesn't block writing. Conversations are indexed by ID, bot and
+    created/updated time. Attachments are kept (once each) in a table of their own.
+    
+    Writes made at the same time (from different threads, eg. several sync conversations, or the
+    background writer alongside them) are grouped: whichever thread gets to the database first
+    commits everything that's waiting in a single transaction, and the others just wait for it.
+    synchronous is passed to SQLite's PRAGMA of the same name; with WAL, 'NORMAL' (the default)
+    can't corrupt the database, but the last few commits may be lost if the machine loses power.
+    Use 'FULL' if every turn must survive that."""
+    __slots__ = ['path', '_connection', '_commit_lock', '_pending_lock', '_pending']
+    
+    FIELDS = ['conversation_id', 'created', 'updated', 'bot', 'message_count']
+    _SCHEMA = """
+        CREATE TABLE IF NOT EXISTS conversations (
+            conversation_id TEXT PRIMARY KEY,
+            argv TEXT,
+            created REAL,
+            updated REAL,
+            bot TEXT,
+            message_count INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS conversations_by_updated ON conversations (updated);
+        CREATE INDEX IF NOT EXISTS conversations_by_created ON conversations (created);
+        CREATE INDEX IF NOT EXISTS conversations_by_bot ON conversations (bot, updated);
+        CREATE TABLE IF NOT EXISTS messages (
+            conversation_id TEXT NOT NULL,
+            idx INTEGER NOT NULL,
+            message TEXT NOT NULL,
+            PRIMARY KEY (conversation_id, idx)
+        ) WITHOUT ROWID;
+    """
+    
+    def __init__(self, path:str|Path, synchronous:str='NORMAL'):
+        self.path = Path(path)
+        self._connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute(f'PRAGMA synchronous={synchronous}')
+        self._connection.executescript(self._SCHEMA)
+        self._commit_lock = threading.RLock()
+        self._pending_lock = threading.Lock()
+        self._pending = []
+        super().__init__(SQLiteBlobStore(self._connection, self._commit_lock))
+    
+    def close(self):
+        with self._commit_lock:
+            self._connection.close()
+    
+    def _run(self, operations):
+        """Run each of operations (connection) in a transaction, along with any others waiting to run"""
+        job = SimpleNamespace(operations=operations, done=False, error=None)
+        with self._pending_lock:
+            self._pending.append(job)
+        with self._commit_lock:
+            if not job.done:
+                with self._pending_lock:
+                    batch, self._pending = self._pending, []
+                try:
+                    self._connection.execute('BEGIN IMMEDIATE')
+                    try:
+                        for queued in batch:
+                            for operation in queued.operations:
+                                operation(self._connection)
+                    except BaseException:
+                        self._connection.execute('ROLLBACK')
+                        raise
+                    self._connection.execute('COMMIT')
+                except BaseException as exc:
+                    for queued in batch:
+                        queued.error = exc
+                for queued in batch:
+                    queued.done = True
+        if job.error is not None:
+            raise job.error
+    
+    def _save(self, conversation_id, argv, entry, start, truncated, messages, connection):
+        if truncated:
+            connection.execute('DELETE FROM messages WHERE conversation_id = ? AND idx >= ?', (conversation_id, start))
+        connection.executemany('INSERT OR REPLACE INTO messages (conversation_id, idx, message) VALUES (?, ?, ?)',
+                    [(conversation_id, index, json.dumps(self._dehydrate(message)))
+                    for index, message in enumerate(messages, start)])
+        connection.execute("""
+            INSERT INTO conversations (conversation_id, argv, created, updated, bot, message_count)
+            VALUES (:conversation_id, :argv, :created, :updated, :bot, :message_count)
+            ON CONFLICT (conversation_id) DO UPDATE SET
+                argv = excluded.argv, updated = excluded.updated, message_count = excluded.message_count
+        """, entry | {'argv': json.dumps(argv)})
+    
+    def prepare_write(self, conversation, start, truncated):
+        return LogWrite(self, functools.partial(self._save, conversation.conversation_id, conversation.argv,
+                    self._entry(conversation), conversation.history_offset + start, truncated, conversation.messages[start:]))
+    
+    def commit(self, writes, sync=False):
+        """All of writes are committed in one transaction. How durable that is depends on the
+        database's synchronous setting rather than sync."""
+        self._run([lambda connection: self._store_attachments(writes)] + [write.payload for write in writes])
+    
+    def _read_messages(self, conversation_id, turns, before):
+        """Load the messages of the last turns turns before message number before (all of them if
+        turns is None); call with the lock held"""
+        if turns is None:
+            rows = self._connection.execute('SELECT message FROM messages WHERE conversation_id = ? AND idx < ? '
+                        'ORDER BY idx', (conversation_id, before)).fetchall()
+            if len(rows) != before:
+                raise CorruptLogException(f"Conversation {conversation_id} should have {before} messages, "
+                            f"but only {len(rows)} are logged")
+            return 0, [json.loads(message) for (message,) in rows]
+        rows = self._connection.execute('SELECT idx, message FROM messages WHERE conversation_id = ? AND idx < ? '
+                    'ORDER BY idx DESC', (conversation_id, before))
+        return _last_turns(((index, json.loads(message)) for index, message in rows), turns, before)
+    
+    def load(self, conversation_id, tail=None):
+        with self._commit_lock:
+            row = self._connection.execute('SELECT argv, created, message_count FROM conversations WHERE conversation_id = ?',
+                        (conversation_id,)).fetchone()
+            if row is None:
+                raise UnknownConversationException(f"Conversation with ID {conversation_id} could not be found")
+            offset, messages = self._read_messages(conversation_id, tail, row[2])
+        return SimpleNamespace(argv=json.loads(row[0]), messages=messages, offset=offset, created=row[1],
+                    state=self.new_state(conversation_id))
+    
+    def load_history(self, conversation_id, before, turns):
+        with self._commit_lock:
+            return self._read_messages(conversation_id, turns, before)
+    
+    def list_conversations(self, bot=None, since=None, until=None):
+        clauses, params = [], []
+        for clause, value in [('bot = ?', bot), ('updated >= ?', since), ('updated < ?', until)]:
+            if value is not None:
+                clauses.append(clause)
+                params.append(value)
+        where = f"WHERE {' AND '.join(clauses)} " if clauses else ''
+        with self._commit_lock:
+            rows = self._connection.execute(f"SELECT {', '.join(self.FIELDS)} FROM conversations {where}"
+                        "ORDER BY updated DESC", params).fetchall()
+        return [SimpleNamespace(**dict(zip(self.FIELDS, row))) for row in rows]
+
+
+__all__ = ['LogStore', 'LogWrite', 'FileLogStore', 'SQLiteLogStore']
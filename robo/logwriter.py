@@ -0,0 +1,140 @@
+"""Background writing of conversation logs, so that conversations never wait on the disk, and
+writes from many conversations can be committed together."""
+
+import atexit
+import queue
+import threading
+from concurrent.futures import Future
+from time import monotonic, perf_counter
+
+
+class LogWriter(object):
+    """Runs log writes on a background thread. Writes are taken off the queue in groups: whatever
+    has been queued by the time the thread gets to it (waiting up to flush_interval seconds for
+    more to arrive, and taking at most max_batch), so that when many conversations are logging at
+    once, their writes are committed together rather than one by one. Writes for the same log
+    store are handed to the store's commit() as a group, letting it share work between them (one
+    transaction, one append per journal, and so on); within a store, writes are committed in the
+    order they were submitted, so those for any one conversation can never be reordered.
+    
+    durability is one of:
+        'flush' (the default) - written to the operating system, which gets them to disk in its
+            own time, so a power cut can lose recent turns
+        'fsync' - each group is fsynced before the writes in it are reported as done
+    
+    If a group fails to commit, every write in it fails: the error is set on their futures, which
+    LoggedConversation watches so that its next write sends the lost messages again, and the
+    failures are counted in metrics().
+    
+    A job can also be any callable taking no arguments, which is just called."""
+    __slots__ = ['flush_interval', 'max_batch', 'durability', '_queue', '_thread', '_lock', '_in_flight',
+                 '_writes', '_batches', '_failed', '_flush_time', '_last_flush', '_max_flush']
+    
+    FLUSH = 'flush'
+    FSYNC = 'fsync'
+    
+    def __init__(self, flush_interval:float=0.0, durability:str=FLUSH, max_batch:int=256):
+        if durability not in (self.FLUSH, self.FSYNC):
+            raise ValueError(f"Unknown durability: {durability}")
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.durability = durability
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._writes = 0
+        self._batches = 0
+        self._failed = 0
+        self._flush_time = 0.0
+        self._last_flush = None
+        self._max_flush = 0.0
+    
+    def submit(self, job) -> Future:
+        """Queue job (a LogWrite, or a callable taking no arguments) to be run on the writer thread"""
+        future = Future()
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='robo-logwriter', daemon=True)
+                self._thread.start()
+        self._queue.put((job, future))
+        return future
+    
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        deadline = monotonic() + self.flush_interval
+        while len(batch) < self.max_batch:
+            try:
+                if (timeout := deadline - monotonic()) > 0:
+                    batch.append(self._queue.get(timeout=timeout))
+                else:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+    
+    def _run(self):
+        while True:
+            batch = [(job, future) for job, future in self._next_batch() if future.set_running_or_notify_cancel()]
+            self._in_flight = len(batch)
+            started = perf_counter()
+            self._commit(batch)
+            elapsed = perf_counter() - started
+            self._in_flight = 0
+            self._writes += len(batch)
+            self._batches += 1
+            self._flush_time += elapsed
+            self._last_flush = elapsed
+            self._max_flush = max(self._max_flush, elapsed)
+    
+    def _commit(self, batch):
+        groups = {}
+        for job, future in batch:
+            groups.setdefault(getattr(job, 'store', None), []).append((job, future))
+        sync = self.durability == self.FSYNC
+        for store, jobs in groups.items():
+            if store is None:
+                for job, future in jobs:
+                    try:
+                        future.set_result(job())
+                    except BaseException as exc:
+                        self._failed += 1
+                        future.set_exception(exc)
+                continue
+            try:
+                store.commit([job for job, future in jobs], sync=sync)
+            except BaseException as exc:
+                self._failed += len(jobs)
+                for job, future in jobs:
+                    future.set_exception(exc)
+            else:
+                for job, future in jobs:
+                    future.set_result(None)
+    
+    def flush(self, timeout:float|None=None):
+        """Block until everything submitted so far has been written"""
+        if self._thread is not None and self._thread.is_alive():
+            self.submit(lambda: None).result(timeout)
+    
+    def metrics(self) -> dict:
+        """Queue depth (writes waiting, and in the group being committed), plus the number of writes
+        and groups committed so far, how many of those writes failed, and how long committing them
+        took, in seconds"""
+        return {
+            'queue_depth': self._queue.qsize(),
+            'in_flight': self._in_flight,
+            'writes': self._writes,
+            'batches': self._batches,
+            'failed_writes': self._failed,
+            'mean_batch_size': self._writes / self._batches if self._batches else None,
+            'last_flush_latency': self._last_flush,
+            'mean_flush_latency': self._flush_time / self._batches if self._batches else None,
+            'max_flush_latency': self._max_flush,
+        }
+
+
+_shared_writer = LogWriter()
+atexit.register(_shared_writer.flush)
+
+
+__all__ = ['LogWriter']
@@ -0,0 +1,38 @@
+"""Serialising a Conversation's state, so that it can be picked up by another process.
+
+A snapshot holds everything needed to carry on the conversation - messages, system prompt, tool
+calls that are still pending or waiting on the client, cache checkpoints and so on - but not the
+bot or its client, which the process restoring it supplies, nor the contents of attachments, which
+are kept in a blob store and referred to by digest. It's JSON, compressed, behind a short header
+saying which version of the format it's in; being plain data, a snapshot can't run code when it's
+loaded, wherever it came from.
+"""
+
+import json
+import zlib
+
+from .exceptions import SnapshotFormatException
+
+MAGIC = b'ROBOSNAP'
+VERSION = 1
+
+
+def dump_snapshot(state:dict, level:int=1) -> bytes:
+    """Encode state (a dict of JSON-serialisable values); level is the zlib compression level"""
+    return MAGIC + bytes([VERSION]) + zlib.compress(json.dumps(state, separators=(',', ':')).encode('utf-8'), level)
+
+
+def load_snapshot(data:bytes) -> dict:
+    """Decode a snapshot made by dump_snapshot()"""
+    data = memoryview(data)
+    if data[:len(MAGIC)] != MAGIC:
+        raise SnapshotFormatException("Not a conversation snapshot")
+    if (version := data[len(MAGIC)]) != VERSION:
+        raise SnapshotFormatException(f"Unsupported snapshot version: {version}")
+    try:
+        return json.loads(zlib.decompress(data[len(MAGIC) + 1:]))
+    except (zlib.error, ValueError) as exc:
+        raise SnapshotFormatException("Corrupt conversation snapshot") from exc
+
+
+__all__ = ['dump_snapshot', 'load_snapshot']
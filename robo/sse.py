@@ -0,0 +1,244 @@
+"""Serve Conversation streams to browsers as Server-Sent Events.
+
+Three event types are emitted, each with a JSON payload:
+    text  - {"text": "..."} for each text delta
+    tool  - {"id": "...", "name": "...", "status": "started"|"finished", "is_error": bool} as tool
+            calls are run
+    usage - token usage summed across the whole response (including tool-use follow-ups); always
+            the last event
+
+Both generators pull from the model only as fast as the consumer pulls from them, so nothing is
+buffered beyond the chunk in flight. Closing a generator early (which WSGI/ASGI servers do when
+the client goes away) cancels the response with stream.cancel(): by default the message that
+prompted it is removed, leaving the conversation as it was, or with commit_partial set the text
+sent so far is kept as the assistant's turn.
+"""
+
+import asyncio
+import contextlib
+import json
+
+from .streamutils import _get_coalescer
+
+SSE_HEADERS = {
+    'content-type': 'text/event-stream',
+    'cache-control': 'no-cache',
+    'x-accel-buffering': 'no',
+}
+
+HEARTBEAT = b': keepalive\n\n'
+
+def format_event(event:str, data) -> bytes:
+    return f'event: {event}\ndata: {json.dumps(data)}\n\n'.encode('utf-8')
+
+
+class _ToolEventCollector:
+    """Turns tool callbacks into SSE events. In a sync conversation the callbacks fire from within
+    the stream, so events are collected here and drained by the generator when the stream next
+    yields (which it does just before and after tools run). In an async one, each event is handed
+    to emit() as soon as its callback fires."""
+    
+    def __init__(self, conversation, emit=None):
+        self.conversation = conversation
+        self.emit = emit
+        self.events = []
+    
+    @staticmethod
+    def _started_events(conv):
+        return [format_event('tool', {'id': tub.id, 'name': tub.name, 'status': 'started', 'is_error': False})
+                for tub in conv.tool_use_blocks.pending if tub.status == 'PENDING']
+    
+    @staticmethod
+    def _finished_event(data):
+        request, response = data
+        return format_event('tool', {'id': request.id, 'name': request.name,
+                'status': 'finished', 'is_error': bool(response.get('is_error', False))})
+    
+    def _on_turn_complete(self, conv, data):
+        self.events.extend(self._started_events(conv))
+    
+    def _on_tool_executed(self, conv, data):
+        self.events.append(self._finished_event(data))
+    
+    async def _aon_turn_complete(self, conv, data):
+        for event in self._started_events(conv):
+            await self.emit(event)
+    
+    async def _aon_tool_executed(self, conv, data):
+        await self.emit(self._finished_event(data))
+    
+    def _callbacks(self):
+        if self.conversation.is_async:
+            return [('turn_complete', self._aon_turn_complete), ('tool_executed', self._aon_tool_executed)]
+        return [('turn_complete', self._on_turn_complete), ('tool_executed', self._on_tool_executed)]
+    
+    def __enter__(self):
+        for name, callback in self._callbacks():
+            self.conversation.register_callback(name, callback)
+        return self
+    
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        for name, callback in self._callbacks():
+            self.conversation.unregister_callback(name, callback)
+    
+    def drain(self):
+        events, self.events = self.events, []
+        return events
+
+
+def _text_events(chunk, coalescer, tool_events):
+    """Tool events go out as soon as they're seen, but any text buffered before them goes first.
+    An empty chunk (the stream pausing for tools to run) only sends the tool events."""
+    if (pending := tool_events.drain()):
+        if coalescer is not None and (text := coalescer.flush()):
+            yield format_event('text', {'text': text})
+        yield from pending
+    if not chunk:
+        return
+    if coalescer is None:
+        yield format_event('text', {'text': chunk})
+    elif (text := coalescer.push(chunk)) is not None:
+        yield format_event('text', {'text': text})
+
+def _final_events(coalescer, tool_events):
+    if coalescer is not None and (text := coalescer.flush()):
+        yield format_event('text', {'text': text})
+    yield from tool_events.drain()
+
+
+def sse_stream(conversation, message:str, with_files:list=[], args:list=[], coalesce=False,
+              commit_partial=False):
+    """Send message to a streaming Conversation and yield the response as SSE-formatted bytes,
+    eg. for a WSGI response. Heartbeats aren't available here, since nothing can be yielded while
+    the generator is blocked waiting on the model; use asse_stream if you need them. coalesce
+    works as for streamer(), but defaults to off so that each text delta gets its own event. Tool
+    events are sent just before the tools run and once they've all finished. commit_partial is
+    passed to stream.cancel() if the generator is closed early."""
+    if not conversation.started:
+        conversation.prestart(args)
+    coalescer = _get_coalescer(coalesce)
+    with _ToolEventCollector(conversation) as tool_events:
+        with conversation.resume(message, with_files=with_files) as stream:
+            stream._tool_breaks = True
+            try:
+                for chunk in stream.text_stream:
+                    yield from _text_events(chunk, coalescer, tool_events)
+            except GeneratorExit:
+                stream.cancel(commit_partial=commit_partial)
+                raise
+        yield from _final_events(coalescer, tool_events)
+    yield format_event('usage', stream.usage)
+
+
+async def asse_stream(conversation, message:str, with_files:list=[], args:list=[], heartbeat:float|None=15.0,
+                    coalesce=False, commit_partial=False):
+    """Async version of sse_stream, for an async_mode Conversation. If heartbeat is set, a keepalive
+    comment is yielded whenever that many seconds pass without anything else to send, so that
+    proxies don't time out the connection while tools run or the model is thinking."""
+    if not conversation.started:
+        conversation.prestart(args)
+    ## The API stream is consumed in a task of its own so that it is always entered, exited and
+    ## cancelled from the same task; a single-slot queue hands events over one at a time.
+    queue = asyncio.Queue(maxsize=1)
+    finished = object()
+    coalescer = _get_coalescer(coalesce)
+    
+    async def emit(event):
+        ## Tool events are queued as their callbacks fire, after any text buffered before them
+        if coalescer is not None and (text := coalescer.flush()):
+            await queue.put(format_event('text', {'text': text}))
+        await queue.put(event)
+    
+    async def produce():
+        with _ToolEventCollector(conversation, emit) as tool_events:
+            stream = await conversation.aresume(message, with_files=with_files)
+            try:
+                async with stream:
+                    async for chunk in stream.text_stream:
+                        for event in _text_events(chunk, coalescer, tool_events):
+                            await queue.put(event)
+            except asyncio.CancelledError:
+                await stream.cancel(commit_partial=commit_partial)
+                raise
+            for event in _final_events(coalescer, tool_events):
+                await queue.put(event)
+        await queue.put(format_event('usage', stream.usage))
+        await queue.put(finished)
+    
+    producer = asyncio.ensure_future(produce())
+    getter = None
+    try:
+        while True:
+            if getter is None:
+                getter = asyncio.ensure_future(queue.get())
+            waiting = [getter] if producer.done() else [getter, producer]
+            done, _ = await asyncio.wait(waiting, timeout=heartbeat, return_when=asyncio.FIRST_COMPLETED)
+            if getter in done:
+                event, getter = getter.result(), None
+                if event is finished:
+                    break
+                yield event
+            elif producer in done:
+                producer.result() ## Raises if the stream failed, otherwise `finished` is on its way
+            else:
+                yield HEARTBEAT
+    finally:
+        for task in (getter, producer):
+            if task is not None and not task.done():
+                task.cancel()
+                with contextlib.suppress(asyncio.CancelledError):
+                    await task
+
+
+class SSEResponse:
+    """An ASGI application that streams the response to message as Server-Sent Events. The client
+    disconnecting cancels the stream (see asse_stream for commit_partial). For example, in Starlette:
+    
+        async def chat(request):
+            return SSEResponse(conversation, (await request.json())['message'])
+    """
+    
+    def __init__(self, conversation, message:str, with_files:list=[], args:list=[],
+                heartbeat:float|None=15.0, headers:dict={}, coalesce=False, commit_partial=False):
+        self.conversation = conversation
+        self.message = message
+        self.with_files = with_files
+        self.args = args
+        self.heartbeat = heartbeat
+        self.coalesce = coalesce
+        self.commit_partial = commit_partial
+        self.headers = {**SSE_HEADERS, **headers}
+    
+    async def _send_events(self, send):
+        events = asse_stream(self.conversation, self.message, with_files=self.with_files,
+                args=self.args, heartbeat=self.heartbeat, coalesce=self.coalesce,
+                commit_partial=self.commit_partial)
+        async with contextlib.aclosing(events):
+            async for payload in events:
+                await send({'type': 'http.response.body', 'body': payload, 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+    
+    @staticmethod
+    async def _wait_for_disconnect(receive):
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+    
+    async def __call__(self, scope, receive, send):
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [(k.encode('latin-1'), v.encode('latin-1')) for k, v in self.headers.items()],
+        })
+        sender = asyncio.ensure_future(self._send_events(send))
+        watcher = asyncio.ensure_future(self._wait_for_disconnect(receive))
+        try:
+            await asyncio.wait([sender, watcher], return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in (sender, watcher):
+                task.cancel()
+            for task in (sender, watcher):
+                with contextlib.suppress(asyncio.CancelledError):
+                    await task
+
+
+__all__ = ['sse_stream', 'asse_stream', 'SSEResponse', 'format_event', 'SSE_HEADERS']
@@ -0,0 +1,338 @@
+"""Utilities for consumers of Conversation streams."""
+
+import asyncio
+import contextlib
+import inspect
+import time
+from collections import deque
+
+from .exceptions import SubscriberDroppedException, StreamCancelledException
+
+
+class ChunkCoalescer(object):
+    """Buffers the text chunks of a stream and releases them in larger pieces, so that whatever
+    they're being written to (a terminal, socket or log file) gets one write per phrase instead
+    of one per token. Buffered text is released when any of the following is true:
+        - at least max_chars characters are buffered
+        - the oldest buffered chunk has been waiting max_delay seconds or more
+        - the latest chunk ends with one of the characters in flush_on (by default, the end of
+          a line or sentence)
+    Only the arrival of a chunk can trigger a release, so call flush() once the stream ends, or
+    before it pauses (eg. from a turn_complete callback, before tools are run), to get whatever
+    is left."""
+    __slots__ = ['max_chars', 'max_delay', 'flush_on', '_buffer', '_size', '_started']
+    
+    def __init__(self, max_chars:int=256, max_delay:float=0.05, flush_on:str='\n.!?'):
+        self.max_chars = max_chars
+        self.max_delay = max_delay
+        self.flush_on = frozenset(flush_on)
+        self._buffer = []
+        self._size = 0
+        self._started = None
+    
+    def push(self, chunk:str) -> str|None:
+        """Add a chunk; returns the buffered text if it is due to be released, otherwise None."""
+        if not chunk:
+            return None
+        self._buffer.append(chunk)
+        self._size += len(chunk)
+        now = time.monotonic()
+        if self._started is None:
+            self._started = now
+        if self._size >= self.max_chars or chunk[-1] in self.flush_on or now - self._started >= self.max_delay:
+            return self.flush()
+        return None
+    
+    def flush(self) -> str:
+        """Release (and return) whatever is buffered, possibly an empty string."""
+        text = ''.join(self._buffer)
+        self._buffer.clear()
+        self._size = 0
+        self._started = None
+        return text
+    
+    def coalesce(self, chunks):
+        """Wrap an iterable of chunks, eg. stream.text_stream"""
+        for chunk in chunks:
+            if (text := self.push(chunk)) is not None:
+                yield text
+        if (text := self.flush()):
+            yield text
+    
+    async def acoalesce(self, chunks):
+        async for chunk in chunks:
+            if (text := self.push(chunk)) is not None:
+                yield text
+        if (text := self.flush()):
+            yield text
+
+
+async def _source_chunks(source, commit_partial=False):
+    """Iterate the text chunks of a stream source: an async stream wrapper, an awaitable that
+    produces one, or any async iterable of chunks. If iteration is cancelled or abandoned partway
+    through a stream wrapper, the response is cancelled with its cancel(commit_partial), so that
+    the conversation isn't left with an unanswered user turn."""
+    if inspect.isawaitable(source):
+        source = await source
+    if hasattr(source, '__aenter__'):
+        try:
+            async with source as stream:
+                async for chunk in stream.text_stream:
+                    yield chunk
+        except (asyncio.CancelledError, GeneratorExit):
+            if hasattr(source, 'cancel'):
+                await source.cancel(commit_partial=commit_partial)
+            raise
+    else:
+        async for chunk in source:
+            yield chunk
+
+
+class StreamMultiplexer(object):
+    """Fans in several async streams, yielding (key, chunk) pairs from one async iterator as the
+    chunks arrive. A source can be an async stream wrapper, an awaitable that produces one (eg.
+    conversation.aresume(message)) or any async iterable of chunks. Each source is consumed by a
+    task of its own, which can get at most buffer_size chunks ahead of the consumer before it has
+    to wait, so a slow consumer holds back fast streams rather than buffering them.
+    
+        async with StreamMultiplexer({'alice': conv1.aresume("Hi"), 'bob': conv2.aresume("Yo")}) as mux:
+            async for key, chunk in mux:
+                ...
+    
+    Leaving the async with block (or the consuming task being cancelled) cancels any streams that
+    are still running, with commit_partial passed to their cancel(). As each stream finishes, its
+    key is added to results: None if it completed, or the exception it failed with. With
+    fail_fast, the first failure cancels the remaining streams and is raised to the consumer;
+    otherwise iteration carries on with the others."""
+    __slots__ = ['buffer_size', 'fail_fast', 'commit_partial', 'results', '_sources', '_tasks', '_queue']
+    
+    _DONE = object()
+    
+    def __init__(self, sources:dict={}, buffer_size:int=8, fail_fast:bool=False, commit_partial:bool=False):
+        self.buffer_size = buffer_size
+        self.fail_fast = fail_fast
+        self.commit_partial = commit_partial
+        self.results = {}
+        self._sources = {}
+        self._tasks = {}
+        self._queue = None
+        for key, source in sources.items():
+            self.add(key, source)
+    
+    def add(self, key, source):
+        """Add a stream; this can be done while iterating, in which case it starts right away"""
+        if key in self._sources:
+            raise ValueError(f"A stream with key {key!r} has already been added")
+        self._sources[key] = source
+        if self._queue is not None:
+            self._start(key, source)
+    
+    @property
+    def pending(self):
+        """Keys of the streams that haven't finished yet"""
+        return [key for key in self._sources if key not in self.results]
+    
+    def _start(self, key, source):
+        self._tasks[key] = asyncio.ensure_future(self._pump(key, source, asyncio.Semaphore(self.buffer_size)))
+    
+    async def _pump(self, key, source, permits):
+        queue = self._queue
+        try:
+            async with contextlib.aclosing(_source_chunks(source, self.commit_partial)) as chunks:
+                async for chunk in chunks:
+                    await permits.acquire()
+                    queue.put_nowait((key, chunk, permits))
+        except asyncio.CancelledError as exc:
+            self.results[key] = exc
+            raise
+        except Exception as exc:
+            self.results[key] = exc
+        else:
+            self.results[key] = None
+        finally:
+            queue.put_nowait((key, self._DONE, None))
+    
+    async def __aiter__(self):
+        self._queue = asyncio.Queue()
+        for key, source in self._sources.items():
+            if key not in self._tasks:
+                self._start(key, source)
+        try:
+            while self._tasks:
+                key, chunk, permits = await self._queue.get()
+                if chunk is self._DONE:
+                    del self._tasks[key]
+                    if self.fail_fast and isinstance(error := self.results.get(key), Exception):
+                        raise error
+                    continue
+                yield key, chunk
+                permits.release()
+        finally:
+            await self.aclose()
+    
+    async def aclose(self):
+        """Cancel any streams that are still running"""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for key in self._tasks:
+            self.results.setdefault(key, asyncio.CancelledError())
+        self._tasks.clear()
+    
+    async def __aenter__(self):
+        return self
+    
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.aclose()
+
+
+class _Subscription(object):
+    """One subscriber's view of a StreamBroadcaster; iterate it to get the chunks"""
+    __slots__ = ['broadcaster', 'queue', 'degraded', 'dropped', '_wakeup']
+    
+    def __init__(self, broadcaster):
+        self.broadcaster = broadcaster
+        self.queue = deque()
+        self.degraded = False
+        self.dropped = False
+        self._wakeup = asyncio.Event()
+    
+    def _put(self, chunk):
+        queue = self.queue
+        if len(queue) < self.broadcaster.max_queue:
+            queue.append(chunk)
+        elif self.broadcaster.policy == StreamBroadcaster.DEGRADE:
+            ## Fall back to fewer, larger chunks rather than losing any text
+            queue[-1] += chunk
+            self.degraded = True
+        else:
+            self.dropped = True
+            self.broadcaster._subscribers.remove(self)
+        self._wakeup.set()
+    
+    def close(self):
+        """Unsubscribe"""
+        if self in self.broadcaster._subscribers:
+            self.broadcaster._subscribers.remove(self)
+        self.queue.clear()
+    
+    def __aiter__(self):
+        return self
+    
+    async def __anext__(self):
+        while not self.queue:
+            if self.dropped:
+                raise SubscriberDroppedException(f"Subscriber fell more than {self.broadcaster.max_queue} chunks behind")
+            if self.broadcaster.finished:
+                if self.broadcaster.error is not None:
+                    raise self.broadcaster.error
+                raise StopAsyncIteration
+            self._wakeup.clear()
+            await self._wakeup.wait()
+        return self.queue.popleft()
+
+
+class StreamBroadcaster(object):
+    """Runs a single async stream (any source StreamMultiplexer accepts) and fans its chunks out
+    to any number of subscribers, so that one response can be watched by several clients without
+    calling the model more than once.
+    
+        async with StreamBroadcaster(conversation.aresume("Hi!")) as broadcast:
+            subscriber = broadcast.subscribe()
+            async for chunk in subscriber:
+                ...
+    
+    A subscriber that joins late first gets everything streamed so far (as one chunk), then
+    follows live. Each subscriber has its own queue of at most max_queue chunks, and the producer
+    never waits on subscribers; when a subscriber's queue is full, policy decides what happens:
+        'degrade' (the default) - further chunks are merged into the last queued one, so the
+            subscriber gets all of the text but in fewer, larger pieces
+        'drop' - the subscriber is unsubscribed, and gets SubscriberDroppedException once it has
+            worked through its queue
+    Leaving the async with block cancels the stream if it is still running (through its cancel(),
+    with commit_partial), and subscribers get StreamCancelledException once they have worked
+    through their queues; use wait() first to let it finish."""
+    __slots__ = ['source', 'max_queue', 'policy', 'replay', 'commit_partial', 'finished', 'error', '_chunks',
+                 '_subscribers', '_task']
+    
+    DEGRADE = 'degrade'
+    DROP = 'drop'
+    
+    def __init__(self, source, max_queue:int=64, policy:str=DEGRADE, replay:bool=True, commit_partial:bool=False):
+        if policy not in (self.DEGRADE, self.DROP):
+            raise ValueError(f"Unknown policy: {policy}")
+        self.source = source
+        self.max_queue = max_queue
+        self.policy = policy
+        self.replay = replay
+        self.commit_partial = commit_partial
+        self.finished = False
+        self.error = None
+        self._chunks = []
+        self._subscribers = []
+        self._task = None
+    
+    @property
+    def text(self):
+        """Everything streamed so far (if replay is on)"""
+        return ''.join(self._chunks)
+    
+    def subscribe(self) -> _Subscription:
+        subscriber = _Subscription(self)
+        if self.replay and self._chunks:
+            subscriber.queue.append(self.text)
+        if not self.finished:
+            self._subscribers.append(subscriber)
+        return subscriber
+    
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._pump())
+    
+    async def _pump(self):
+        try:
+            async with contextlib.aclosing(_source_chunks(self.source, self.commit_partial)) as chunks:
+                async for chunk in chunks:
+                    if self.replay:
+                        self._chunks.append(chunk)
+                    for subscriber in list(self._subscribers):
+                        subscriber._put(chunk)
+        except asyncio.CancelledError:
+            self.error = StreamCancelledException("The stream was cancelled before it finished")
+            raise
+        except Exception as exc:
+            self.error = exc
+        finally:
+            self.finished = True
+            for subscriber in self._subscribers:
+                subscriber._wakeup.set()
+            self._subscribers.clear()
+    
+    async def wait(self):
+        """Wait for the stream to finish"""
+        self.start()
+        await asyncio.gather(self._task, return_exceptions=True)
+    
+    async def aclose(self):
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+    
+    async def __aenter__(self):
+        self.start()
+        return self
+    
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.aclose()
+
+
+def _get_coalescer(coalesce):
+    """Normalise the `coalesce` argument accepted by streamer() and friends: True for a
+    ChunkCoalescer with default settings, False/None for none, or a ChunkCoalescer instance."""
+    if coalesce is True:
+        return ChunkCoalescer()
+    return coalesce or None
+
+
+__all__ = ['ChunkCoalescer', 'StreamMultiplexer', 'StreamBroadcaster']
@@ -1,21 +1,255 @@
+from collections import deque
+from bisect import bisect_left
+from time import perf_counter
+import contextlib
+import queue
+import threading
+
+import anthropic
+try:
+    from httpx import TransportError as _TransportError
+except ImportError: # pragma: no cover
+    _TransportError = ConnectionError
+
+## Errors that mean the connection dropped partway through a response (see Bot.stream_resume_attempts)
+RESUMABLE_ERRORS = (anthropic.APIConnectionError, _TransportError, ConnectionError)
+
+
+class StreamMetrics(object):
+    """Timings for a streamed response, as time.perf_counter() values. A wrapper shares its
+    metrics with any tool-use follow-up streams it opens, so they cover the whole response.
+    Gaps between text chunks are counted into a histogram (see GAP_BUCKETS) rather than kept;
+    gaps spanning a tool phase aren't counted, since those are recorded in tool_phases."""
+    __slots__ = ['request_started', 'response_started', 'first_event', 'first_text', 'ended',
+                 'requests', 'chunks', 'gap_histogram', 'gap_total', 'gap_max', 'tool_phases', '_last_text']
+    
+    ## Upper bounds of the gap histogram buckets, in seconds; the final bucket is everything slower
+    GAP_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+    
+    def __init__(self):
+        self.request_started = self.response_started = self.first_event = self.first_text = None
+        self.ended = None
+        self.requests = 0
+        self.chunks = 0
+        self.gap_histogram = [0] * (len(self.GAP_BUCKETS) + 1)
+        self.gap_total = 0.0
+        self.gap_max = 0.0
+        self.tool_phases = []
+        self._last_text = None
+    
+    def request_start(self):
+        self.requests += 1
+        if self.request_started is None:
+            self.request_started = perf_counter()
+    
+    def response_start(self):
+        if self.response_started is None:
+            self.response_started = perf_counter()
+    
+    def text(self):
+        now = perf_counter()
+        self.chunks += 1
+        if self.first_text is None:
+            self.first_text = now
+        elif self._last_text is not None:
+            gap = now - self._last_text
+            self.gap_histogram[bisect_left(self.GAP_BUCKETS, gap)] += 1
+            self.gap_total += gap
+            if gap > self.gap_max:
+                self.gap_max = gap
+        self._last_text = now
+    
+    def tool_phase(self, tool_names, started):
+        self.tool_phases.append({'tools': tool_names, 'duration': perf_counter() - started})
+        self._last_text = None
+    
+    def end(self):
+        if self.ended is None:
+            self.ended = perf_counter()
+    
+    def _since_request(self, timestamp):
+        if timestamp is None or self.request_started is None:
+            return None
+        return timestamp - self.request_started
+    
+    @property
+    def ttft(self):
+        """Time to first token: seconds from the request being made to the first text arriving"""
+        return self._since_request(self.first_text)
+    
+    def as_dict(self):
+        """Durations in seconds, measured from the start of the request"""
+        gaps = sum(self.gap_histogram)
+        bucket_names = [f'<={int(bound * 1000)}ms' for bound in self.GAP_BUCKETS] + \
+                [f'>{int(self.GAP_BUCKETS[-1] * 1000)}ms']
+        return {
+            'requests': self.requests,
+            'time_to_response': self._since_request(self.response_started),
+            'time_to_first_event': self._since_request(self.first_event),
+            'ttft': self.ttft,
+            'duration': self._since_request(self.ended),
+            'chunks': self.chunks,
+            'gap_histogram': dict(zip(bucket_names, self.gap_histogram)),
+            'gap_mean': self.gap_total / gaps if gaps else None,
+            'gap_max': self.gap_max if gaps else None,
+            'tool_time': sum(phase['duration'] for phase in self.tool_phases),
+            'tool_phases': list(self.tool_phases),
+        }
+
+
+def _make_event_store(retain_events):
+    """None retains every event; an int N retains only the last N (so 0 retains none)"""
+    if retain_events is None:
+        return []
+    return deque(maxlen=retain_events)
+
+
+def _adopt_followup(wrapper, substream):
+    """Link a tool-use follow-up stream to the wrapper that opened it"""
+    substream.metrics = wrapper.metrics
+    substream._is_followup = True
+    substream._tool_breaks = getattr(wrapper, '_tool_breaks', False)
+    wrapper._substream = substream
+    return substream
+
+
+_READ_AHEAD_END = object()
+
+def _read_ahead(iterable, size):
+    """Iterate iterable in a background thread that stays up to size items ahead of the consumer.
+    Exceptions raised by the iterable are re-raised to the consumer in order."""
+    items = queue.Queue(maxsize=size)
+    stopping = threading.Event()
+    
+    def put(entry):
+        while not stopping.is_set():
+            try:
+                items.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+    
+    def reader():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+        except BaseException as exc:
+            put((_READ_AHEAD_END, exc))
+        else:
+            put((_READ_AHEAD_END, None))
+    
+    threading.Thread(target=reader, name='robo-stream-readahead', daemon=True).start()
+    try:
+        while True:
+            item, exc = items.get()
+            if item is _READ_AHEAD_END:
+                if exc is not None:
+                    raise exc
+                return
+            yield item
+    finally:
+        stopping.set()
+
+
+def _cancel_chain(wrapper):
+    """Mark a wrapper and any tool-use follow-up streams it has opened as cancelled, and return
+    them outermost first"""
+    chain = [wrapper]
+    while (substream := chain[-1]._substream) is not None:
+        chain.append(substream)
+    for sw in chain:
+        sw.cancelled = True
+    return chain
+
+
+def _rewind_cancelled(wrapper, chain, commit_partial):
+    """Put the conversation back into a consistent state after a cancellation: either the partial
+    text of the response that was in progress becomes the assistant's turn, or (if there is none,
+    or commit_partial is False) everything from the message that prompted the response onwards is
+    removed, so that no unanswered user turn is left behind. Returns the partial text."""
+    conv = wrapper.conversation_obj
+    innermost = chain[-1]
+    partial_text = innermost.accumulated_text
+    if commit_partial and partial_text:
+        conv._truncate_messages(innermost._mark)
+        conv.messages.append(conv._make_text_message('assistant', partial_text))
+    else:
+        conv._truncate_messages(max(wrapper._mark - 1, 0))
+    conv.tool_use_blocks.pending.clear()
+    return partial_text
+
 
 class StreamWrapper:
     suppress_append_accumulated = False
     
-    def __init__(self, stream, conversation_obj):
+    def __init__(self, stream, conversation_obj, retain_events=None):
+        """Text is accumulated in self.chunks and only joined when accumulated_text is read,
+        so that accumulation stays linear in the length of the response. retain_events
+        controls how many raw events are kept in self.events (see _make_event_store); if not
+        given, the Bot's stream_retain_events setting is used. The tool use variants also
+        total up token usage across the response and any tool-use follow-ups in self.usage."""
         self.stream = stream
         self.conversation_obj = conversation_obj
-        self.accumulated_text = ""
         self.chunks = []
-        self.events = []
+        self._accumulated = ('', 0)
+        self.usage = {}
+        self.cancelled = False
+        self._substream = None
+        self._mark = len(conversation_obj.messages)
+        self.metrics = StreamMetrics()
+        self._is_followup = False
+        self._resume_trim = False
+        if retain_events is None:
+            retain_events = getattr(conversation_obj.bot, 'stream_retain_events', None)
+        self.events = _make_event_store(retain_events)
+    
+    @property
+    def accumulated_text(self):
+        text, length = self._accumulated
+        if length != len(self.chunks):
+            self._accumulated = (text := ''.join(self.chunks), len(self.chunks))
+        return text
+    
+    @accumulated_text.setter
+    def accumulated_text(self, text):
+        self.chunks = [text] if text else []
+        self._accumulated = (text or '', len(self.chunks))
+    
+    def _add_usage(self, usage):
+        if hasattr(usage, 'model_dump'):
+            usage = usage.model_dump()
+        for key, value in usage.items():
+            if type(value) is int:
+                self.usage[key] = self.usage.get(key, 0) + value
     
     def __enter__(self):
+        self.metrics.request_start()
         self.stream_context = self.stream.__enter__()
+        self.metrics.response_start()
         return self
     
+    def cancel(self, commit_partial:bool=True) -> str:
+        """Stop the response immediately, closing the connection so that no more tokens are
+        generated. If commit_partial is set, the text received so far is kept as the assistant's
+        turn; otherwise (or if no text has been received) the prompting message is removed from the
+        conversation. Fires the response_cancelled callback and returns the partial text."""
+        chain = _cancel_chain(self)
+        for sw in chain:
+            if (stream_context := getattr(sw, 'stream_context', None)) is not None:
+                stream_context.close()
+        partial_text = _rewind_cancelled(self, chain, commit_partial)
+        self.conversation_obj._post_stream_hook()
+        def response_cancelled_callback_wrapper(callback_function):
+            callback_function(self.conversation_obj, (partial_text,))
+        self.conversation_obj._execute_callbacks('response_cancelled', response_cancelled_callback_wrapper)
+        return partial_text
+    
     def __exit__(self, exc_type, exc_val, exc_tb):
         result = self.stream.__exit__(exc_type, exc_val, exc_tb)
-        if exc_type is None and self.accumulated_text:
+        self.conversation_obj._end_streaming_tools()
+        if exc_type is None and not self.cancelled and self.accumulated_text:
             asst_message = self.conversation_obj._make_text_message('assistant', self.accumulated_text)
             if not self.suppress_append_accumulated:
                 self.conversation_obj.messages.append(asst_message)
@@ -24,63 +258,191 @@ class StreamWrapper:
                 callback_function(self.conversation_obj, (self.stream_context.get_final_message(),))
             self.conversation_obj._execute_callbacks('response_complete', response_complete_callback_wrapper)
         
+        if not self._is_followup:
+            self.metrics.end()
+            def stream_metrics_callback_wrapper(callback_function):
+                callback_function(self.conversation_obj, (self.metrics,))
+            self.conversation_obj._execute_callbacks('stream_metrics', stream_metrics_callback_wrapper)
+        
         return result
     
     @property
     def text_stream(self): # pragma: no cover
+        chunks, metrics = self.chunks, self.metrics
         for text in self.stream_context.text_stream:
-            self.chunks.append(text)
-            self.accumulated_text += text
+            chunks.append(text)
+            metrics.text()
             yield text
+            if self.cancelled:
+                return
     
     @property
     def event_stream(self):
-        for event in self.stream_context:
-            self.events.append(event)
-            yield event
+        events, metrics = self.events, self.metrics
+        attempts = getattr(self.conversation_obj.bot, 'stream_resume_attempts', 0)
+        readahead = getattr(self.conversation_obj.bot, 'stream_readahead', 0)
+        while True:
+            try:
+                for event in (_read_ahead(self.stream_context, readahead) if readahead else self.stream_context):
+                    if metrics.first_event is None:
+                        metrics.first_event = perf_counter()
+                    events.append(event)
+                    yield event
+                    if self.cancelled:
+                        return
+                return
+            except RESUMABLE_ERRORS:
+                if attempts <= 0 or self.cancelled or not self._can_resume():
+                    raise
+                attempts -= 1
+            self._reconnect()
+    
+    def _can_resume(self):
+        return True
+    
+    def _on_resume(self):
+        pass
+    
+    def _resume_request(self):
+        """Build the request that picks up where a dropped response left off: the same request,
+        with the text received so far as an assistant prefill. The prefill can't end in whitespace,
+        so any that is trimmed is also trimmed from the start of the continuation."""
+        conv = self.conversation_obj
+        received = self.accumulated_text
+        prefill = received.rstrip()
+        self._resume_trim = prefill != received
+        self._on_resume()
+        messages = conv._get_conversation_context()
+        if prefill:
+            messages = messages + [conv._make_text_message('assistant', prefill)]
+        self.metrics.request_start()
+        return conv.bot.client.messages.stream(**(conv._configure_for_message() | {'messages': messages}))
+    
+    def _reconnect(self):
+        with contextlib.suppress(Exception):
+            self.stream.__exit__(None, None, None)
+        self.stream = self._resume_request()
+        self.stream_context = self.stream.__enter__()
+
+
+class _ToolUseEventHandlers:
+    """Event handling shared by the sync and async tool-use stream wrappers. Each wrapper handles
+    a single response from the model; _event_handlers maps event types to the handler for them
+    so that the hot loop does one dict lookup per event. A handler returns text to be yielded
+    to the consumer, or None."""
+    
+    def _reset_turn(self):
+        self._current_block_type = None
+        self._current_tool_block = None
+        self._turn_context = []
+        self._text_start = 0
+        self._continuing_text = False
+    
+    def _can_resume(self):
+        """A dropped response can only be resumed if it hasn't made any tool calls, since those
+        can't be part of a prefill"""
+        return self._current_block_type != 'tool_use' and \
+            not any(block['type'] == 'tool_use' for block in self._turn_context)
+    
+    def _on_resume(self):
+        self._continuing_text = self._current_block_type == 'text'
+    
+    def _end_text_block(self):
+        self._turn_context.append({
+            'type': 'text',
+            'text': ''.join(self.chunks[self._text_start:]),
+        })
+        self._current_block_type = None
+    
+    def _end_turn(self):
+        if self._continuing_text:
+            ## Resumed with a prefill, but the model had nothing more to say
+            self._continuing_text = False
+            self._end_text_block()
+    
+    def _on_content_block_start(self, event):
+        block = event.content_block
+        if self._continuing_text:
+            self._continuing_text = False
+            if block.type == 'text':
+                return ## The continuation of the text block that was interrupted
+            self._end_text_block()
+        self._current_block_type = block.type
+        if block.type == 'text':
+            self._text_start = len(self.chunks)
+        if block.type == 'tool_use':
+            self._current_tool_block = block
+            self.conversation_obj._begin_tool_request(block)
+    
+    def _on_text(self, event):
+        text = event.text
+        if self._resume_trim:
+            if not (text := text.lstrip()):
+                return None
+            self._resume_trim = False
+        self.chunks.append(text)
+        self.metrics.text()
+        return text
+    
+    def _on_input_json(self, event):
+        self.conversation_obj._stream_tool_input(self._current_tool_block, event.partial_json, event.snapshot)
+    
+    def _on_content_block_stop(self, event):
+        block = event.content_block
+        if self._current_block_type == 'tool_use':
+            treq = {
+                'type': 'tool_use',
+                'id': block.id,
+                'name': block.name,
+                'input': block.input,
+            }
+            self.conversation_obj._add_tool_request(treq)
+            self._turn_context.append(treq)
+            self._current_block_type = None
+        elif self._current_block_type == 'text':
+            self._end_text_block()
+    
+    _event_handlers = {
+        'content_block_start': _on_content_block_start,
+        'text': _on_text,
+        'input_json': _on_input_json,
+        'content_block_stop': _on_content_block_stop,
+    }
 
 
-class StreamWrapperWithToolUse(StreamWrapper):
+class StreamWrapperWithToolUse(_ToolUseEventHandlers, StreamWrapper):
     suppress_append_accumulated = True
+    _tool_breaks = False ## If set, text_stream yields '' before and after tools run (see sse_stream)
     
     @property
     def text_stream(self):
-        
+    
         def exhaust_events(conv):
-            current_block_type = None
-            accumulated_text = ''
-            accumulated_context = []
+            self._reset_turn()
+            handlers = self._event_handlers
             ## Stream text responses, capture tool use requests
             for event in self.event_stream:
-                if event.type == 'content_block_start':
-                    current_block_type = type(event.content_block).__name__
-                elif event.type == 'text':
-                    yield event.text
-                    accumulated_text += event.text
-                    self.accumulated_text = accumulated_text
-                elif event.type == 'content_block_stop' and current_block_type == 'ToolUseBlock':
-                    treq = {
-                        'type': 'tool_use',
-                        'id': event.content_block.id,
-                        'name': event.content_block.name,
-                        'input': event.content_block.input,
-                    }
-                    conv._add_tool_request(treq)
-                    accumulated_context.append(treq)
-                elif event.type == 'content_block_stop' and current_block_type == 'TextBlock':
-                    ttxt = {
-                        'type': 'text',
-                        'text': event.content_block.text,
-                    }
-                    accumulated_context.append(ttxt)
-            conv.messages.append({'role': 'assistant', 'content': accumulated_context})
+                if (handler := handlers.get(event.type)) is not None:
+                    if (text := handler(self, event)) is not None:
+                        yield text
+            if self.cancelled:
+                return
+            self._end_turn()
+            self._add_usage(self.stream_context.get_final_message().usage)
+            conv.messages.append({'role': 'assistant', 'content': self._turn_context})
             
             def turn_complete_callback_wrapper(callback_function):
-                callback_function(conv, (accumulated_text,))
+                callback_function(conv, (self.accumulated_text,))
             conv._execute_callbacks('turn_complete', turn_complete_callback_wrapper)
-    
+            
             if not conv._is_exhausted():
+                if self._tool_breaks:
+                    yield ''
+                tools_started, tool_names = perf_counter(), conv._pending_tool_names()
                 conv._handle_pending_tool_requests()
+                self.metrics.tool_phase(tool_names, tools_started)
+                if self._tool_breaks:
+                    yield ''
                 
                 # Check for client-targeted responses first
                 msg_out = conv._handle_waiting_tool_requests()
@@ -91,28 +453,57 @@ class StreamWrapperWithToolUse(StreamWrapper):
                 else:
                     # Handle model-targeted tool responses
                     resps = conv._compile_tool_responses()
-                    with conv._resume_stream(resps, is_tool_message=True) as substream:
+                    with _adopt_followup(self, conv._resume_stream(resps, is_tool_message=True)) as substream:
                         yield from substream.text_stream
-                
+                    self._add_usage(substream.usage)
+        
         yield from exhaust_events(self.conversation_obj)
 
 
 class AsyncStreamWrapper:
-    def __init__(self, stream, conversation_obj):
+    def __init__(self, stream, conversation_obj, retain_events=None):
         self.stream = stream
         self.conversation_obj = conversation_obj
-        self.accumulated_text = ""
         self.accumulated_text_bypass = False
         self.chunks = []
-        self.events = []
+        self._accumulated = ('', 0)
+        self.usage = {}
+        self.cancelled = False
+        self._substream = None
+        self._mark = len(conversation_obj.messages)
+        self.metrics = StreamMetrics()
+        self._is_followup = False
+        self._resume_trim = False
+        if retain_events is None:
+            retain_events = getattr(conversation_obj.bot, 'stream_retain_events', None)
+        self.events = _make_event_store(retain_events)
+    
+    accumulated_text = StreamWrapper.accumulated_text
+    _add_usage = StreamWrapper._add_usage
     
     async def __aenter__(self):
+        self.metrics.request_start()
         self.stream_context = await self.stream.__aenter__()
+        self.metrics.response_start()
         return self
     
+    async def cancel(self, commit_partial:bool=True) -> str:
+        """See StreamWrapper.cancel"""
+        chain = _cancel_chain(self)
+        for sw in chain:
+            if (stream_context := getattr(sw, 'stream_context', None)) is not None:
+                await stream_context.close()
+        partial_text = _rewind_cancelled(self, chain, commit_partial)
+        await self.conversation_obj._post_stream_hook_async()
+        async def response_cancelled_callback_wrapper(callback_function):
+            await callback_function(self.conversation_obj, (partial_text,))
+        await self.conversation_obj._aexecute_callbacks('response_cancelled', response_cancelled_callback_wrapper)
+        return partial_text
+    
     async def __aexit__(self, exc_type, exc_val, exc_tb):
         result = await self.stream.__aexit__(exc_type, exc_val, exc_tb)
-        if exc_type is None and (self.accumulated_text or self.accumulated_text_bypass):
+        await self.conversation_obj._aend_streaming_tools()
+        if exc_type is None and not self.cancelled and (self.accumulated_text or self.accumulated_text_bypass):
             if not self.accumulated_text_bypass:
                 asst_message = self.conversation_obj._make_text_message('assistant', self.accumulated_text)
                 self.conversation_obj.messages.append(asst_message)
@@ -125,62 +516,98 @@ class AsyncStreamWrapper:
                 await callback_function(self.conversation_obj, (final_message,))
             await self.conversation_obj._aexecute_callbacks('response_complete', response_complete_callback_wrapper)
         
+        if not self._is_followup:
+            self.metrics.end()
+            async def stream_metrics_callback_wrapper(callback_function):
+                await callback_function(self.conversation_obj, (self.metrics,))
+            await self.conversation_obj._aexecute_callbacks('stream_metrics', stream_metrics_callback_wrapper)
+        
         return result
     
     @property
     async def text_stream(self): # pragma: no cover
+        chunks, metrics = self.chunks, self.metrics
         async for text in self.stream_context.text_stream:
-            self.chunks.append(text)
-            self.accumulated_text += text
+            chunks.append(text)
+            metrics.text()
             yield text
+            if self.cancelled:
+                return
     
     @property
     async def event_stream(self):
-        async for event in self.stream_context:
-            self.events.append(event)
-            yield event
+        events, metrics = self.events, self.metrics
+        attempts = getattr(self.conversation_obj.bot, 'stream_resume_attempts', 0)
+        while True:
+            try:
+                async for event in self.stream_context:
+                    if metrics.first_event is None:
+                        metrics.first_event = perf_counter()
+                    events.append(event)
+                    yield event
+                    if self.cancelled:
+                        return
+                return
+            except RESUMABLE_ERRORS:
+                if attempts <= 0 or self.cancelled or not self._can_resume():
+                    raise
+                attempts -= 1
+            await self._areconnect()
+    
+    _can_resume = StreamWrapper._can_resume
+    _on_resume = StreamWrapper._on_resume
+    _resume_request = StreamWrapper._resume_request
+    
+    async def _areconnect(self):
+        with contextlib.suppress(Exception):
+            await self.stream.__aexit__(None, None, None)
+        self.stream = self._resume_request()
+        self.stream_context = await self.stream.__aenter__()
 
 
-class AsyncStreamWrapperWithToolUse(AsyncStreamWrapper):
+class AsyncStreamWrapperWithToolUse(_ToolUseEventHandlers, AsyncStreamWrapper):
+    async def _aon_input_json(self, event):
+        await self.conversation_obj._astream_tool_input(self._current_tool_block, event.partial_json, event.snapshot)
+    
+    ## Handlers that need to be awaited take precedence over their sync counterparts
+    _aevent_handlers = {
+        'input_json': _aon_input_json,
+    }
+    _event_handlers = {
+        'content_block_start': _ToolUseEventHandlers._on_content_block_start,
+        'text': _ToolUseEventHandlers._on_text,
+        'content_block_stop': _ToolUseEventHandlers._on_content_block_stop,
+    }
+    
     @property
     async def text_stream(self):
-        
+    
         async def exhaust_events(conv):
-            current_block_type = None
-            accumulated_text = ''
-            accumulated_context = []
+            self._reset_turn()
+            handlers, ahandlers = self._event_handlers, self._aevent_handlers
             ## Stream text responses, capture tool use requests
             async for event in self.event_stream:
-                if event.type == 'content_block_start':
-                    current_block_type = type(event.content_block).__name__
-                elif event.type == 'text':
-                    yield event.text
-                    accumulated_text += event.text
-                elif event.type == 'content_block_stop' and current_block_type == 'ToolUseBlock':
-                    treq = {
-                        'type': 'tool_use',
-                        'id': event.content_block.id,
-                        'name': event.content_block.name,
-                        'input': event.content_block.input,
-                    }
-                    conv._add_tool_request(treq)
-                    accumulated_context.append(treq)
-                elif event.type == 'content_block_stop' and current_block_type == 'TextBlock':
-                    ttxt = {
-                        'type': 'text',
-                        'text': event.content_block.text,
-                    }
-                    accumulated_context.append(ttxt)
-            conv.messages.append({'role': 'assistant', 'content': accumulated_context})
+                if (handler := handlers.get(event.type)) is not None:
+                    if (text := handler(self, event)) is not None:
+                        yield text
+                elif (ahandler := ahandlers.get(event.type)) is not None:
+                    await ahandler(self, event)
+            if self.cancelled:
+                return
+            self._end_turn()
+            self._add_usage((await self.stream_context.get_final_message()).usage)
+            conv.messages.append({'role': 'assistant', 'content': self._turn_context})
             
             async def turn_complete_callback_wrapper(callback_function):
-                await callback_function(conv, (accumulated_text,))
+                await callback_function(conv, (self.accumulated_text,))
             await conv._aexecute_callbacks('turn_complete', turn_complete_callback_wrapper)
             
             self.accumulated_text_bypass = True
-    
+            
             if not conv._is_exhausted():
+                tools_started, tool_names = perf_counter(), conv._pending_tool_names()
                 await conv._ahandle_pending_tool_requests()
+                self.metrics.tool_phase(tool_names, tools_started)
                 msg_out = conv._handle_waiting_tool_requests()
                 if msg_out is not None:
                     resp = conv._handle_canned_response(None, (msg_out, False))
@@ -188,13 +615,14 @@ class AsyncStreamWrapperWithToolUse(AsyncStreamWrapper):
                         yield chunk
                 else:
                     resps = conv._compile_tool_responses()
-                    async with await conv._aresume_stream(resps, is_tool_message=True) as substream:
+                    async with _adopt_followup(self, await conv._aresume_stream(resps, is_tool_message=True)) as substream:
                         async for chunk in substream.text_stream:
                             yield chunk
-                
+                    self._add_usage(substream.usage)
+        
         async for chunk in exhaust_events(self.conversation_obj):
             yield chunk
 
 
 __all__ = ['StreamWrapper', 'AsyncStreamWrapper', 'StreamWrapperWithToolUse', \
-         'AsyncStreamWrapperWithToolUse']
\ No newline at end of file
+         'AsyncStreamWrapperWithToolUse']
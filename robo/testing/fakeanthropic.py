@@ -19,7 +19,7 @@ class Usage:
     input_tokens: int
     output_tokens: int
     
-    def model_dump(self):
+    def model_dump(self, **kwargs):
         return {
             'input_tokens': self.input_tokens,
             'output_tokens': self.output_tokens
@@ -31,6 +31,9 @@ class TextBlock:
     def __init__(self, text: str):
         self.text = text
         self.type = "text"
+    
+    def model_dump(self, **kwargs):
+        return {'type': self.type, 'text': self.text}
 
 
 class ToolUseBlock:
@@ -40,6 +43,9 @@ class ToolUseBlock:
         self.name = name
         self.input = input
         self.type = "tool_use"
+    
+    def model_dump(self, **kwargs):
+        return {'type': self.type, 'id': self.id, 'name': self.name, 'input': self.input}
 
 
 class StreamEvent:
@@ -68,6 +74,33 @@ class TextEvent(StreamEvent):
         self.text = text
 
 
+class InputJsonEvent(StreamEvent):
+    """Tool input JSON delta event"""
+    def __init__(self, partial_json: str, snapshot: dict):
+        super().__init__("input_json")
+        self.partial_json = partial_json
+        self.snapshot = snapshot
+
+
+def _partial_json_snapshot(partial, previous):
+    """Crude stand-in for the SDK's partial JSON parsing: try closing the object off"""
+    for closer in ['', '"}', '}', '"]}', ']}']:
+        try:
+            return json.loads(partial + closer)
+        except json.JSONDecodeError:
+            pass
+    return previous
+
+
+def _input_json_events(toolinput, chunk_size=8):
+    """Split a tool input into input_json events, chunk_size characters at a time"""
+    fulltext = json.dumps(toolinput)
+    snapshot = {}
+    for i in range(0, len(fulltext), chunk_size):
+        snapshot = _partial_json_snapshot(fulltext[:i+chunk_size], snapshot)
+        yield InputJsonEvent(fulltext[i:i+chunk_size], snapshot)
+
+
 class ContentBlockStopEvent(StreamEvent):
     """Content block stop event"""
     def __init__(self, content_block):
@@ -91,23 +124,114 @@ class FakeMessage:
         self.role = "assistant"
         self.stop_reason = "end_turn"
     
+    def model_dump(self, **kwargs):
+        return {'id': self.id, 'type': 'message', 'role': self.role, 'model': self.model,
+                'content': [block.model_dump(**kwargs) for block in self.content],
+                'stop_reason': self.stop_reason, 'stop_sequence': None, 'usage': self.usage.model_dump(**kwargs)}
+    
     def __repr__(self):
         return f'<{self.__module__}.{self.__class__.__name__}: "{self.content}">'
 
 
+class FakeFileMetadata:
+    """Mimics anthropic BetaFileMetadata"""
+    def __init__(self, filename: str, mime_type: str, size_bytes: int, expires_at: Optional[float] = None):
+        self.id = f"file_{uuid.uuid4().hex[:12]}"
+        self.type = "file"
+        self.filename = filename
+        self.mime_type = mime_type
+        self.size_bytes = size_bytes
+        self.created_at = time.time()
+        self.expires_at = expires_at
+
+
+class FakeNotFoundError(Exception):
+    """Stands in for anthropic.NotFoundError"""
+
+
+class FakeFiles:
+    """Mimics the (beta) Files API interface. Uploaded files are kept in .uploaded, by ID."""
+    
+    def __init__(self):
+        self.uploaded = {}
+        self.upload_count = 0
+    
+    def upload(self, file, expires_in_seconds: Optional[int] = None, **kwargs) -> FakeFileMetadata:
+        filename, data, mime_type = file
+        self.upload_count += 1
+        metadata = FakeFileMetadata(filename, mime_type, len(data),
+                    None if expires_in_seconds is None else time.time() + expires_in_seconds)
+        self.uploaded[metadata.id] = (metadata, bytes(data))
+        return metadata
+    
+    def retrieve_metadata(self, file_id: str, **kwargs) -> FakeFileMetadata:
+        return self._get(file_id)[0]
+    
+    def delete(self, file_id: str, **kwargs):
+        self._get(file_id)
+        del self.uploaded[file_id]
+        return {'id': file_id, 'type': 'file_deleted'}
+    
+    def list(self, **kwargs) -> List[FakeFileMetadata]:
+        return [metadata for metadata, data in self.uploaded.values()]
+    
+    def _get(self, file_id):
+        if (entry := self.uploaded.get(file_id)) is None or \
+                (entry[0].expires_at is not None and entry[0].expires_at <= time.time()):
+            raise FakeNotFoundError(f"File not found: {file_id}")
+        return entry
+    
+    def check_request(self, messages: List[Dict], kwargs: Dict):
+        """Raise if messages refer to files that don't exist, or do so without the Files API beta"""
+        for msg in messages:
+            for block in (msg.get('content') if isinstance(msg.get('content'), list) else []):
+                if isinstance(block, dict) and isinstance(source := block.get('source'), dict) and source.get('type') == 'file':
+                    if 'files-api' not in (kwargs.get('extra_headers') or {}).get('anthropic-beta', ''):
+                        raise ValueError("File sources need the files-api beta header")
+                    self._get(source['file_id'])
+
+
+class FakeAsyncFiles(FakeFiles):
+    """Mimics the async (beta) Files API interface"""
+    
+    async def upload(self, file, expires_in_seconds: Optional[int] = None, **kwargs) -> FakeFileMetadata:
+        return super().upload(file, expires_in_seconds, **kwargs)
+    
+    async def retrieve_metadata(self, file_id: str, **kwargs) -> FakeFileMetadata:
+        return super().retrieve_metadata(file_id)
+    
+    async def delete(self, file_id: str, **kwargs):
+        return super().delete(file_id)
+    
+    async def list(self, **kwargs) -> List[FakeFileMetadata]:
+        return super().list()
+
+
+class FakeBeta:
+    """Mimics the client's beta namespace"""
+    def __init__(self, files: FakeFiles):
+        self.files = files
+
+
 class FakeStreamManager:
-    """Mimics anthropic MessageStreamManager for sync streaming"""
+    """Mimics anthropic MessageStreamManager for sync streaming. If disconnect_after is set, the
+    connection "drops" (raising ConnectionResetError) after that many characters of text."""
     
-    def __init__(self, response_generator):
+    def __init__(self, response_generator, disconnect_after=None):
         self.response_generator = response_generator
+        self.disconnect_after = disconnect_after
         self._final_message = None
         self._events = []
+        self._closed = False
         
     def __enter__(self):
         return self
         
     def __exit__(self, exc_type, exc_val, exc_tb):
         return False
+    
+    def close(self):
+        self._closed = True
         
     def __iter__(self):
         content_blocks = []
@@ -124,6 +248,10 @@ class FakeStreamManager:
                 
                 # Simulate character-by-character streaming
                 for char in response_item:
+                    if self._closed:
+                        return
+                    if len(current_text) == self.disconnect_after:
+                        raise ConnectionResetError("Connection reset by peer (simulated)")
                     current_text += char
                     text_block.text = current_text
                     event = TextEvent(char)
@@ -138,7 +266,10 @@ class FakeStreamManager:
                     response_item['input']
                 )
                 content_blocks.append(tool_block)
-                yield ContentBlockStartEvent(tool_block)
+                # As with the real API, the input arrives as JSON deltas after an empty start block
+                yield ContentBlockStartEvent(ToolUseBlock(tool_block.id, tool_block.name, {}))
+                for event in _input_json_events(tool_block.input):
+                    yield event
                 yield ContentBlockStopEvent(tool_block)
         
         # Finalize any text blocks
@@ -166,16 +297,21 @@ class FakeStreamManager:
 class FakeAsyncStreamManager:
     """Mimics anthropic AsyncMessageStreamManager for async streaming"""
     
-    def __init__(self, response_generator):
+    def __init__(self, response_generator, disconnect_after=None):
         self.response_generator = response_generator
+        self.disconnect_after = disconnect_after
         self._final_message = None
         self._events = []
+        self._closed = False
         
     async def __aenter__(self):
         return self
         
     async def __aexit__(self, exc_type, exc_val, exc_tb):
         return False
+    
+    async def close(self):
+        self._closed = True
         
     async def __aiter__(self):
         content_blocks = []
@@ -192,6 +328,10 @@ class FakeAsyncStreamManager:
                 
                 # Simulate character-by-character streaming
                 for char in response_item:
+                    if self._closed:
+                        return
+                    if len(current_text) == self.disconnect_after:
+                        raise ConnectionResetError("Connection reset by peer (simulated)")
                     await asyncio.sleep(0.001)  # Small delay to simulate streaming
                     current_text += char
                     text_block.text = current_text
@@ -207,7 +347,10 @@ class FakeAsyncStreamManager:
                     response_item['input']
                 )
                 content_blocks.append(tool_block)
-                yield ContentBlockStartEvent(tool_block)
+                # As with the real API, the input arrives as JSON deltas after an empty start block
+                yield ContentBlockStartEvent(ToolUseBlock(tool_block.id, tool_block.name, {}))
+                for event in _input_json_events(tool_block.input):
+                    yield event
                 yield ContentBlockStopEvent(tool_block)
         
         # Finalize any text blocks
@@ -233,18 +376,42 @@ class FakeAsyncStreamManager:
         return self._final_message
 
 
+def _continue_from_prefill(response_content, messages):
+    """If the conversation ends with an assistant message, that's a prefill: the response should
+    carry on from where it leaves off"""
+    if not messages or messages[-1].get('role') != 'assistant':
+        return response_content
+    content = messages[-1]['content']
+    prefill = content if isinstance(content, str) else ''.join(block.get('text', '') for block in content)
+    continued = []
+    for item in response_content:
+        if prefill and isinstance(item, str):
+            consumed = item[:len(prefill)]
+            prefill = prefill[len(consumed):]
+            item = item[len(consumed):]
+            if not item:
+                continue
+        continued.append(item)
+    return continued
+
+
 class FakeMessages:
     """Mimics the messages API interface"""
     
-    def __init__(self, response_scenarios=None):
+    def __init__(self, response_scenarios=None, disconnect_after=None, files=None):
         self.response_scenarios = response_scenarios or {}
+        self.files = files or FakeFiles()
         self.call_count = 0
+        self.disconnect_after = list(disconnect_after or [])
+        self.last_messages = None
         
     def create(self, model: str, max_tokens: int, messages: List[Dict], 
                system: Optional[str] = None, temperature: float = 1.0, 
                tools: Optional[List] = None, **kwargs) -> FakeMessage:
         """Create a non-streaming response"""
         self.call_count += 1
+        self.last_messages = messages
+        self.files.check_request(messages, kwargs)
         
         # Generate response based on the last user message
         user_message_parts = []
@@ -303,8 +470,10 @@ class FakeMessages:
             user_message = ' '.join(user_message_parts)
         else:
             user_message = user_message_parts
-        response_content = self._generate_response(user_message, tools, is_tool_response)
-        return FakeStreamManager(response_content)
+        response_content = _continue_from_prefill(self._generate_response(user_message, tools, is_tool_response), messages)
+        self.last_messages = messages
+        self.files.check_request(messages, kwargs)
+        return FakeStreamManager(response_content, self.disconnect_after.pop(0) if self.disconnect_after else None)
     
     def _generate_response(self, user_message: str, tools: Optional[List] = None, is_tool_response:bool = False) -> List:
         """Generate response content based on user message and available tools"""
@@ -350,9 +519,12 @@ class FakeMessages:
 class FakeAsyncMessages:
     """Mimics the async messages API interface"""
     
-    def __init__(self, response_scenarios=None):
+    def __init__(self, response_scenarios=None, disconnect_after=None, files=None):
         self.response_scenarios = response_scenarios or {}
+        self.files = files or FakeFiles()
         self.call_count = 0
+        self.disconnect_after = list(disconnect_after or [])
+        self.last_messages = None
         
     async def create(self, model: str, max_tokens: int, messages: List[Dict], 
                      system: Optional[str] = None, temperature: float = 1.0, 
@@ -360,6 +532,8 @@ class FakeAsyncMessages:
         """Create a non-streaming response"""
         await asyncio.sleep(0.01)  # Simulate network delay
         self.call_count += 1
+        self.last_messages = messages
+        self.files.check_request(messages, kwargs)
         
         # Generate response based on the last user message
         user_message_parts = []
@@ -418,8 +592,10 @@ class FakeAsyncMessages:
             user_message = ' '.join(user_message_parts)
         else:
             user_message = user_message_parts
-        response_content = self._generate_response(user_message, tools, is_tool_response)
-        return FakeAsyncStreamManager(response_content)
+        response_content = _continue_from_prefill(self._generate_response(user_message, tools, is_tool_response), messages)
+        self.last_messages = messages
+        self.files.check_request(messages, kwargs)
+        return FakeAsyncStreamManager(response_content, self.disconnect_after.pop(0) if self.disconnect_after else None)
     
     def _generate_response(self, user_message: str, tools: Optional[List] = None, is_tool_response:bool = False) -> List:
         """Generate response content based on user message and available tools"""
@@ -465,9 +641,13 @@ class FakeAsyncMessages:
 class FakeAnthropic:
     """Fake Anthropic client for testing"""
     
-    def __init__(self, api_key: str = "fake-key", response_scenarios: Optional[Dict] = None):
+    def __init__(self, api_key: str = "fake-key", response_scenarios: Optional[Dict] = None,
+                 disconnect_after: Optional[List[int]] = None):
+        """disconnect_after injects connection drops: the Nth streaming request made drops after
+        disconnect_after[N] characters of text (None for no drop)"""
         self.api_key = api_key
-        self.messages = FakeMessages(response_scenarios)
+        self.beta = FakeBeta(FakeFiles())
+        self.messages = FakeMessages(response_scenarios, disconnect_after, self.beta.files)
     
     def __repr__(self):
         return f"<FakeAnthropic(api_key='{self.api_key}')>"
@@ -476,9 +656,13 @@ class FakeAnthropic:
 class FakeAsyncAnthropic:
     """Fake AsyncAnthropic client for testing"""
     
-    def __init__(self, api_key: str = "fake-key", response_scenarios: Optional[Dict] = None):
+    def __init__(self, api_key: str = "fake-key", response_scenarios: Optional[Dict] = None,
+                 disconnect_after: Optional[List[int]] = None):
+        """disconnect_after injects connection drops: the Nth streaming request made drops after
+        disconnect_after[N] characters of text (None for no drop)"""
         self.api_key = api_key
-        self.messages = FakeAsyncMessages(response_scenarios)
+        self.beta = FakeBeta(FakeAsyncFiles())
+        self.messages = FakeAsyncMessages(response_scenarios, disconnect_after, self.beta.files)
     
     def __repr__(self):
         return f"<FakeAsyncAnthropic(api_key='{self.api_key}')>"
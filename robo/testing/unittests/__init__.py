@@ -1,11 +1,16 @@
 import pytest
 import json
+import base64
+import hashlib
+import zlib
 import os
 import asyncio
 import anthropic
 from unittest.mock import Mock, patch, AsyncMock, mock_open
 import contextlib
 import tempfile
+import time
+import threading
 from datetime import datetime
 
 import robo
@@ -14,9 +19,17 @@ from robo.exceptions import *
 from robo.tools import *
 from robo.testing.fakeanthropic import *
 from robo.streamwrappers import StreamWrapper, AsyncStreamWrapper
+from robo.logstore import FileLogStore, SQLiteLogStore
+from robo.logwriter import LogWriter
+from robo.logindex import LogIndex
+from robo.attachments import Attachment, FileBlobStore, EncodedAttachmentCache, encoded_attachments, b64encode
+from robo.fileuploads import FileUploadCache, uploaded_files
+from robo.images import ImagePipeline
 
 from io import StringIO, BytesIO
 from types import SimpleNamespace
+from collections import defaultdict
+from pathlib import Path
 
 
 class ToolTesterBot(Bot):
@@ -308,6 +321,23 @@ class TestMisc:
         tcount = conv.count_tokens('hello everybody')
         assert tcount.input_tokens < 15 and tcount.input_tokens > 5
         assert len(conv.messages) == 0
+    
+    def test_count_tokens_changes_nothing(self):
+        uploaded_files.invalidate()
+        client = fake_client()
+        client.messages.count_tokens = Mock(return_value=SimpleNamespace(input_tokens=10))
+        conv = Conversation(TestFileHandling.UploadingBot(client=client), [])
+        conv.resume('one', with_files=[('application/pdf', b'first', 'document')])
+        uploaded_files.invalidate() ## So that the history's attachment would need uploading again too
+        uploads = client.beta.files.upload_count
+        attachments = dict(conv._attachments)
+        assert conv.count_tokens('two', with_files=[('application/pdf', b'second', 'document')]).input_tokens == 10
+        assert client.beta.files.upload_count == uploads and conv._attachments == attachments
+        assert len(conv.messages) == 2 and uploaded_files.lookup(client, next(iter(attachments))) is None
+        messages = client.messages.count_tokens.call_args.kwargs['messages']
+        assert [messages[i]['content'][0]['source'] for i in (0, 2)] == [
+            {'type': 'base64', 'media_type': 'application/pdf', 'data': 'Zmlyc3Q='},
+            {'type': 'base64', 'media_type': 'application/pdf', 'data': 'c2Vjb25k'}]
 
 
 class TestLoggedConversation:
@@ -388,6 +418,356 @@ class TestLoggedConversation:
         assert len(loggedconv2.messages) == 6
         assert repr(loggedconv1) == repr(loggedconv2)
     
+    @staticmethod
+    def _journal(loggedconv):
+        with open(loggedconv._log_state.logdir / 'journal.jsonl') as journal:
+            return [json.loads(line) for line in journal]
+    
+    def test_journal_appends_only_new_messages(self):
+        bot = Bot(client=fake_client())
+        with tempfile.TemporaryDirectory() as tmpdir:
+            loggedconv = LoggedConversation(bot, logs_dir=tmpdir).prestart([])
+            loggedconv.resume('one')
+            loggedconv.resume('two')
+            records = self._journal(loggedconv)
+            assert [r['type'] for r in records] == ['header'] + ['message'] * 4
+            assert [r['index'] for r in records[1:]] == [0, 1, 2, 3]
+            assert records[3]['message'] == loggedconv.messages[2]
+            assert not (loggedconv._log_state.logdir / 'snapshot.json').exists()
+    
+    def test_journal_compaction(self):
+        bot = Bot(client=fake_client())
+        with tempfile.TemporaryDirectory() as tmpdir:
+            loggedconv = LoggedConversation(bot, log_store=FileLogStore(tmpdir, compact_threshold=6)).prestart([])
+            for message in ['one', 'two', 'three', 'four']:
+                loggedconv.resume(message)
+            logdir = loggedconv._log_state.logdir
+            with open(logdir / 'snapshot.jsonl') as snapshot:
+                header, *messages = [json.loads(line) for line in snapshot]
+            assert header['length'] == 6 and len(messages) == 6
+            assert [r['type'] for r in self._journal(loggedconv)] == ['header', 'message', 'message']
+            revived = LoggedConversation.revive(bot, conversation_id=loggedconv.conversation_id, logs_dir=tmpdir)
+            assert revived.messages == loggedconv.messages
+            revived.resume('five')
+            assert len(LoggedConversation.revive(bot, loggedconv.conversation_id, tmpdir).messages) == 10
+    
+    def test_journal_records_truncation(self):
+        bot = Bot(client=fake_client())
+        with tempfile.TemporaryDirectory() as tmpdir:
+            loggedconv = LoggedConversation(bot, logs_dir=tmpdir, stream=True).prestart([])
+            with loggedconv.resume('one') as stream:
+                for chunk in stream.text_stream:
+                    pass
+            with loggedconv.resume('two') as stream:
+                next(iter(stream.text_stream))
+                stream.cancel(commit_partial=False)
+            loggedconv._write_log()
+            assert self._journal(loggedconv)[-1] == {'type': 'truncate', 'length': 2}
+            revived = LoggedConversation.revive(bot, loggedconv.conversation_id, tmpdir, stream=True)
+            assert revived.messages == loggedconv.messages and len(revived.messages) == 2
+    
+    def test_failed_log_write_is_resent(self):
+        class FlakyLogStore(FileLogStore):
+            failures = 1
+            
+            def commit(self, writes, sync=False):
+                if self.failures and any(r['type'] == 'message' and r['index'] == 2
+                            for write in writes for r in write.payload.records):
+                    self.failures -= 1
+                    raise OSError("Disk full")
+                super().commit(writes, sync)
+        bot = Bot(client=fake_client())
+        with tempfile.TemporaryDirectory() as tmpdir:
+            store = FlakyLogStore(tmpdir)
+            loggedconv = LoggedConversation(bot, log_store=store).prestart([])
+            loggedconv.resume('one')
+            with pytest.raises(OSError):
+                loggedconv.resume('two')
+            loggedconv.resume('three')
+            assert len(loggedconv.messages) == 6
+            revived = LoggedConversation.revive(bot, loggedconv.conversation_id, log_store=FileLogStore(tmpdir))
+            assert revived.messages == loggedconv.messages
+            
+            ## A log with messages missing from it is reported rather than half-loaded
+            journal = loggedconv._log_state.logdir / 'journal.jsonl'
+            records = [json.loads(line) for line in open(journal)]
+            with open(journal, 'w') as writer:
+                writer.writelines(json.dumps(r) + '\n' for r in records if r.get('index') != 3)
+            with pytest.raises(CorruptLogException):
+                LoggedConversation.revive(bot, loggedconv.conversation_id, log_store=FileLogStore(tmpdir))
+    
+    def test_revive_legacy_log(self):
+        bot = Bot(client=fake_client())
+        with tempfile.TemporaryDirectory() as tmpdir:
+            conv = Conversation(bot, [])
+            conv.resume('one')
+            logdir = Path(tmpdir) / f"{int(time.time()/10):x}__legacy-id"
+            logdir.mkdir()
+            with open(logdir / 'conversation.json', 'w') as logfile:
+                json.dump({'when': '', 'with': 'Bot', 'argv': [], 'messages': conv.messages}, logfile, indent=4)
+            revived = LoggedConversation.revive(bot, 'legacy-id', tmpdir)
+            revived.resume('two')
+            assert revived._log_state.logdir == logdir
+            (entry,) = LoggedConversation.list_conversations(tmpdir)
+            assert entry.path == logdir.name and entry.message_count == 4
+            with patch('os.listdir', side_effect=AssertionError("Directory scanned")):
+                revived = LoggedConversation.revive(bot, 'legacy-id', tmpdir)
+            assert len(revived.messages) == 4
+    
+    def test_sharded_layout_and_index(self):
+        class OtherBot(Bot):
+            pass
+        with tempfile.TemporaryDirectory() as tmpdir:
+            convs = [LoggedConversation(botclass(client=fake_client()), logs_dir=tmpdir).prestart([])
+                        for botclass in [Bot, Bot, OtherBot]]
+            for conv in convs:
+                conv.resume('one')
+            convs[0].resume('two')
+            logdir = convs[0]._log_state.logdir
+            assert logdir.parent.parent.parent == Path(tmpdir) and logdir.name == convs[0].conversation_id
+            assert len(os.listdir(tmpdir)) <= 4 ## Up to three shards and the index
+            entries = LoggedConversation.list_conversations(tmpdir)
+            assert [e.conversation_id for e in entries][0] == convs[0].conversation_id
+            assert {e.conversation_id: e.message_count for e in entries} == {c.conversation_id: len(c.messages) for c in convs}
+            assert [e.conversation_id for e in LoggedConversation.list_conversations(tmpdir, bot=OtherBot)] == [convs[2].conversation_id]
+            assert len(LoggedConversation.list_conversations(tmpdir, bot='Bot', since=entries[-1].updated)) == 2
+            assert LoggedConversation.list_conversations(tmpdir, until=entries[-1].updated - 1) == []
+            with patch('os.listdir', side_effect=AssertionError("Directory scanned")):
+                revived = LoggedConversation.revive(Bot(client=fake_client()), convs[1].conversation_id, tmpdir)
+            assert revived.messages == convs[1].messages
+            assert revived.first_saved_at == convs[1].first_saved_at
+            
+            index = LogIndex(tmpdir)
+            index.lookup(convs[0].conversation_id)
+            with patch.object(LogIndex, '_SCHEMA', 'Not SQL'): ## The schema is only created once
+                index.record('another-id', 'x', None, time.time(), 'Bot', 0)
+                assert len(index.conversations()) == 4
+    
+    def test_async_logging_off_event_loop(self):
+        bot = Bot(client=fake_client_async())
+        writer_threads = []
+        append_journal = FileLogStore._append_journal
+        def recording_append(*args):
+            writer_threads.append(threading.current_thread())
+            append_journal(*args)
+        with tempfile.TemporaryDirectory() as tmpdir, \
+                patch.object(FileLogStore, '_append_journal', recording_append):
+            async def run():
+                loggedconv = LoggedConversation(bot, logs_dir=tmpdir, async_mode=True).prestart([])
+                await loggedconv.aresume('one')
+                assert len(self._journal(loggedconv)) == 3 ## Durable once aresume returns
+                revived = await LoggedConversation.arevive(bot, loggedconv.conversation_id, tmpdir, async_mode=True)
+                assert revived.messages == loggedconv.messages
+            asyncio.run(run())
+        assert writer_threads and threading.main_thread() not in writer_threads
+    
+    def test_async_logging_batched(self):
+        bot = Bot(client=fake_client_async())
+        with tempfile.TemporaryDirectory() as tmpdir:
+            async def run():
+                loggedconv = LoggedConversation(bot, logs_dir=tmpdir, async_mode=True, stream=True,
+                            log_durability='batched').prestart([])
+                for message in ['one', 'two']:
+                    async with await loggedconv.aresume(message) as stream:
+                        async for chunk in stream.text_stream:
+                            pass
+                await loggedconv.aflush_log()
+                assert loggedconv._log_pending == []
+                return loggedconv
+            loggedconv = asyncio.run(run())
+            assert len(LoggedConversation.revive(bot, loggedconv.conversation_id, tmpdir).messages) == 4
+        with pytest.raises(ValueError):
+            LoggedConversation(bot, logs_dir='.', log_durability='sometimes')
+    
+    def test_sqlite_log_store(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            store = SQLiteLogStore(Path(tmpdir) / 'logs.db')
+            loggedconv = LoggedConversation(Bot(client=fake_client()), log_store=store, stream=True).prestart([])
+            for message in ['one', 'two']:
+                with loggedconv.resume(message) as stream:
+                    for chunk in stream.text_stream:
+                        pass
+            with loggedconv.resume('three') as stream:
+                next(iter(stream.text_stream))
+                stream.cancel(commit_partial=False)
+            loggedconv._write_log()
+            revived = LoggedConversation.revive(Bot(client=fake_client()), loggedconv.conversation_id, log_store=store)
+            assert revived.messages == loggedconv.messages and len(revived.messages) == 4
+            revived.resume('four')
+            (entry,) = LoggedConversation.list_conversations(log_store=store, bot=Bot)
+            assert entry.conversation_id == loggedconv.conversation_id and entry.message_count == 6
+            assert LoggedConversation.list_conversations(log_store=store, bot='OtherBot') == []
+            with pytest.raises(UnknownConversationException):
+                LoggedConversation.revive(Bot, 'INVALID', log_store=store)
+            store.close()
+    
+    def test_sqlite_log_store_async_and_concurrent(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            store = SQLiteLogStore(Path(tmpdir) / 'logs.db')
+            async def run():
+                convs = [LoggedConversation(Bot(client=fake_client_async()), log_store=store, async_mode=True).prestart([])
+                            for i in range(8)]
+                await asyncio.gather(*[conv.aresume('one') for conv in convs])
+                revived = await LoggedConversation.arevive(Bot(client=fake_client_async()), convs[0].conversation_id,
+                            log_store=store, async_mode=True)
+                assert revived.messages == convs[0].messages
+                return convs
+            convs = asyncio.run(run())
+            def chat(conv):
+                conv = LoggedConversation.revive(Bot(client=fake_client()), conv.conversation_id, log_store=store)
+                for message in ['two', 'three']:
+                    conv.resume(message)
+            threads = [threading.Thread(target=chat, args=(conv,)) for conv in convs]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            entries = LoggedConversation.list_conversations(log_store=store)
+            assert sorted(e.message_count for e in entries) == [6] * 8
+            store.close()
+    
+    def _check_tail_revive(self, bot, log_store):
+        loggedconv = LoggedConversation(bot, log_store=log_store).prestart([])
+        for message in ['one', 'two', 'three', 'four', 'five']:
+            loggedconv.resume(message)
+        expected = list(loggedconv.messages)
+        conversation_id = loggedconv.conversation_id
+        tailconv = LoggedConversation.revive(bot, conversation_id, log_store=log_store, tail=2)
+        assert tailconv.history_offset == 6
+        assert tailconv.messages == expected[6:]
+        assert tailconv.messages[0]['content'] == [{'type': 'text', 'text': 'four'}]
+        tailconv.resume('six')
+        assert bot.client.messages.last_messages[0]['content'][0]['text'] == 'four'
+        expected += tailconv.messages[-2:]
+        assert LoggedConversation.revive(bot, conversation_id, log_store=log_store).messages == expected
+        assert tailconv.load_earlier_history(2) == 4
+        assert tailconv.history_offset == 2
+        assert tailconv.messages == expected[2:]
+        assert tailconv.load_earlier_history(5) == 2
+        assert tailconv.load_earlier_history() == 0
+        assert tailconv.messages == expected
+        tailconv.resume('seven')
+        assert LoggedConversation.revive(bot, conversation_id, log_store=log_store).messages == tailconv.messages
+        return conversation_id
+    
+    def test_tail_revive(self):
+        bot = Bot(client=fake_client())
+        with tempfile.TemporaryDirectory() as tmpdir:
+            ## A low compact_threshold means the tail is read (backwards) from a snapshot, and that
+            ## compacting a conversation revived with tail keeps the messages it didn't load
+            log_store = FileLogStore(tmpdir, compact_threshold=4)
+            conversation_id = self._check_tail_revive(bot, log_store)
+            assert (log_store._find_logdir(conversation_id)[0] / 'snapshot.jsonl').exists()
+            self._check_tail_revive(bot, SQLiteLogStore(Path(tmpdir) / 'logs.sqlite'))
+            tailconv = LoggedConversation.revive(bot, conversation_id, log_store=log_store, tail=100)
+            assert tailconv.history_offset == 0
+    
+    def test_tail_revive_async(self):
+        bot = Bot(client=fake_client_async())
+        with tempfile.TemporaryDirectory() as tmpdir:
+            loggedconv = LoggedConversation(bot, logs_dir=tmpdir, async_mode=True).prestart([])
+            async def run():
+                for message in ['one', 'two', 'three']:
+                    await loggedconv.aresume(message)
+                await loggedconv.aflush_log()
+                tailconv = await LoggedConversation.arevive(bot, loggedconv.conversation_id, tmpdir, tail=1,
+                            async_mode=True)
+                assert tailconv.messages == loggedconv.messages[4:]
+                assert await tailconv.aload_earlier_history(2) == 4
+                assert tailconv.messages == loggedconv.messages
+            asyncio.run(run())
+    
+    def test_attachments_stored_once(self):
+        payload = bytes(range(256)) * 64
+        filespec = ('image/png', payload, 'image')
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for store in [FileLogStore(tmpdir), SQLiteLogStore(Path(tmpdir) / 'logs.db')]:
+                convs = [LoggedConversation(Bot(client=fake_client()), log_store=store).prestart([]) for i in range(2)]
+                for conv in convs:
+                    conv.resume('one', with_files=[filespec])
+                    conv.resume('two', with_files=[filespec])
+                if isinstance(store, FileLogStore):
+                    journal = (convs[0]._log_state.logdir / 'journal.jsonl').read_text()
+                    assert base64.b64encode(payload).decode('utf-8') not in journal and 'robo_blob' in journal
+                    assert len(list((Path(tmpdir) / 'blobs').rglob('*'))) == 2 ## One shard directory and one blob
+                client = fake_client()
+                revived = LoggedConversation.revive(Bot(client=client), convs[0].conversation_id, log_store=store)
+                assert revived.messages[0]['content'][0] == convs[0].messages[0]['content'][0]
+                assert revived.messages[0]['content'][0]['source']['type'] == 'robo_blob'
+                assert revived._attachments == {}
+                encoded_attachments.clear() ## So that the attachment is read back from the store
+                revived.resume('three')
+                sent = client.messages.last_messages
+                assert sent[0]['content'][0]['source'] == {'type': 'base64', 'media_type': 'image/png',
+                            'data': base64.b64encode(payload).decode('utf-8')}
+                assert sent[2]['content'][0]['source']['data'] == base64.b64encode(payload).decode('utf-8')
+    
+    def test_group_commit(self):
+        writer = LogWriter()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            store = FileLogStore(tmpdir)
+            convs = [LoggedConversation(Bot(client=fake_client()), log_store=store, log_writer=writer,
+                        log_durability='batched').prestart([]) for i in range(5)]
+            started, release = threading.Event(), threading.Event()
+            writer.submit(lambda: started.set() or release.wait())
+            started.wait()
+            for conv in convs:
+                conv.resume('one')
+                conv.resume('two')
+            assert writer.metrics()['queue_depth'] == 10
+            commit = FileLogStore.commit
+            with patch.object(FileLogStore, 'commit', autospec=True, side_effect=commit) as mock_commit, \
+                    patch.object(LogIndex, 'record_many', autospec=True, side_effect=LogIndex.record_many) as mock_index:
+                release.set()
+                for conv in convs:
+                    conv.flush_log()
+            assert mock_commit.call_count == 1 and len(mock_commit.call_args.args[1]) == 10
+            assert mock_index.call_count == 1
+            metrics = writer.metrics()
+            assert (metrics['batches'], metrics['writes'], metrics['queue_depth']) == (2, 11, 0)
+            assert metrics['max_flush_latency'] > 0 and metrics['mean_batch_size'] == 5.5
+            for conv in convs:
+                records = [json.loads(line) for line in open(conv._log_state.logdir / 'journal.jsonl')]
+                assert [r['type'] for r in records] == ['header'] + ['message'] * 4
+                assert LoggedConversation.revive(Bot, conv.conversation_id, tmpdir).messages == conv.messages
+    
+    def test_log_writer_failure_in_background(self):
+        class FailingOnceLogStore(FileLogStore):
+            failures = 1
+            
+            def commit(self, writes, sync=False):
+                if self.failures and any(r.get('index') == 2 for write in writes for r in write.payload.records):
+                    self.failures -= 1
+                    raise OSError("Disk full")
+                super().commit(writes, sync)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            writer = LogWriter()
+            conv = LoggedConversation(Bot(client=fake_client()), log_store=FailingOnceLogStore(tmpdir),
+                        log_writer=writer, log_durability='batched').prestart([])
+            conv.resume('one')
+            writer.flush()
+            conv.resume('two')
+            writer.flush()
+            assert writer.metrics()['failed_writes'] == 1
+            conv.resume('three')
+            writer.flush()
+            revived = LoggedConversation.revive(Bot, conv.conversation_id, log_store=FileLogStore(tmpdir))
+            assert revived.messages == conv.messages and len(revived.messages) == 6
+            with pytest.raises(OSError):
+                conv.flush_log()
+    
+    def test_log_writer_fsync(self):
+        with tempfile.TemporaryDirectory() as tmpdir, patch('os.fsync') as mock_fsync:
+            conv = LoggedConversation(Bot(client=fake_client()), logs_dir=tmpdir,
+                        log_writer=LogWriter(durability='fsync', flush_interval=0.01)).prestart([])
+            conv.resume('one', with_files=[('image/png', b'1234567890', 'image')])
+            assert mock_fsync.call_count == 2 ## The journal and the blob
+            conv = LoggedConversation(Bot(client=fake_client()), logs_dir=tmpdir).prestart([])
+            conv.resume('one')
+            assert mock_fsync.call_count == 2
+        with pytest.raises(ValueError):
+            LogWriter(durability='eventually')
+    
     def test_lc_other(self):
         with pytest.raises(Exception, match='logs_dir required'):
             loggedconv1 = LoggedConversation(Bot)
@@ -419,6 +799,67 @@ class TestUtils:
             msgtext = sio.read()
             assert msgtext.startswith("I understand you said: 'test input'")
     
+    def test_chunk_coalescer(self):
+        from robo.streamutils import ChunkCoalescer
+        coalescer = ChunkCoalescer(max_chars=5, max_delay=60)
+        assert list(coalescer.coalesce('abcdefghijk')) == ['abcde', 'fghij', 'k']
+        assert list(coalescer.coalesce(['Hi', '.', ' How', ' are', ' you?', ' Fine'])) == \
+            ['Hi.', ' How are', ' you?', ' Fine']
+        coalescer = ChunkCoalescer(max_delay=0)
+        assert coalescer.push('a') == 'a'
+        assert coalescer.flush() == ''
+    
+    def test_streamer_coalesced_writes(self):
+        for coalesce, expected_writes in [(False, 'many'), (True, 'few')]:
+            sink = Mock(wraps=StringIO())
+            conv = Conversation(Bot(client=create_fake_client()), [], stream=True)
+            with patch('builtins.print'):
+                streamer(conv, cc=sink, coalesce=coalesce)('test input')
+            text = ''.join(call.args[0] for call in sink.write.call_args_list)
+            assert text.startswith("I understand you said: 'test input'")
+            if expected_writes == 'many':
+                assert sink.write.call_count == len(text)
+            else:
+                assert sink.write.call_count < len(text) / 10
+    
+    def test_streamer_coalesced_flushes(self):
+        from robo.streamutils import ChunkCoalescer
+        class CheckingBot(Bot):
+            class Check(Tool):
+                description = 'Check something'
+                parameter_descriptions = {}
+                
+                def __call__(self):
+                    written.append(sink.getvalue())
+                    return 'checked'
+            
+            tools = [Check]
+        scenario = {'check': ['Let me check', {'type': 'tool_use', 'id': 'toolu_1', 'name': 'Check', 'input': {}}]}
+        for client, make_streamer in [(FakeAnthropic, streamer), (FakeAsyncAnthropic, streamer_async)]:
+            written, sink = [], StringIO()
+            conv = Conversation(CheckingBot(client=client(response_scenarios=scenario)), [], stream=True,
+                        async_mode=client is FakeAsyncAnthropic)
+            say = make_streamer(conv, cc=sink, coalesce=ChunkCoalescer(max_delay=60))
+            with patch('builtins.print'):
+                if client is FakeAsyncAnthropic:
+                    asyncio.run(say('check'))
+                else:
+                    say('check')
+            assert written == ['Let me check']
+            assert sink.getvalue() == "Let me checkTool response was:['checked']"
+            assert conv._lookup_callbacks('turn_complete') == []
+        
+        sink = StringIO()
+        conv = Conversation(Bot(client=FakeAnthropic(disconnect_after=[5])), [], stream=True)
+        say = streamer(conv, cc=sink, coalesce=ChunkCoalescer(max_delay=60))
+        with patch('builtins.print'):
+            with pytest.raises(ConnectionResetError):
+                say('hello')
+            assert sink.getvalue() == 'Hello'
+            sink.truncate(0), sink.seek(0)
+            say('test input')
+        assert sink.getvalue().startswith("I understand you said")
+    
     def test_getjson(self):
         bot = Bot(client=fake_client())
         conv = Conversation(bot, [])
@@ -469,6 +910,239 @@ class TestFileHandling:
         with patch('builtins.open', mock_open(read_data=b'1234567890')):
             seg = Conversation._compile_user_message('test_input', with_files=['/tmp/xyz.png'])
             assert seg == {'role': 'user', 'content': [{'type': 'image', 'source': {'type': 'base64', 'media_type': 'image/png', 'data': 'MTIzNDU2Nzg5MA=='}}, {'type': 'text', 'text': 'test_input'}]}
+    
+    def test_attachments_encoded_lazily(self):
+        encoded_attachments.clear()
+        misses = encoded_attachments.misses
+        payload = os.urandom(3000)
+        expected = {'type': 'base64', 'media_type': 'image/png', 'data': base64.b64encode(payload).decode('utf-8')}
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filepath = Path(tmpdir) / 'picture.png'
+            filepath.write_bytes(payload)
+            clients = [fake_client() for i in range(3)]
+            convs = [Conversation(Bot(client=client), []) for client in clients]
+            convs[0].resume('one', with_files=[filepath])
+            convs[1].resume('two', with_files=[('image/png', memoryview(payload), 'image')])
+            convs[2].resume('three', with_files=[('image/png', bytearray(payload), 'image')])
+            for conv, client in zip(convs, clients):
+                source = conv.messages[0]['content'][0]['source']
+                assert source == {'type': 'robo_blob', 'media_type': 'image/png', 'digest': 'sha256:' + hashlib.sha256(payload).hexdigest()}
+                assert client.messages.last_messages[0]['content'][0]['source'] == expected
+            assert encoded_attachments.misses == misses + 1 ## Encoded once for all three conversations
+            assert isinstance(convs[0]._attachments[source['digest']].source, Path)
+            with pytest.raises(ValueError, match='blob store is needed'):
+                convs[0].snapshot()
+            blobs = FileBlobStore(Path(tmpdir) / 'blobs')
+            snapshot = convs[0].snapshot(blobs)
+            assert len(snapshot) < len(payload) and source['digest'] in blobs ## Only the digest is in the snapshot
+            with pytest.raises(ValueError, match='missing from the blob store'):
+                Conversation.restore(Bot(client=fake_client()), snapshot)
+            restored = Conversation.restore(Bot(client=fake_client()), snapshot, blobs=blobs)
+            assert restored._load_attachment(source['digest']) == payload
+            encoded_attachments.clear()
+            restored.resume('five')
+            assert restored.bot.client.messages.last_messages[0]['content'][0]['source'] == expected
+            filepath.write_bytes(b'something else')
+            encoded_attachments.clear()
+            with pytest.raises(ValueError, match='changed since it was attached'):
+                convs[0].resume('four')
+    
+    def test_chunked_base64(self):
+        chunk = robo.attachments.ENCODE_CHUNK_SIZE
+        for size in [0, 1, 2, 3, chunk - 1, chunk, chunk + 1, 2 * chunk + 2]:
+            data = os.urandom(size)
+            expected = base64.b64encode(data).decode('ascii')
+            hasher = hashlib.sha256()
+            assert b64encode(data, hasher) == expected and hasher.digest() == hashlib.sha256(data).digest()
+            assert b64encode(bytearray(data)) == expected
+            assert b64encode(memoryview(b'xx' + data)[2:]) == expected
+        segment = Conversation._make_message_file_segment(('image/png', memoryview(b'1234567890'), 'image'))
+        assert segment['source']['data'] == 'MTIzNDU2Nzg5MA=='
+    
+    def test_attachment_encoding_memory(self):
+        import tracemalloc
+        payload = os.urandom(4 * 1024 * 1024)
+        encoded_size = len(base64.b64encode(payload))
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filepath = Path(tmpdir) / 'large.pdf'
+            filepath.write_bytes(payload)
+            (Path(tmpdir) / 'empty.pdf').write_bytes(b'')
+            assert Attachment(Path(tmpdir) / 'empty.pdf').encode() == ''
+            attachment = Attachment(filepath)
+            del payload
+            tracemalloc.start()
+            try:
+                encoded = attachment.encode()
+                peak = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+            ## The output buffer and the string made from it, but not the file's contents
+            assert len(encoded) == encoded_size and peak < 2.1 * encoded_size
+    
+    class RecordingPipeline:
+        """Stands in for an ImagePipeline, for checking how conversations use one"""
+        def __init__(self):
+            self.calls = []
+        def process_file(self, filething, media_type):
+            self.calls.append(filething)
+            return (filething if filething.startswith(b'small:') else b'small:' + filething), 'image/webp'
+    
+    def test_image_pipeline_applied_to_images(self):
+        pipeline = self.RecordingPipeline()
+        class ImageBot(Bot):
+            image_pipeline = pipeline
+        client = fake_client()
+        conv = Conversation(ImageBot(client=client), [])
+        assert conv.image_pipeline is pipeline
+        conv.resume('look', with_files=[('image/png', b'picture', 'image'), ('application/pdf', b'doc', 'document')])
+        sent = client.messages.last_messages[0]['content']
+        assert sent[0]['source']['media_type'] == 'image/webp'
+        assert base64.b64decode(sent[0]['source']['data']) == b'small:picture'
+        assert base64.b64decode(sent[1]['source']['data']) == b'doc'
+        assert pipeline.calls == [b'picture']
+        async_client = fake_client_async()
+        aconv = Conversation(ImageBot(client=async_client), [], async_mode=True)
+        asyncio.run(aconv.aresume('look', with_files=[('image/png', b'picture', 'image')]))
+        assert base64.b64decode(async_client.messages.last_messages[0]['content'][0]['source']['data']) == b'small:picture'
+    
+    def test_image_pipeline_needs_pillow(self):
+        with patch('robo.images.Image', None):
+            with pytest.raises(ImportError, match='Pillow'):
+                ImagePipeline()
+    
+    def test_image_pipeline(self):
+        Image = pytest.importorskip('PIL.Image')
+        photo = Image.new('RGB', (4000, 3000), (200, 120, 40))
+        exif = Image.Exif()
+        exif[0x010F] = 'Camera Maker' ## Make
+        original = BytesIO()
+        photo.save(original, format='JPEG', quality=95, exif=exif)
+        original = original.getvalue()
+        pipeline = ImagePipeline(quality=70)
+        data, media_type = pipeline.process(original, 'image/jpeg')
+        assert media_type == 'image/jpeg' and len(data) < len(original)
+        with Image.open(BytesIO(data)) as processed:
+            assert max(processed.size) <= 1568 and processed.size[0] * processed.size[1] <= 1_150_000
+            assert processed.size[0] / processed.size[1] == pytest.approx(4 / 3, rel=0.01)
+            assert not processed.getexif()
+        assert pipeline.process(original, 'image/jpeg') is pipeline.process(original, 'image/jpeg')
+        assert pipeline.process(data, 'image/jpeg')[0] == data ## Processing is idempotent
+        assert pipeline.process(b'%PDF', 'application/pdf') == (b'%PDF', 'application/pdf')
+        transparent = BytesIO()
+        Image.new('RGBA', (100, 100), (0, 0, 0, 0)).save(transparent, format='PNG')
+        data, media_type = ImagePipeline(format='JPEG').process(transparent.getvalue(), 'image/png')
+        assert media_type == 'image/jpeg'
+        with Image.open(BytesIO(data)) as processed:
+            assert processed.mode == 'RGB' and processed.getpixel((50, 50))[0] > 250
+    
+    def test_image_pipeline_keeps_optimised_images(self):
+        Image = pytest.importorskip('PIL.Image')
+        picture = Image.linear_gradient('L').resize((320, 240)).convert('RGB')
+        optimised = BytesIO()
+        picture.save(optimised, format='JPEG', quality=60, optimize=True)
+        optimised = optimised.getvalue()
+        assert ImagePipeline(quality=85).process(optimised, 'image/jpeg') == (optimised, 'image/jpeg')
+        with tempfile.TemporaryDirectory() as tmpdir:
+            ## A path is decoded from the file rather than read in, and kept as the attachment
+            path = Path(tmpdir) / 'picture.jpg'
+            path.write_bytes(optimised)
+            with patch.object(Path, 'read_bytes', side_effect=AssertionError('read in full')):
+                assert ImagePipeline(quality=85).process_file(path, 'image/jpeg') == (path, 'image/jpeg')
+            conv = Conversation(Bot(client=fake_client()), [])
+            conv.image_pipeline = ImagePipeline(quality=85)
+            conv.resume('look', with_files=[path])
+            assert [attachment.source for attachment in conv._attachments.values()] == [path]
+        ## ...but not if re-encoding makes it smaller, or it has metadata to drop
+        heavy = BytesIO()
+        picture.save(heavy, format='JPEG', quality=100)
+        data, media_type = ImagePipeline(quality=85).process(heavy.getvalue(), 'image/jpeg')
+        assert len(data) < len(heavy.getvalue())
+        exif = Image.Exif()
+        exif[0x010F] = 'Camera Maker' ## Make
+        tagged = BytesIO()
+        picture.save(tagged, format='JPEG', quality=60, optimize=True, exif=exif)
+        data, media_type = ImagePipeline(quality=85).process(tagged.getvalue(), 'image/jpeg')
+        with Image.open(BytesIO(data)) as processed:
+            assert not processed.getexif()
+    
+    class UploadingBot(Bot):
+        upload_files = True
+    
+    def test_files_api_uploads(self):
+        uploaded_files.invalidate()
+        payload = os.urandom(2000)
+        filespec = ('application/pdf', payload, 'document')
+        client = fake_client()
+        conv = Conversation(self.UploadingBot(client=client), [])
+        conv.resume('one', with_files=[filespec])
+        conv.resume('two')
+        conv2 = Conversation(self.UploadingBot(client=client), [])
+        conv2.resume('three', with_files=[filespec])
+        assert client.beta.files.upload_count == 1
+        file_id, (metadata, data) = next(iter(client.beta.files.uploaded.items()))
+        assert data == payload and metadata.mime_type == 'application/pdf'
+        assert client.messages.last_messages[0]['content'][0] == {'type': 'document', 'source': {'type': 'file', 'file_id': file_id}}
+        ## A new API key means a new workspace, so the file is uploaded again
+        other_client = FakeAnthropic(api_key='other-key')
+        Conversation(self.UploadingBot(client=other_client), []).resume('four', with_files=[filespec])
+        assert other_client.beta.files.upload_count == 1
+        ## Without a valid upload, the fake API refuses the request, as the real one would
+        client.beta.files.delete(file_id)
+        with pytest.raises(FakeNotFoundError):
+            conv.resume('five')
+        uploaded_files.invalidate(file_id)
+        conv.resume('six')
+        assert client.beta.files.upload_count == 2
+    
+    def test_files_api_uploads_async(self):
+        uploaded_files.invalidate()
+        client = fake_client_async()
+        conv = Conversation(self.UploadingBot(client=client), [], async_mode=True)
+        async def run():
+            await conv.aresume('one', with_files=[('image/png', b'0123456789', 'image')])
+            await conv.aresume('two')
+        asyncio.run(run())
+        assert client.beta.files.upload_count == 1
+        assert client.messages.last_messages[0]['content'][0]['source']['type'] == 'file'
+    
+    def test_file_upload_cache(self):
+        client = fake_client()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache = FileUploadCache(Path(tmpdir) / 'uploads.json', expiry_margin=60)
+            file_id = cache.upload(client, 'sha256:abc', 'text/plain', lambda: b'abc')
+            assert cache.upload(client, 'sha256:abc', 'text/plain', lambda: b'abc') == file_id
+            assert client.beta.files.upload_count == 1
+            assert FileUploadCache(Path(tmpdir) / 'uploads.json').lookup(client, 'sha256:abc') == file_id
+            ## Uploads about to expire are treated as expired
+            cache.store(client, 'sha256:def', client.beta.files.upload(file=('def', b'def', 'text/plain'), expires_in_seconds=30))
+            assert cache.lookup(client, 'sha256:def') is None
+            cache.store(client, 'sha256:def', client.beta.files.upload(file=('def', b'def', 'text/plain'), expires_in_seconds=3600))
+            assert cache.lookup(client, 'sha256:def') is not None
+            cache.invalidate()
+            assert cache.lookup(client, 'sha256:abc') is None
+    
+    def test_file_upload_cache_shared_between_processes(self):
+        client = fake_client()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            ## Each cache stands in for a different process using the same file
+            first, second = FileUploadCache(Path(tmpdir) / 'uploads.json'), FileUploadCache(Path(tmpdir) / 'uploads.json')
+            abc = first.upload(client, 'sha256:abc', 'text/plain', lambda: b'abc')
+            defg = second.upload(client, 'sha256:def', 'text/plain', lambda: b'def')
+            assert first.lookup(client, 'sha256:def') == defg and second.lookup(client, 'sha256:abc') == abc
+            first.invalidate(abc)
+            assert second.lookup(client, 'sha256:abc') is None
+            assert FileUploadCache(Path(tmpdir) / 'uploads.json').lookup(client, 'sha256:def') == defg
+            assert client.beta.files.upload_count == 2
+    
+    def test_encoded_attachment_cache_eviction(self):
+        cache = EncodedAttachmentCache(max_bytes=10)
+        assert cache.get('a', lambda: 'YWJj') == 'YWJj'
+        assert cache.get('b', lambda: 'ZGVm') == 'ZGVm'
+        cache.get('a', lambda: 'YWJj')
+        cache.get('c', lambda: 'Z2hp')
+        assert 'a' in cache and 'c' in cache and 'b' not in cache
+        cache.get('d', lambda: b64encode(b'0123456789')) ## Too big to cache
+        assert 'd' not in cache and (cache.hits, cache.misses) == (1, 4)
 
 
 class TestGeneratorFunctions:
@@ -588,6 +1262,75 @@ class TestConversationContext:
             c._get_conversation_context()[4]['content'][0]['cache_control']['type'] == 'ephemeral'
 
 
+class TestSnapshots:
+    scenario = {'navigate me': [{'type': 'tool_use', 'id': 'toolu_98765', 'name': 'guided_navigate', 'input': {'destination': '/xyz/xyz/'}}]}
+    
+    def test_waiting_tool_moves_between_workers(self):
+        conv = Conversation(ClientToolTestBot(client=FakeAnthropic(response_scenarios=self.scenario)), [])
+        conv.resume('test input', set_cache_checkpoint=True)
+        assert gettext(conv.resume('navigate me')) == '\n@@@@NAVIGATE /xyz/xyz/'
+        snapshot = conv.snapshot()
+        assert type(snapshot) is bytes
+        ## Another worker, with its own bot and client
+        restored = Conversation.restore(ClientToolTestBot(client=FakeAnthropic(response_scenarios=self.scenario)), snapshot)
+        assert restored.messages == conv.messages and restored.sysprompt == conv.sysprompt and restored.started
+        assert restored._message_cache_checkpoints == [0]
+        assert [type(obj) for obj in restored.message_objects] == [anthropic.types.Message, anthropic.types.Message, robo.CannedResponse]
+        assert restored.message_objects[1].content[0].input == {'destination': '/xyz/xyz/'}
+        assert restored.message_objects[2].text == conv.message_objects[2].text
+        assert json.loads(zlib.decompress(snapshot[9:]))['messages'] == conv.messages ## Plain JSON
+        assert [tub.status for tub in restored.tool_use_blocks.pending] == ['WAITING']
+        assert gettext(restored.resume('@@@@RECONNECT')) == '''Tool response was:['@@@@RECONNECT']'''
+        conv.resume('@@@@RECONNECT')
+        assert restored.messages == conv.messages
+    
+    class DatedBot(Bot):
+        def get_tools_schema(self):
+            return [{'name': 'today', 'description': "Today's date", 'input_schema': {'type': 'object', 'properties': {}}}]
+        
+        def tools_today(self):
+            return {'message': datetime(2020, 1, 1), 'target': 'model'}
+    
+    def test_snapshot_of_tool_returning_non_json_value(self):
+        scenario = {'what day is it': [{'type': 'tool_use', 'id': 'toolu_1', 'name': 'today', 'input': {}}]}
+        conv = Conversation(self.DatedBot(client=FakeAnthropic(response_scenarios=scenario)), [])
+        conv.resume('what day is it')
+        restored = Conversation.restore(self.DatedBot(client=FakeAnthropic(response_scenarios=scenario)), conv.snapshot())
+        assert restored.messages == conv.messages
+        assert restored.tool_use_blocks.resolved[0].response == {'target': 'model', 'message': '2020-01-01 00:00:00', 'is_error': False}
+    
+    def test_restore_modes_and_soft_start(self):
+        bot = TestFrontendFeatures.SoftStartBot(client=fake_client_async())
+        conv = Conversation(bot, [], async_mode=True, stream=True)
+        restored = Conversation.restore(bot, asyncio.run(conv.asnapshot()))
+        assert restored.is_async and restored.is_streaming and restored.soft_started
+        assert restored.messages == conv.messages
+        restored = Conversation.restore(bot, conv.snapshot(), stream=False)
+        assert not restored.is_streaming
+        with pytest.raises(SnapshotFormatException, match='Not a conversation snapshot'):
+            Conversation.restore(bot, b'{"messages": []}')
+        with pytest.raises(SnapshotFormatException, match='Unsupported snapshot version'):
+            Conversation.restore(bot, b'ROBOSNAP\xff')
+        with pytest.raises(SnapshotFormatException, match='Corrupt'):
+            Conversation.restore(bot, b'ROBOSNAP\x01not zlib')
+    
+    def test_logged_conversation_snapshot(self):
+        bot = Bot(client=fake_client())
+        with tempfile.TemporaryDirectory() as tmpdir:
+            conv = LoggedConversation(bot, logs_dir=tmpdir, log_durability='batched').prestart([])
+            conv.resume('one')
+            conv.resume('two', with_files=[('image/png', b'1234567890', 'image')])
+            restored = LoggedConversation.restore(bot, conv.snapshot(), logs_dir=tmpdir)
+            assert restored.conversation_id == conv.conversation_id
+            assert restored._attachments == {} and restored._get_conversation_context()[2]['content'][0]['source']['data'] == 'MTIzNDU2Nzg5MA=='
+            assert restored._log_state == conv._log_state
+            assert restored.first_saved_at == conv.first_saved_at
+            restored.resume('three')
+            restored.flush_log()
+            revived = LoggedConversation.revive(bot, conv.conversation_id, tmpdir)
+            assert revived.messages == restored.messages and len(revived.messages) == 6
+
+
 class TestClassBasicAttributes:
     def test_basic_attributes(self):
         class NameTesterBot(Bot):
@@ -653,6 +1396,213 @@ class TestOOTools:
             MyTool1()()
 
 
+class TestToolInputValidation:
+    def test_compiled_validator(self):
+        class MyTool(Tool):
+            description = 'Test tool'
+            parameter_descriptions = {'text': 'A string', 'count': 'A number', 'flag': 'A boolean'}
+            def __call__(self, text:str, count:int, flag:bool=False):
+                return text * count
+
+        validate = MyTool.get_input_validator()
+        assert validate({'text': 'a', 'count': 2}) == []
+        assert validate({'text': 'a', 'count': 2.5, 'flag': True}) == []
+        assert validate({'text': 'a'}) == ["missing required parameter 'count'"]
+        assert validate({'text': 'a', 'count': True}) == ["parameter 'count' should be of type number, got bool"]
+        assert validate({'text': 'a', 'count': 1, 'extra': 1}) == ["unexpected parameter 'extra'"]
+        assert validate(['a']) == ["input must be an object, got list"]
+
+        class PassthruTool(MyTool):
+            def __call__(self, text:str, **kwargs):
+                return text
+        assert PassthruTool.get_input_validator()({'text': 'a', 'extra': 1}) == []
+
+        class UncheckedTool(MyTool):
+            validate_input = False
+        assert UncheckedTool.get_input_validator() is None
+
+    def test_invalid_input_not_executed(self):
+        scenario = {'bad weather': [{'type': 'tool_use', 'id': 'toolu_1', 'name': 'GetWeather', 'input': {'location': 5}}]}
+        sio = StringIO()
+        with contextlib.redirect_stdout(sio):
+            conv = Conversation(ToolTesterBot(client=FakeAnthropic(response_scenarios=scenario)), [])
+            msg = conv.resume('bad weather')
+        assert 'GetWeather called' not in sio.getvalue()
+        tool_result = conv.messages[-2]['content'][0]
+        assert tool_result['is_error'] is True
+        assert "parameter 'location' should be of type string" in tool_result['content']
+        assert 'Invalid input for tool GetWeather' in gettext(msg)
+
+        conv = Conversation(ToolTesterBot(client=FakeAsyncAnthropic(response_scenarios=scenario)), [], async_mode=True)
+        asyncio.run(conv.aresume('bad weather'))
+        assert conv.messages[-2]['content'][0]['is_error'] is True
+
+
+class StreamingInputTesterBot(Bot):
+    class WriteFile(Tool):
+        description = 'Write a file'
+        parameter_descriptions = {'path': 'Where to write', 'content': 'What to write'}
+        streaming_input = True
+
+        torn_down = []
+
+        def __init__(self, **kwargs):
+            self.snapshots = []
+
+        def input_delta(self, partial_json, snapshot):
+            self.snapshots.append(snapshot)
+
+        def teardown(self):
+            self.torn_down.append(self)
+
+        def __call__(self, path:str, content:str):
+            return f'{len(self.snapshots)} deltas, final {self.snapshots[-1]["content"]}'
+
+    tools = [WriteFile]
+
+    test_scenario = {'write it': [{'type': 'tool_use', 'id': 'toolu_1', 'name': 'WriteFile',
+        'input': {'path': 'x.txt', 'content': 'a long piece of text to be streamed in'}}]}
+
+
+class TestStreamingToolInput:
+    def test_streaming_tool_input_sync(self):
+        deltas = []
+        conv = Conversation(StreamingInputTesterBot(client=FakeAnthropic(
+                    response_scenarios=StreamingInputTesterBot.test_scenario)), [], stream=True)
+        conv.register_callback('tool_input_delta', lambda conv, data: deltas.append(data))
+        with conv.resume('write it') as stream:
+            text = ''.join(stream.text_stream)
+        assert "deltas, final a long piece of text to be streamed in" in text
+        assert ''.join(partial for block, partial, snapshot in deltas) == \
+            json.dumps(StreamingInputTesterBot.test_scenario['write it'][0]['input'])
+        assert deltas[0][0].name == 'WriteFile'
+        assert conv._streaming_tool_instances == {}
+
+    def test_streaming_tool_input_async(self):
+        deltas = []
+        async def callback(conv, data):
+            deltas.append(data)
+        conv = Conversation(StreamingInputTesterBot(client=FakeAsyncAnthropic(
+                    response_scenarios=StreamingInputTesterBot.test_scenario)), [], stream=True, async_mode=True)
+        conv.register_callback('tool_input_delta', callback)
+        async def run():
+            async with await conv.aresume('write it') as stream:
+                return ''.join([chunk async for chunk in stream.text_stream])
+        text = asyncio.run(run())
+        assert "deltas, final a long piece of text to be streamed in" in text
+        assert len(deltas) > 1
+
+    def test_streaming_tool_input_stream_fails(self):
+        def failing_callback(conv, data):
+            if len(data[2]) > 1:
+                raise ConnectionResetError("dropped")
+        async def afailing_callback(conv, data):
+            failing_callback(conv, data)
+        torn_down = StreamingInputTesterBot.WriteFile.torn_down
+        torn_down.clear()
+        conv = Conversation(StreamingInputTesterBot(client=FakeAnthropic(
+                    response_scenarios=StreamingInputTesterBot.test_scenario)), [], stream=True)
+        conv.register_callback('tool_input_delta', failing_callback)
+        with pytest.raises(ConnectionResetError):
+            with conv.resume('write it') as stream:
+                ''.join(stream.text_stream)
+        assert conv._streaming_tool_instances == {}
+        assert len(torn_down) == 1 and torn_down[0].snapshots
+
+        conv = Conversation(StreamingInputTesterBot(client=FakeAsyncAnthropic(
+                    response_scenarios=StreamingInputTesterBot.test_scenario)), [], stream=True, async_mode=True)
+        conv.register_callback('tool_input_delta', afailing_callback)
+        async def run():
+            async with await conv.aresume('write it') as stream:
+                return ''.join([chunk async for chunk in stream.text_stream])
+        with pytest.raises(ConnectionResetError):
+            asyncio.run(run())
+        assert conv._streaming_tool_instances == {}
+        assert len(torn_down) == 2
+    
+    def test_streaming_tool_invalid_input(self):
+        scenario = {'write it': [{'type': 'tool_use', 'id': 'toolu_1', 'name': 'WriteFile',
+                    'input': {'path': 'x.txt', 'content': ['not', 'a', 'string']}}]}
+        torn_down = StreamingInputTesterBot.WriteFile.torn_down
+        torn_down.clear()
+        conv = Conversation(StreamingInputTesterBot(client=FakeAnthropic(response_scenarios=scenario)), [], stream=True)
+        with conv.resume('write it') as stream:
+            ''.join(stream.text_stream)
+        assert conv.messages[2]['content'][0]['is_error'] is True
+        assert len(torn_down) == 1 and torn_down[0].snapshots
+        
+        conv = Conversation(StreamingInputTesterBot(client=FakeAsyncAnthropic(response_scenarios=scenario)), [],
+                    stream=True, async_mode=True)
+        async def run():
+            async with await conv.aresume('write it') as stream:
+                return ''.join([chunk async for chunk in stream.text_stream])
+        asyncio.run(run())
+        assert conv.messages[2]['content'][0]['is_error'] is True
+        assert len(torn_down) == 2 and conv._streaming_tool_instances == {}
+
+
+class LifecycleTesterBot(Bot):
+    created, torn_down = [], []
+
+    class CountingTool(Tool):
+        description = 'Counts'
+        parameter_descriptions = {}
+
+        def __init__(self, **kwargs):
+            LifecycleTesterBot.created.append(self)
+
+        def __call__(self):
+            return str(id(self))
+
+        def teardown(self):
+            LifecycleTesterBot.torn_down.append(self)
+
+    class PerCall(CountingTool):
+        pass
+
+    class PerConversation(CountingTool):
+        lifecycle = 'conversation'
+
+    class PerProcess(CountingTool):
+        lifecycle = 'process'
+
+    tools = [PerCall, PerConversation, PerProcess]
+
+
+class TestToolLifecycles:
+    def _call_twice(self, conv, toolname):
+        tub = {'id': 'tu_12345', 'name': toolname, 'input': {}}
+        return [conv.bot.handle_tool_call(tub, conv.tool_context, conv._tool_pool)['message'] for i in range(2)]
+
+    def test_lifecycles(self):
+        LifecycleTesterBot.created.clear(), LifecycleTesterBot.torn_down.clear()
+        conv1 = Conversation(LifecycleTesterBot(client=fake_client()), [])
+        conv2 = Conversation(LifecycleTesterBot(client=fake_client()), [])
+
+        first, second = self._call_twice(conv1, 'PerCall')
+        assert first != second
+
+        first, second = self._call_twice(conv1, 'PerConversation')
+        assert first == second
+        assert self._call_twice(conv2, 'PerConversation')[0] != first
+
+        first, second = self._call_twice(conv1, 'PerProcess')
+        assert first == second == self._call_twice(conv2, 'PerProcess')[0]
+
+        assert len(LifecycleTesterBot.created) == 5
+        conv1.close()
+        assert len(LifecycleTesterBot.torn_down) == 1
+        asyncio.run(conv2.aclose())
+        assert len(LifecycleTesterBot.torn_down) == 2
+        assert len(conv1._tool_pool) == 0
+
+    def test_invalid_lifecycle(self):
+        class BadTool(Tool):
+            lifecycle = 'forever'
+        with pytest.raises(ValueError, match='Unknown lifecycle'):
+            BadTool.get_lifecycle()
+
+
 class TestToolUse:
     def test_tooluse_sync_flat(self):
         conv = Conversation(ToolTesterBot(client=fake_client()), [])
@@ -699,7 +1649,66 @@ class TestToolUse:
         
         with pytest.raises(Exception, match='Tool function not found: tools_get_url2'):
             bot.handle_tool_call(tooldata_missing)
+
+    def test_tool_dispatch_table(self):
+        class RenamedToolBot(Bot):
+            class GetWeather(Tool):
+                name = 'weather'
+                description = 'Get weather'
+                parameter_descriptions = {'location': 'the location'}
+                target = 'client'
+                async def call_async(self, location:str):
+                    return f'Raining in {location}'
+                def call_sync(self, location:str):
+                    return f'Sunny in {location}'
+
+            tools = [GetWeather]
+
+            def tools_legacy(self, x=None):
+                return {'target': 'model', 'message': x}
+
+            async def unprefixed(self, x=None):
+                return {'target': 'model', 'message': x * 2}
+
+        table = RenamedToolBot._get_tool_dispatch_table()
+        assert RenamedToolBot._get_tool_dispatch_table() is table
+        assert set(table) == {'weather', 'legacy'}
+        assert table['weather'].target == 'client' and table['weather'].native_async
+        assert ToolTesterBot._get_tool_dispatch_table() is not table
+
+        bot = RenamedToolBot(client=fake_client())
+        assert bot.handle_tool_call({'id': 'tu_1', 'name': 'weather', 'input': {'location': 'Oslo'}}) == \
+            {'target': 'client', 'message': 'Sunny in Oslo'}
+        assert bot.handle_tool_call({'id': 'tu_2', 'name': 'legacy', 'input': {'x': 'y'}})['message'] == 'y'
+        assert asyncio.run(bot.ahandle_tool_call({'id': 'tu_3', 'name': 'unprefixed', 'input': {'x': 'y'}}))['message'] == 'yy'
+        assert 'unprefixed' in table
+        with pytest.raises(Exception, match='Tool function not found: tools_GetWeather2'):
+            bot.handle_tool_call({'id': 'tu_4', 'name': 'GetWeather2', 'input': {}})
     
+    def test_tool_classes_as_tools_attributes(self):
+        class Forecast(Tool):
+            description = 'Get the forecast'
+            parameter_descriptions = {'location': 'the location'}
+            def call_sync(self, location:str):
+                return f'Fog in {location}'
+        
+        class AttributeToolBot(Bot):
+            tools_forecast = Forecast
+        
+        table = AttributeToolBot._get_tool_dispatch_table()
+        assert table['forecast'].toolclass is Forecast
+        bot = AttributeToolBot(client=fake_client())
+        assert bot.handle_tool_call({'id': 'tu_1', 'name': 'forecast', 'input': {'location': 'Leeds'}}) == \
+            {'target': 'model', 'message': 'Fog in Leeds'}
+        ## Tools bound to one instance are found, but not shared with other instances of the class
+        bot.tools_local = lambda x=None: {'target': 'model', 'message': x}
+        bot.tools_instance_forecast = Forecast
+        assert bot.handle_tool_call({'id': 'tu_2', 'name': 'local', 'input': {'x': 'y'}})['message'] == 'y'
+        assert bot.handle_tool_call({'id': 'tu_3', 'name': 'instance_forecast', 'input': {'location': 'Hull'}})['message'] == 'Fog in Hull'
+        assert 'local' not in table and 'instance_forecast' not in table
+        with pytest.raises(Exception, match='Tool function not found: tools_local'):
+            AttributeToolBot(client=fake_client()).handle_tool_call({'id': 'tu_4', 'name': 'local', 'input': {}})
+
     def test_tooluse_client_targeted(self):
         scenario = {'navigate me': [{'type': 'tool_use', 'id': 'toolu_98765', 'name': 'guided_navigate', 'input': {'destination': '/xyz/xyz/'}}]}
         # sync flat
@@ -1072,6 +2081,495 @@ class TestBaseStreamWrappers:
         
         result = asyncio.run(wrapper())
         assert result == 'Hello2'
+    
+    def test_streamwrapper_accumulated_text(self):
+        conv = Conversation(Bot(client=create_fake_client()), [], stream=True)
+        with StreamWrapper(FakeStreamManager(['Hello']), conv) as sw:
+            for chunk in sw.text_stream:
+                assert sw.accumulated_text.endswith(chunk)
+            assert sw.chunks == list('Hello')
+        assert conv.messages[-1]['content'][0]['text'] == 'Hello'
+        sw.accumulated_text = 'replaced'
+        assert sw.accumulated_text == 'replaced'
+        
+        sw.accumulated_text = ''
+        sw.chunks.append('a')
+        assert sw.accumulated_text == 'a'
+        sw.accumulated_text = 'replaced'
+        assert sw.accumulated_text == 'replaced'
+    
+    def test_stream_event_retention(self):
+        class RetainingBot(Bot):
+            stream_retain_events = 3
+        message = 'hello there'
+        
+        conv = Conversation(Bot(client=create_fake_client()), [], stream=True)
+        with conv.resume(message) as stream:
+            all_text = ''.join(stream.text_stream)
+        all_events = list(stream.events)
+        assert len(all_events) > 3
+        
+        conv = Conversation(RetainingBot(client=create_fake_client()), [], stream=True)
+        with conv.resume(message) as stream:
+            assert ''.join(stream.text_stream) == all_text
+        assert [e.type for e in stream.events] == [e.type for e in all_events[-3:]]
+        
+        conv = Conversation(Bot(client=create_fake_client()), [], stream=True)
+        with StreamWrapper(FakeStreamManager(['Hello']), conv, retain_events=0) as sw:
+            assert len(list(sw.event_stream)) > 0
+        assert len(sw.events) == 0
+        
+        async def run():
+            conv = Conversation(RetainingBot(client=create_fake_async_client()), [], stream=True, async_mode=True)
+            async with await conv.aresume(message) as stream:
+                text = ''.join([chunk async for chunk in stream.text_stream])
+            return text, stream
+        text, stream = asyncio.run(run())
+        assert text == all_text
+        assert len(stream.events) == 3
+        assert stream.accumulated_text == all_text
+
+
+class TestStreamMultiplexer:
+    def _conversation(self):
+        return Conversation(Bot(client=create_fake_async_client()), [], stream=True, async_mode=True)
+    
+    def test_multiplexer(self):
+        from robo.streamutils import StreamMultiplexer
+        convs = {key: self._conversation() for key in ['a', 'b', 'c']}
+        async def failing():
+            yield 'x'
+            raise ValueError('oops')
+        async def run():
+            received = defaultdict(str)
+            order = []
+            mux = StreamMultiplexer({key: conv.aresume(f'say {key}') for key, conv in convs.items()}, buffer_size=2)
+            mux.add('broken', failing())
+            async with mux:
+                async for key, chunk in mux:
+                    received[key] += chunk
+                    order.append(key)
+            return mux, received, order
+        mux, received, order = asyncio.run(run())
+        for key, conv in convs.items():
+            assert received[key] == f"I understand you said: 'say {key}'. How can I help you with that?"
+            assert conv.messages[-1]['content'][0]['text'] == received[key]
+            assert mux.results[key] is None
+        assert type(mux.results['broken']) is ValueError
+        assert mux.pending == []
+        ## Chunks are interleaved rather than one stream after another
+        assert order.index('c') < len(order) - order[::-1].index('a')
+    
+    def test_multiplexer_cancellation(self):
+        from robo.streamutils import StreamMultiplexer
+        convs = [self._conversation() for i in range(2)]
+        async def run():
+            async with StreamMultiplexer({i: conv.aresume('hello') for i, conv in enumerate(convs)}) as mux:
+                async for key, chunk in mux:
+                    break
+            return mux
+        mux = asyncio.run(run())
+        assert all(type(mux.results[i]) is asyncio.CancelledError for i in range(2))
+        assert all(conv.messages == [] for conv in convs)
+        
+        convs = [self._conversation() for i in range(2)]
+        async def run_committing():
+            mux = StreamMultiplexer({i: conv.aresume('hello') for i, conv in enumerate(convs)}, commit_partial=True)
+            async for key, chunk in mux:
+                if key == 0:
+                    break
+            await mux.aclose()
+            return mux
+        mux = asyncio.run(run_committing())
+        assert [m['role'] for m in convs[0].messages] == ['user', 'assistant']
+        assert 'Hello! How can I help you today?'.startswith(convs[0].messages[-1]['content'][0]['text'])
+    
+    def test_multiplexer_fail_fast(self):
+        from robo.streamutils import StreamMultiplexer
+        async def failing():
+            raise ValueError('oops')
+            yield
+        async def run():
+            async with StreamMultiplexer({'ok': self._conversation().aresume('hello'), 'broken': failing()},
+                        fail_fast=True) as mux:
+                async for key, chunk in mux:
+                    pass
+        with pytest.raises(ValueError):
+            asyncio.run(run())
+
+
+class TestStreamBroadcaster:
+    expected = "I understand you said: 'broadcast'. How can I help you with that?"
+    
+    def test_broadcast_with_late_subscriber(self):
+        from robo.streamutils import StreamBroadcaster
+        client = create_fake_async_client()
+        conv = Conversation(Bot(client=client), [], stream=True, async_mode=True)
+        async def consume(subscriber):
+            return ''.join([chunk async for chunk in subscriber])
+        async def run():
+            async with StreamBroadcaster(conv.aresume('broadcast')) as broadcast:
+                early = [broadcast.subscribe() for i in range(2)]
+                consumers = [asyncio.ensure_future(consume(s)) for s in early]
+                while len(broadcast.text) < 10:
+                    await asyncio.sleep(0.001)
+                late = broadcast.subscribe()
+                assert late.queue[0] == broadcast.text
+                results = await asyncio.gather(*consumers, consume(late))
+                await broadcast.wait()
+            return results
+        assert asyncio.run(run()) == [self.expected] * 3
+        assert client.messages.call_count == 1
+        assert conv.messages[-1]['content'][0]['text'] == self.expected
+    
+    def test_slow_subscriber_policies(self):
+        from robo.streamutils import StreamBroadcaster
+        async def run(policy):
+            conv = Conversation(Bot(client=create_fake_async_client()), [], stream=True, async_mode=True)
+            async with StreamBroadcaster(conv.aresume('broadcast'), max_queue=2, policy=policy) as broadcast:
+                slow = broadcast.subscribe()
+                await broadcast.wait()
+            received = []
+            try:
+                async for chunk in slow:
+                    received.append(chunk)
+            except SubscriberDroppedException:
+                received.append(None)
+            return slow, received
+        slow, received = asyncio.run(run(StreamBroadcaster.DEGRADE))
+        assert slow.degraded and len(received) == 2 and ''.join(received) == self.expected
+        slow, received = asyncio.run(run(StreamBroadcaster.DROP))
+        assert slow.dropped and received == ['I', ' ', None]
+    
+    def test_broadcast_cancelled(self):
+        from robo.streamutils import StreamBroadcaster
+        conv = Conversation(Bot(client=create_fake_async_client()), [], stream=True, async_mode=True)
+        async def run():
+            async with StreamBroadcaster(conv.aresume('broadcast')) as broadcast:
+                subscriber = broadcast.subscribe()
+                received = [await subscriber.__anext__()]
+            try:
+                async for chunk in subscriber:
+                    received.append(chunk)
+            except StreamCancelledException:
+                received.append(None)
+            return received
+        received = asyncio.run(run())
+        assert received[-1] is None and self.expected.startswith(''.join(received[:-1]))
+        assert conv.messages == []
+
+
+class TestStreamCancellation:
+    def test_cancel_commits_partial(self):
+        cancelled = []
+        conv = Conversation(Bot(client=create_fake_client()), [], stream=True)
+        conv.register_callback('response_cancelled', lambda conv, data: cancelled.append(data))
+        with conv.resume('hello') as stream:
+            for i, chunk in enumerate(stream.text_stream):
+                if i == 4:
+                    assert stream.cancel() == 'Hello'
+        assert stream.stream_context._closed
+        assert cancelled == [('Hello',)]
+        assert [m['role'] for m in conv.messages] == ['user', 'assistant']
+        assert conv.messages[-1]['content'][0]['text'] == 'Hello'
+    
+    def test_cancel_without_commit(self):
+        conv = Conversation(Bot(client=create_fake_client()), [], stream=True)
+        with conv.resume('hello') as stream:
+            for chunk in stream.text_stream:
+                break
+            stream.cancel(commit_partial=False)
+        assert conv.messages == []
+    
+    def test_cancel_during_tool_followup(self):
+        conv = Conversation(TimeWeatherLocationTestBot(client=create_fake_client(
+                    TimeWeatherLocationTestBot.test_scenario)), [], stream=True)
+        with conv.resume('tool test') as stream:
+            chunks = stream.text_stream
+            partial = next(chunks) + next(chunks)
+            assert stream.cancel() == partial
+        assert [m['role'] for m in conv.messages] == ['user', 'assistant', 'user', 'assistant']
+        assert conv.messages[-1]['content'][0]['text'] == partial
+        
+        with conv.resume('tool test') as stream:
+            next(stream.text_stream)
+            stream.cancel(commit_partial=False)
+        assert len(conv.messages) == 4
+    
+    def test_cancel_async(self):
+        cancelled = []
+        async def callback(conv, data):
+            cancelled.append(data)
+        conv = Conversation(Bot(client=create_fake_async_client()), [], stream=True, async_mode=True)
+        conv.register_callback('response_cancelled', callback)
+        async def run():
+            async with await conv.aresume('hello') as stream:
+                async for chunk in stream.text_stream:
+                    if len(stream.chunks) == 2:
+                        await stream.cancel()
+                        break
+        asyncio.run(run())
+        assert cancelled == [('He',)]
+        assert conv.messages[-1]['content'][0]['text'] == 'He'
+
+
+class TestStreamMetrics:
+    def _check_metrics(self, metrics, text):
+        stats = metrics.as_dict()
+        assert stats['requests'] == 2
+        assert stats['chunks'] == len(text)
+        assert sum(stats['gap_histogram'].values()) == len(text) - 1
+        assert [phase['tools'] for phase in stats['tool_phases']] == [['StartTimer']]
+        assert stats['tool_time'] >= 0.2
+        assert 0 <= stats['time_to_response'] <= stats['time_to_first_event'] <= stats['ttft'] <= stats['duration']
+        assert stats['ttft'] >= stats['tool_time']
+    
+    def test_stream_metrics_sync(self):
+        reported = []
+        conv = Conversation(TimerBot(client=create_fake_client(TimerBot.test_scenario)), [], stream=True)
+        conv.register_callback('stream_metrics', lambda conv, data: reported.append(data))
+        with conv.resume('tool test') as stream:
+            text = ''.join(stream.text_stream)
+        assert reported == [(stream.metrics,)]
+        self._check_metrics(stream.metrics, text)
+    
+    def test_stream_metrics_async(self):
+        reported = []
+        async def callback(conv, data):
+            reported.append(data)
+        conv = Conversation(TimerBot(client=create_fake_async_client(TimerBot.test_scenario)), [], 
+                stream=True, async_mode=True)
+        conv.register_callback('stream_metrics', callback)
+        async def run():
+            async with await conv.aresume('tool test') as stream:
+                return ''.join([chunk async for chunk in stream.text_stream]), stream
+        text, stream = asyncio.run(run())
+        assert reported == [(stream.metrics,)]
+        self._check_metrics(stream.metrics, text)
+        ## The fake async client sleeps 1ms between chunks
+        assert stream.metrics.as_dict()['gap_mean'] >= 0.001
+
+
+class ResumingBot(Bot):
+    stream_resume_attempts = 1
+
+
+class TestStreamReadahead:
+    def test_readahead(self):
+        class ReadaheadBot(Bot):
+            stream_readahead = 4
+        conv = Conversation(ReadaheadBot(client=create_fake_client()), [], stream=True)
+        with conv.resume('hello') as stream:
+            chunks = stream.text_stream
+            first = next(chunks)
+            time.sleep(0.05)
+            ## The reader has carried on while the consumer was busy, but no further than allowed
+            assert 4 <= len(stream.stream_context._events) - 1 <= 4 + 2
+            text = first + ''.join(chunks)
+        assert text == 'Hello! How can I help you today?'
+        assert conv.messages[-1]['content'][0]['text'] == text
+    
+    def test_readahead_tool_use_and_errors(self):
+        class ReadaheadToolBot(TimeWeatherLocationTestBot):
+            stream_readahead = 2
+        conv = Conversation(ReadaheadToolBot(client=create_fake_client(TimeWeatherLocationTestBot.test_scenario)),
+                [], stream=True)
+        with conv.resume('tool test') as stream:
+            assert ''.join(stream.text_stream).startswith('Tool response was:')
+        
+        class ReadaheadResumingBot(ResumingBot):
+            stream_readahead = 2
+        for bot in [ReadaheadResumingBot(client=FakeAnthropic(disconnect_after=[7])), 
+                    ReadaheadToolBot(client=FakeAnthropic(disconnect_after=[7]))]:
+            conv = Conversation(bot, [], stream=True)
+            try:
+                with conv.resume('hello') as stream:
+                    text = ''.join(stream.text_stream)
+            except ConnectionResetError:
+                text = None
+            assert text == (TestStreamResume.expected if bot.stream_resume_attempts else None)
+
+
+class TestStreamResume:
+    expected = 'Hello! How can I help you today?'
+    
+    def test_resume_after_disconnect(self):
+        for disconnect_after, prefill in [(10, 'Hello! How'), (7, 'Hello!')]:
+            client = FakeAnthropic(disconnect_after=[disconnect_after])
+            conv = Conversation(ResumingBot(client=client), [], stream=True)
+            with conv.resume('hello') as stream:
+                assert ''.join(stream.text_stream) == self.expected
+            assert client.messages.last_messages[-1]['content'][0]['text'] == prefill
+            assert [m['role'] for m in conv.messages] == ['user', 'assistant']
+            assert conv.messages[-1]['content'] == [{'type': 'text', 'text': self.expected}]
+            assert stream.metrics.requests == 2
+    
+    def test_no_resume_by_default(self):
+        conv = Conversation(Bot(client=FakeAnthropic(disconnect_after=[5])), [], stream=True)
+        with pytest.raises(ConnectionResetError):
+            with conv.resume('hello') as stream:
+                for chunk in stream.text_stream:
+                    pass
+        assert stream.accumulated_text == 'Hello'
+    
+    def test_resume_tool_followup(self):
+        class ResumingToolBot(TimeWeatherLocationTestBot):
+            stream_resume_attempts = 1
+        conv = Conversation(ResumingToolBot(client=FakeAnthropic(response_scenarios=TimeWeatherLocationTestBot.test_scenario,
+                    disconnect_after=[None, 12])), [], stream=True)
+        with conv.resume('tool test') as stream:
+            text = ''.join(stream.text_stream)
+        assert text.startswith('Tool response was:') and text.endswith(']')
+        assert conv.messages[-1]['content'][0]['text'] == text
+    
+    def test_resume_async(self):
+        conv = Conversation(ResumingBot(client=FakeAsyncAnthropic(disconnect_after=[7])), [], 
+                stream=True, async_mode=True)
+        async def run():
+            async with await conv.aresume('hello') as stream:
+                return ''.join([chunk async for chunk in stream.text_stream])
+        assert asyncio.run(run()) == self.expected
+        assert conv.messages[-1]['content'][0]['text'] == self.expected
+
+
+def _parse_sse(payloads):
+    events = []
+    for payload in payloads:
+        if payload.startswith(b':'):
+            events.append(('heartbeat', None))
+            continue
+        eventline, dataline = payload.decode('utf-8').strip().split('\n')
+        events.append((eventline.removeprefix('event: '), json.loads(dataline.removeprefix('data: '))))
+    return events
+
+
+class TestSSE:
+    def _check_events(self, events):
+        assert [e for e in events if e[0] == 'tool'] == [
+            ('tool', {'id': 'toolu_00001', 'name': 'GetUserLocation', 'status': 'started', 'is_error': False}),
+            ('tool', {'id': 'toolu_00002', 'name': 'GetLocationWeather', 'status': 'started', 'is_error': False}),
+            ('tool', {'id': 'toolu_00001', 'name': 'GetUserLocation', 'status': 'finished', 'is_error': False}),
+            ('tool', {'id': 'toolu_00002', 'name': 'GetLocationWeather', 'status': 'finished', 'is_error': False}),
+        ]
+        assert ''.join(data['text'] for name, data in events if name == 'text').startswith('Tool response was:')
+        ## One request for the tool calls, one for the follow-up
+        assert events[-1] == ('usage', {'input_tokens': 200, 'output_tokens': 100})
+    
+    def test_sse_sync(self):
+        from robo.sse import sse_stream
+        conv = Conversation(TimeWeatherLocationTestBot(client=create_fake_client(
+                    TimeWeatherLocationTestBot.test_scenario)), stream=True)
+        events = _parse_sse(sse_stream(conv, 'tool test'))
+        self._check_events(events)
+        assert conv._lookup_callbacks('tool_executed') == []
+    
+    def test_sse_async(self):
+        from robo.sse import asse_stream
+        conv = Conversation(TimeWeatherLocationTestBot(client=create_fake_async_client(
+                    TimeWeatherLocationTestBot.test_scenario)), stream=True, async_mode=True)
+        async def run():
+            return [payload async for payload in asse_stream(conv, 'tool test', heartbeat=0.0005)]
+        events = _parse_sse(asyncio.run(run()))
+        assert ('heartbeat', None) in events
+        self._check_events([e for e in events if e[0] != 'heartbeat'])
+    
+    class WatchedToolBot(Bot):
+        """Its tool records the SSE events the client had received by the time it ran"""
+        scenario = {'look': [{'type': 'tool_use', 'id': 'toolu_1', 'name': 'look', 'input': {}}]}
+        
+        def __init__(self, received, **kwargs):
+            self.received = received
+            self.seen = []
+            super().__init__(**kwargs)
+        
+        def get_tools_schema(self):
+            return [{'name': 'look', 'description': 'Look around', 'input_schema': {'type': 'object', 'properties': {}}}]
+        
+        def tools_look(self):
+            self.seen.append(list(self.received))
+            return {'message': 'a room', 'target': 'model'}
+    
+    class AsyncWatchedToolBot(WatchedToolBot):
+        async def tools_look(self):
+            await asyncio.sleep(0.05) ## The started event goes out while the tool is still running
+            self.seen.append(list(self.received))
+            return {'message': 'a room', 'target': 'model'}
+    
+    def _check_tool_progress(self, bot, received):
+        started = ('tool', {'id': 'toolu_1', 'name': 'look', 'status': 'started', 'is_error': False})
+        finished = ('tool', {'id': 'toolu_1', 'name': 'look', 'status': 'finished', 'is_error': False})
+        assert started in bot.seen[0] and finished not in bot.seen[0] ## The client heard about the tool as it ran
+        assert started in received and finished in received
+        result = next(i for i, event in enumerate(received) if event[0] == 'text') ## The reply to the tool's result
+        assert received.index(started) < received.index(finished) < result
+        assert 'a room' in ''.join(event[1]['text'] for event in received[result:] if event[0] == 'text')
+    
+    def test_sse_tool_progress(self):
+        from robo.sse import sse_stream
+        received = []
+        bot = self.WatchedToolBot(received, client=create_fake_client(self.WatchedToolBot.scenario))
+        for payload in sse_stream(Conversation(bot, [], stream=True), 'look'):
+            received.extend(_parse_sse([payload]))
+        self._check_tool_progress(bot, received)
+        
+        received.clear()
+        bot = self.AsyncWatchedToolBot(received, client=create_fake_async_client(self.WatchedToolBot.scenario))
+        from robo.sse import asse_stream
+        async def run():
+            async for payload in asse_stream(Conversation(bot, [], stream=True, async_mode=True), 'look', heartbeat=0.01):
+                received.extend(_parse_sse([payload]))
+        asyncio.run(run())
+        assert ('heartbeat', None) in received
+        self._check_tool_progress(bot, [event for event in received if event[0] != 'heartbeat'])
+    
+    def test_sse_coalesced(self):
+        from robo.sse import sse_stream
+        conv = Conversation(TimeWeatherLocationTestBot(client=create_fake_client(
+                    TimeWeatherLocationTestBot.test_scenario)), stream=True)
+        events = _parse_sse(sse_stream(conv, 'tool test', coalesce=True))
+        self._check_events(events)
+        assert len([e for e in events if e[0] == 'text']) < 10
+    
+    def test_sse_asgi_disconnect(self):
+        from robo.sse import SSEResponse
+        conv = Conversation(Bot(client=create_fake_async_client()), stream=True, async_mode=True)
+        sent = []
+        async def run(**kwargs):
+            disconnected = asyncio.Event()
+            async def receive():
+                await disconnected.wait()
+                return {'type': 'http.disconnect'}
+            async def send(message):
+                sent.append(message)
+                if len(sent) == 4:
+                    disconnected.set()
+            await SSEResponse(conv, 'hello', heartbeat=None, **kwargs)(
+                    {'type': 'http', 'method': 'GET', 'path': '/'}, receive, send)
+        asyncio.run(run())
+        assert sent[0]['status'] == 200
+        assert (b'content-type', b'text/event-stream') in sent[0]['headers']
+        assert all(m['more_body'] for m in sent[1:])
+        assert len(sent) < 10
+        assert conv.messages == []
+        
+        conv = Conversation(Bot(client=create_fake_async_client()), stream=True, async_mode=True)
+        sent.clear()
+        asyncio.run(run(commit_partial=True))
+        text = ''.join(json.loads(m['body'].split(b'data: ')[1])['text'] for m in sent[1:] if m['body'])
+        assert [m['role'] for m in conv.messages] == ['user', 'assistant']
+        assert conv.messages[-1]['content'][0]['text'].startswith(text)
+    
+    def test_sse_sync_disconnect(self):
+        from robo.sse import sse_stream
+        for commit_partial in (False, True):
+            conv = Conversation(Bot(client=create_fake_client()), stream=True)
+            events = sse_stream(conv, 'hello', commit_partial=commit_partial)
+            next(events)
+            events.close()
+            if commit_partial:
+                assert [m['role'] for m in conv.messages] == ['user', 'assistant']
+            else:
+                assert conv.messages == []
 
 
 class TestConversationStartMethods:
@@ -1,5 +1,8 @@
 
 import inspect
+import atexit
+import threading
+import types
 
 _types_map = {
     str: 'string',
@@ -11,8 +14,40 @@ _types_map = {
     type(None): 'null',
 }
 
+## JSON schema type -> python types that satisfy it. Checked with `type(v) in ...` rather than
+## isinstance so that bools are not accepted as numbers.
+_schema_types_map = {
+    'string': frozenset([str]),
+    'number': frozenset([int, float]),
+    'integer': frozenset([int]),
+    'boolean': frozenset([bool]),
+    'array': frozenset([list, tuple]),
+    'object': frozenset([dict]),
+    'null': frozenset([type(None)]),
+}
+
+LIFECYCLE_CALL = 'call'
+LIFECYCLE_CONVERSATION = 'conversation'
+LIFECYCLE_PROCESS = 'process'
+LIFECYCLES = (LIFECYCLE_CALL, LIFECYCLE_CONVERSATION, LIFECYCLE_PROCESS)
+
 class Tool(object):
-    __slots__ = ['name', 'description', 'parameter_descriptions', 'target']
+    """lifecycle determines how long an instance of the Tool lives for:
+        'call' (the default) - a new instance is created for every tool call.
+        'conversation' - one instance is created per Conversation and reused for every call
+            made within it. teardown() is called when the Conversation is closed.
+        'process' - one instance is shared by every Conversation in the process. Since it isn't
+            tied to any single Conversation, it is instantiated WITHOUT tool context. teardown()
+            is called at interpreter shutdown.
+    Use the longer lifecycles for tools that open DB connections, HTTP sessions etc in __init__.
+    validate_input (default True) checks the input from the model against the call schema before
+    the tool is run; set it to False to skip this.
+    streaming_input (default False) - when streaming, the tool is instantiated as soon as the model
+    starts a call to it, and input_delta() receives the input as it streams in. This lets tools with
+    large inputs (code, documents) start work before the call is complete. The same instance then
+    handles the call itself."""
+    __slots__ = ['name', 'description', 'parameter_descriptions', 'target', 'lifecycle', 'validate_input',
+                 'streaming_input']
     def __init__(self, *args, **kwargs):
         """If a tool_context exists, it will be passed in here as kwargs. If anything needs
         to be done with it (for example stashing object references on the Tool instance), 
@@ -28,6 +63,48 @@ class Tool(object):
     async def call_async(self, *args, **kwargs):
         return self.__call__(*args, **kwargs)
     
+    def input_delta(self, partial_json:str, snapshot:dict):
+        """Receives the tool input as it streams in (see streaming_input). partial_json is the
+        newly arrived fragment of JSON text, snapshot is the input parsed so far - note that the
+        last string value in it may be incomplete."""
+        pass
+    
+    async def ainput_delta(self, partial_json:str, snapshot:dict):
+        self.input_delta(partial_json, snapshot)
+    
+    def teardown(self):
+        """Release any resources acquired in __init__. Called when a pooled instance is
+        retired (see lifecycle), and for a per-call instance only if it was created for
+        streaming_input and the call was never made (the stream ended first, or the input was
+        rejected)."""
+        pass
+    
+    async def ateardown(self):
+        self.teardown()
+    
+    @classmethod
+    def get_lifecycle(klass):
+        lifecycle = getattr(klass, 'lifecycle', None)
+        if lifecycle is None or type(lifecycle) is types.MemberDescriptorType:
+            return LIFECYCLE_CALL
+        if lifecycle not in LIFECYCLES:
+            raise ValueError(f"Unknown lifecycle for tool {klass.__name__}: {lifecycle}")
+        return lifecycle
+    
+    @classmethod
+    def get_input_validator(klass):
+        """Return a compiled validator for this tool's input (see compile_input_validator), or
+        None if validate_input has been switched off."""
+        if getattr(klass, 'validate_input', True) is False:
+            return None
+        allow_additional = False
+        for callname in ['__call__', 'call_sync', 'call_async']:
+            if getattr(klass, callname) is not getattr(Tool, callname):
+                params = inspect.signature(getattr(klass, callname)).parameters.values()
+                allow_additional = any(p.kind is inspect.Parameter.VAR_KEYWORD for p in params)
+                break
+        return compile_input_validator(klass.get_call_schema()['input_schema'], allow_additional)
+    
     @classmethod
     def get_call_schema(klass):
         input_schema_properties = {}
@@ -61,4 +138,82 @@ class Tool(object):
         }
 
 
-__all__ = ['Tool']
\ No newline at end of file
+def compile_input_validator(input_schema, allow_additional=False):
+    """Compile an input_schema into a function that takes a tool input dict and returns a list of
+    problems with it (empty if the input is valid). Only the parts of JSON Schema that
+    Tool.get_call_schema produces are checked: required properties, property types and (unless
+    allow_additional is set) unexpected properties."""
+    properties = input_schema.get('properties', {})
+    required = tuple(input_schema.get('required', ()))
+    allowed = frozenset(properties)
+    typechecks = {key: (spec['type'], _schema_types_map[spec['type']]) for key, spec in properties.items()
+                  if spec.get('type') in _schema_types_map}
+    
+    def validate(toolinput):
+        if type(toolinput) is not dict:
+            return [f"input must be an object, got {type(toolinput).__name__}"]
+        problems = [f"missing required parameter '{key}'" for key in required if key not in toolinput]
+        for key, value in toolinput.items():
+            if (check := typechecks.get(key)) is not None:
+                if type(value) not in check[1]:
+                    problems.append(f"parameter '{key}' should be of type {check[0]}, got {type(value).__name__}")
+            elif key not in allowed and not allow_additional:
+                problems.append(f"unexpected parameter '{key}'")
+        return problems
+    
+    return validate
+
+
+class ToolPool(object):
+    """Holds reusable Tool instances, one per Tool class. Conversations each have their own
+    pool for 'conversation' lifecycle tools; 'process' lifecycle tools live in a single
+    module-level pool that is torn down at interpreter exit."""
+    __slots__ = ['instances', '_lock']
+    
+    def __init__(self):
+        self.instances = {}
+        self._lock = threading.Lock()
+    
+    def __len__(self):
+        return len(self.instances)
+    
+    def acquire(self, toolclass, toolcontext={}):
+        try:
+            return self.instances[toolclass]
+        except KeyError:
+            pass
+        with self._lock:
+            if (instance := self.instances.get(toolclass)) is None:
+                instance = self.instances[toolclass] = toolclass(**toolcontext)
+        return instance
+    
+    def _drain(self):
+        with self._lock:
+            instances = list(self.instances.values())
+            self.instances.clear()
+        return instances
+    
+    def teardown(self):
+        for instance in self._drain():
+            instance.teardown()
+    
+    async def ateardown(self):
+        for instance in self._drain():
+            await instance.ateardown()
+
+
+_process_pool = ToolPool()
+atexit.register(_process_pool.teardown)
+
+def get_tool_instance(toolclass, toolcontext={}, toolpool=None):
+    """Return an instance of toolclass appropriate to its lifecycle. If no toolpool is given,
+    'conversation' lifecycle tools fall back to being created per call."""
+    lifecycle = toolclass.get_lifecycle()
+    if lifecycle == LIFECYCLE_PROCESS:
+        return _process_pool.acquire(toolclass)
+    elif lifecycle == LIFECYCLE_CONVERSATION and toolpool is not None:
+        return toolpool.acquire(toolclass, toolcontext)
+    return toolclass(**toolcontext)
+
+
+__all__ = ['Tool', 'ToolPool', 'compile_input_validator']